@@ -10,6 +10,7 @@ from rich import print
 import sqlite3
 
 from src.models import generate_id
+from src.tokenizer import split_dba
 
 # Connect to SQLite database (or create it if it doesn't exist)
 FINCH_DB_MODE = os.getenv("FINCH_DB_MODE", "prod")
@@ -215,9 +216,10 @@ def get_ppp(row, quick_mode=False):
         for k, v in ppp_mapping.items():
             kwargs[k] = row[v].title()
 
-    if " DBA " in row["BorrowerName"].upper():
-        kwargs["name"] = row["BorrowerName"].upper().split(" DBA ")[0]
-        kwargs["dba"] = row["BorrowerName"].upper().split(" DBA ")[1]
+    name, dba = split_dba(row["BorrowerName"].upper())
+    if dba:
+        kwargs["name"] = name
+        kwargs["dba"] = dba
 
     ppp = None
 
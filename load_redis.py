@@ -2,44 +2,26 @@ import json
 import os
 from io import BytesIO
 import gzip
-from random import randint
 from csv import DictReader
 from redis import StrictRedis
 from hashlib import sha256
 from time import time, sleep
 from typer import Typer
-from string import punctuation
 
 import boto3
 
+from src.keylayout import group_layout, object_key
+from src.throttle import AdaptiveLimiter, LimitedClient
+from src.tokenizer import index_tokens
+
 app = Typer()
 
 r = StrictRedis(host=os.environ.get("REDIS_HOST", "localhost"), port=os.environ.get("REDIS_PORT", 6379), db=2)
 
-s3 = boto3.client("s3")
+s3 = LimitedClient(boto3.client("s3"), AdaptiveLimiter(maximum=int(os.getenv("S3_MAX_CONCURRENCY", "128"))))
 s3_bucket = "socialcredit-prod-ohchae7p"
 s3_base_key = "data/words"
-
-
-stop_words = [
-    "THE",
-    "AND",
-    "OF",
-    "TO",
-    "IN",
-    "FOR",
-    "A",
-    "IS",
-    "THAT",
-    "ON",
-    "WITH",
-    "AS",
-    "AT",
-    "BY",
-    "FROM",
-    "BE",
-    "&",
-]
+word_key_layout = group_layout("words", os.getenv("S3_SHARDED_GROUPS"), os.getenv("S3_MIGRATING_GROUPS"))
 
 
 @app.command()
@@ -63,12 +45,8 @@ def processcsv(fn: str):
         # print(f"{idx}: {org}")
         if org is None:
             continue
-        for word in [x for x in org.split() if x not in stop_words]:
-            for p in punctuation:
-                word = word.replace(p, "")
-            if len(word) == 0:
-                continue
-            word = f"word:{word.lower()}"
+        for word in index_tokens(org):
+            word = f"word:{word}"
             # print(f"adding {org} to {word}")
             # add org to word set
             pipeline.sadd(word, org)
@@ -101,7 +79,6 @@ def processcsv(fn: str):
                 print("halt.flg found, halting")
                 break
             count = 0
-            sleep(randint(5, 10))
             start = time()
 
         count += 1
@@ -173,7 +150,7 @@ def loadtos3():
         word = word_key.split(":")[1]
         try:
             data = dict(word=word, organizations=list(data))
-            s3_fn = f"{s3_base_key}/{word}.json.gz"
+            s3_fn = object_key(s3_base_key, word, word_key_layout)
             # gzip the data and send to s3
             buffer = BytesIO()
             with gzip.GzipFile(mode="wb", fileobj=buffer) as f:
@@ -4,16 +4,19 @@ import gzip
 from io import BytesIO
 import json
 import os
-import re
 import sqlite3
-from string import punctuation
 from time import time, sleep
 from typer import Typer
 
 import boto3
+from botocore.config import Config as BotoConfig
 from filelock import FileLock
 from sqlalchemy import create_engine, text
 
+from src.keylayout import group_layout, object_key
+from src.throttle import AdaptiveLimiter, LimitedClient
+from src.tokenizer import index_tokens, tokenize_batch
+
 app = Typer()
 
 conn = sqlite3.connect("tracking.db")
@@ -37,33 +40,19 @@ staging_folder = os.path.join(data_folder, "staging")
 s3_bucket = "socialcredit-prod-ohchae7p"
 s3_base_key = "data/words"
 s3_base_org_key = "data/organizations"
+# the app's key layout of the organizations (see src/keylayout.py), bulk loads are what the sharded layout is for
+org_key_layout = group_layout("organizations", os.getenv("S3_SHARDED_GROUPS"), os.getenv("S3_MIGRATING_GROUPS"))
 
-max_worker_count = os.cpu_count() * 5
-loop_sleep_time = 0
+# uploads are paced by the adaptive concurrency limit (see src/throttle.py), the pool only has to have a thread for
+# every slot it can open
+s3_limiter = AdaptiveLimiter(maximum=int(os.getenv("S3_MAX_CONCURRENCY", "128")))
+s3 = LimitedClient(boto3.client("s3", config=BotoConfig(max_pool_connections=s3_limiter.maximum)), s3_limiter)
+max_worker_count = s3_limiter.maximum
 
 os.makedirs(word_folder, exist_ok=True)
 os.makedirs(batch_folder, exist_ok=True)
 os.makedirs(staging_folder, exist_ok=True)
 
-stop_words = [
-    "the",
-    "and",
-    "of",
-    "to",
-    "in",
-    "for",
-    "a",
-    "is",
-    "that",
-    "on",
-    "with",
-    "as",
-    "at",
-    "by",
-    "from",
-    "be",
-    "&",
-]
 hash_key = "OrganizationName"
 
 # sqlite = sqlite3.connect("tracking.db")
@@ -71,18 +60,15 @@ hash_key = "OrganizationName"
 
 
 def extract_words(text):
-    words = []
-    for word in [x for x in re.findall(r"\w+", text) if x not in stop_words]:
-        words.append("".join([x for x in word if x not in punctuation]))
-    return list(set(words))
+    return index_tokens(text)
 
 
 def write_batch(batch, offset):
     data = []
-    for row in batch:
-        words = extract_words(row["BorrowerName"])
+    names = [row["BorrowerName"] for row in batch]
+    for name, words in zip(names, tokenize_batch(names)):
         for word in words:
-            data.append([word, row["BorrowerName"]])
+            data.append([word, name])
 
     fn = os.path.join(batch_folder, f"{offset}.json")
     with open(fn, "w") as f:
@@ -140,7 +126,7 @@ def write_compress_s3_object(s3, data):
 
     s3.put_object(
         Bucket=s3_bucket,
-        Key=f"{s3_base_org_key}/{prefix}.json.gz",
+        Key=object_key(s3_base_org_key, prefix, org_key_layout),
         Body=buffer.getvalue(),
         ContentEncoding="gzip",
         ContentType="application/json",
@@ -259,19 +245,19 @@ def getorgstats():
 
 
 @app.command()
-def loadorgs(chunk_size: int = 3840, speed_threshold: int = 70, skip_files: str = "", worker_id: int = 0):
+def loadorgs(chunk_size: int = 3840, skip_files: str = "", worker_id: int = 0):
     halt_fn = "halt.flg"
     if os.path.exists(halt_fn):
         print("halt flag found, exiting")
         sleep(100)
         exit(0)
-    print(f"loading orgs with chunksize {chunk_size} and speed threshold {speed_threshold} for worker {worker_id}")
+    print(f"loading orgs with chunksize {chunk_size} for worker {worker_id}")
 
     # check if worker is already assigned a file
     fn = get_worker_fn_from_db(worker_id)
     if fn is not None:
         print(f"worker {worker_id} already assigned {fn} - processing...")
-        process_fn(chunk_size, speed_threshold, fn)
+        process_fn(chunk_size, fn)
     else:
         skip_files = skip_files.split(",")
         for fn in [
@@ -286,18 +272,17 @@ def loadorgs(chunk_size: int = 3840, speed_threshold: int = 70, skip_files: str
                 continue
             print(f"Assigned {fn} to worker {worker_id} - processing...")
             upsert_worker_fn_in_db(worker_id, fn)
-            process_fn(chunk_size, speed_threshold, fn)
+            process_fn(chunk_size, fn)
     sleep(10)
 
 
-def process_fn(chunk_size, speed_threshold, fn):
+def process_fn(chunk_size, fn):
     print("Starting", fn)
     count = 1
     with open(fn, "r") as csvfile:
         reader = csv.DictReader(csvfile)
         start = time()
         rows = []
-        s3 = boto3.client("s3")
         previous_offset = get_offset_from_db(fn)
         for idx, row in enumerate(reader):
             if os.path.exists("stop.flg"):
@@ -316,15 +301,12 @@ def process_fn(chunk_size, speed_threshold, fn):
 
                 duration = time() - start
                 if duration > 0:
-                    print(f"{chunk_size/duration} records/sec - uploaded so far: {idx}")
+                    print(
+                        f"{chunk_size/duration} records/sec at {int(s3_limiter.limit)} concurrent requests"
+                        f" - uploaded so far: {idx}"
+                    )
                     upsert_offset_in_db(fn, idx)
                     previous_offset = idx
-
-                    if chunk_size / duration < speed_threshold:
-                        print("too slow, exiting")
-                        exit(0)
-                    if loop_sleep_time:
-                        sleep(loop_sleep_time)
                     start = time()
                     count = 0
 
@@ -474,7 +456,6 @@ def fixwords(chunk_size: int = 1000, worker_id: int = 0):
     if not target_words:
         print("No words to fix for worker", worker_id)
         exit(0)
-    s3 = boto3.client("s3")
     start = time()
     with engine.connect() as conn:
         for word in target_words:
@@ -35,6 +35,7 @@ from models import (
     OrganizationProfile,
     Organizations,
     Users,
+    UserBitmaps,
     UserProfile,
     Tags,
 )
@@ -49,18 +50,40 @@ def generate_id(length):
 @mod.route("/")
 @requires_login_and_group("Admins")
 def index():
-    users = Users().users()
+    # the user lists come from the flag bitmaps, only the users that are shown get loaded
+    bitmaps = UserBitmaps()
+    if bitmaps.available():
+        admins = bitmaps.get("is_admin")
+        manually_added_users = bitmaps.get("create_method:manual")
+        blocked_users = bitmaps.get("is_blocked")
+        users = Users().get_many(bitmaps.profile_names(admins | manually_added_users | blocked_users))
+
+        def profiles(bitmap):
+            return sorted([users[x] for x in bitmaps.profile_names(bitmap) if x in users], key=lambda x: x.name)
+
+        lists = dict(
+            admins=profiles(admins),
+            antisocial_credit_count=len(bitmaps.get("all") - bitmaps.get("is_premium_user")),
+            manually_added_users=profiles(manually_added_users),
+            blocked_users=profiles(blocked_users),
+        )
+    else:
+        # the bitmaps are not built yet (flask build-user-bitmaps), every user is loaded
+        users = sorted([x for x in Users().users() if x], key=lambda x: x.name)
+        lists = dict(
+            admins=[x for x in users if x.is_admin],
+            antisocial_credit_count=len([x for x in users if x.is_premium_user is False]),
+            manually_added_users=[x for x in users if x.create_method == "manual"],
+            blocked_users=[x for x in users if x.is_blocked is True],
+        )
     tags = Tags().tags()
 
     return render_template(
         "admin/action.html",
-        admins=[x for x in users if x.is_admin],
-        antisocial_credits=[x for x in users if x.is_premium_user is False],
-        manually_added_users=[x for x in users if x.create_method == "manual"],
         organization_count=Organizations().count(),
-        blocked_users=[x for x in users if x.is_blocked is True],
         tags=tags,
         access_tokens=AccessTokens().ls(),
+        **lists,
     )
 
 
@@ -126,31 +149,48 @@ def edit_organization(name: str = None):
     organization = None
     orgs = Organizations()
     if name:
-        organization = orgs().get(name=name)
+        organization = orgs.get(name=name)
     if request.method == "GET" and organization:
         form = AddOrganizationForm(obj=organization)
     else:
         form = AddOrganizationForm()
-    print("organization", organization)
     if form.validate_on_submit():
-        # check to see if organizaiton already exists with this name
+        # check to see if another organization already exists with this name
         existing_organization = orgs.get(name=form.name.data)
-        print("existing_organization", existing_organization, organization)
-        if organization and existing_organization and existing_organization.name == organization.name:
+        if existing_organization and (not organization or existing_organization.name != organization.name):
             form.name.errors.append("Organization with this name already exists")
 
         if not form.name.errors:
+            previous_name = None
             if organization:
-                print("updating organization")
+                # a rename moves the org's postings to the new name and deletes the old org
+                previous_name = organization.name
                 organization.name = form.name.data
             else:
-                print("creating organization")
                 organization = OrganizationProfile(name=form.name.data)
-            orgs.update(organization)
-        return redirect(url_for("admin.index"))
+            orgs.update(organization, previous_name=previous_name)
+            return redirect(url_for("admin.index"))
     return render_template("admin/update.html", form=form, update_type="Organization")
 
 
+# delete an organization
+@mod.route("/organization/delete/<string:name>", methods=["GET", "POST"])
+@requires_login_and_group("Admins")
+def delete_organization(name: str):
+    orgs = Organizations()
+    organization = orgs.get(name=name)
+    if not organization:
+        return redirect(url_for("admin.index"))
+
+    form = DeleteUserForm()
+
+    if form.validate_on_submit():
+        if form.confirm.data == "DELETE":
+            orgs.delete(organization.name)
+            return redirect(url_for("admin.index"))
+    return render_template("admin/delete_organization.html", form=form, organization=organization)
+
+
 # add a blocked user
 @mod.route("/blockeduser", methods=["GET", "POST"])
 @requires_login_and_group("Admins")
@@ -291,8 +331,7 @@ def add_tag():
         tag = tags.get(name=form.name.data)
         if not tag:
             name = form.name.data
-            tag_data = dict(name=name, profiles=[], description=form.description.data)
-            tags.update(name=name, data=tag_data)
+            tags.add(name, description=form.description.data)
         return redirect(url_for("admin.index"))
     return render_template("admin/update.html", form=form, update_type="Tag")
 
@@ -305,7 +344,7 @@ def delete_tag(name):
     tag = tags.get(name=name)
     if not tag:
         return redirect(url_for("admin.index"))
-    if "profiles" in tag and tag["profiles"]:
+    if tags.profile_count(name):
         return render_template("error.html", message="Cannot delete tag with profiles")
     tags.rm(name=name)
     return redirect(url_for("admin.index"))
@@ -319,10 +358,12 @@ def delete_tag_all(name):
     tag = tags.get(name=name)
     if not tag:
         return redirect(url_for("admin.index"))
-    for user in Users().users():
-        if tag in user.tags:
-            user.tags.remove(tag)
-            Users().update(user)
+    # only the users in the tag's posting are loaded
+    users = Users()
+    for user in users.get_many(tags.postings(name).all()).values():
+        if name in user.tags:
+            user.tags.remove(name)
+            users.update(user)
 
     return redirect(url_for("admin.index"))
 
@@ -335,14 +376,24 @@ def show_tag(name):
     if not tag:
         return redirect(url_for("admin.index"))
 
-    users = Users()
-    users_with_tag = []
-    for profile_name in tag.get("profiles", []):
-        profile = users.get(name=profile_name)
-        if profile:
-            users_with_tag.append(profile)
-    users_with_tag.sort(key=lambda x: x.name)
+    # the posting is sorted, so only the users of the requested page are loaded
+    page = request.args.get("page", 1, type=int)
+    per_page = request.args.get("per_page", config.DEFAULT_PER_PAGE, type=int)
+    postings = Tags().postings(name)
+    names = postings.range((page - 1) * per_page, per_page)
+    users = Users().get_many(names, timeout=config.SEARCH_FETCH_TIMEOUT)
+    users_with_tag = [users[x] for x in names if x in users]
+    prev_url = url_for("admin.show_tag", name=name, page=page - 1, per_page=per_page) if page > 1 else None
+    next_url = None
+    if page * per_page < postings.count():
+        next_url = url_for("admin.show_tag", name=name, page=page + 1, per_page=per_page)
 
     return render_template(
-        "admin/show_profiles.html", tag=tag, profiles=users_with_tag, data_type="users", data_target="tag " + name
+        "admin/show_profiles.html",
+        tag=tag,
+        profiles=users_with_tag,
+        data_type="users",
+        data_target="tag " + name,
+        prev_url=prev_url,
+        next_url=next_url,
     )
@@ -22,6 +22,8 @@ from models import (
     Organizations,
 )
 from auth.utils import jwt_has_access
+from suggest import suggest_index
+from query import QueryError, plan
 
 mod = Blueprint("api", __name__, url_prefix="/api")
 
@@ -57,6 +59,51 @@ def protected_read():
     return jsonify(dict(name=config.APP_NAME, access="read"))
 
 
+# typeahead completions for a partial search term
+@mod.route("/search/suggest")
+@jwt_has_access("read")
+def search_suggest():
+    return jsonify(suggestions(request.args.get("q", ""), request.args.get("k", config.SUGGEST_COUNT, type=int)))
+
+
+# organization search with the field scoped query language, e.g. ?q=state:TX tag:ppp rating>100000 roofing
+@mod.route("/search/organizations")
+@jwt_has_access("read")
+def search_organizations():
+    q = request.args.get("q", "")
+    page = request.args.get("page", 1, type=int)
+    per_page = min(request.args.get("per_page", config.DEFAULT_PER_PAGE, type=int), 1000)
+    try:
+        query_plan = plan(q)
+        if query_plan.is_paged():
+            organizations, total = query_plan.page(page, per_page)
+        else:
+            organizations = sorted(query_plan.execute(), key=lambda x: x.lower())
+            total = len(organizations)
+            organizations = organizations[(page - 1) * per_page : page * per_page]
+    except QueryError as e:
+        return jsonify(dict(q=q, status="error", message=str(e))), 400
+    return jsonify(
+        dict(
+            q=q,
+            total=total,
+            page=page,
+            per_page=per_page,
+            organizations=organizations,
+            plan=query_plan.describe(),
+        )
+    )
+
+
+def suggestions(q: str, k: int) -> dict:
+    index = suggest_index()
+    # only the last term of the query is completed
+    terms = q.split(" ")
+    if index is None or not terms[-1]:
+        return dict(q=q, suggestions=[])
+    return dict(q=q, suggestions=index.suggest(terms[-1], k=min(k, 50)))
+
+
 # # route to insert and organization
 # @csrf.exempt
 # @mod.route("/organization", methods=["POST"])
@@ -89,6 +89,8 @@ app.register_blueprint(adminmod)
 app.register_blueprint(authmod)
 app.register_blueprint(apimod)
 
+import commands  # registers the flask cli commands
+
 
 @jwt.expired_token_loader
 def expired_token_callback(jwt_header, jwt_payload):
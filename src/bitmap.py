@@ -0,0 +1,137 @@
+from base64 import b64decode, b64encode
+from bisect import bisect_left
+
+# roaring style compressed bitmap over 32 bit doc ids
+# ids are split into a 16 bit high part that selects a container and a 16 bit low part stored in it;
+# sparse containers are sorted lists of low parts, dense ones (more than ARRAY_LIMIT ids) are 65536 bit
+# python ints so and/or/count run on whole machine words
+
+ARRAY_LIMIT = 4096
+CONTAINER_BITS = 1 << 16
+
+
+def _to_int(container) -> int:
+    if isinstance(container, int):
+        return container
+    bits = 0
+    for low in container:
+        bits |= 1 << low
+    return bits
+
+
+def _to_list(bits: int) -> list[int]:
+    lows = []
+    for idx, byte in enumerate(bits.to_bytes(CONTAINER_BITS // 8, "little")):
+        while byte:
+            low = byte & -byte
+            lows.append(idx * 8 + low.bit_length() - 1)
+            byte ^= low
+    return lows
+
+
+def _normalize(bits: int):
+    # picks the smaller representation for a container, None when it is empty
+    count = bits.bit_count()
+    if count == 0:
+        return None
+    if count <= ARRAY_LIMIT:
+        return _to_list(bits)
+    return bits
+
+
+class Bitmap:
+    def __init__(self, ids=None):
+        self.containers = {}
+        for doc_id in ids or []:
+            self.add(doc_id)
+
+    def add(self, doc_id: int) -> bool:
+        high, low = doc_id >> 16, doc_id & 0xFFFF
+        container = self.containers.setdefault(high, [])
+        if isinstance(container, int):
+            if container >> low & 1:
+                return False
+            self.containers[high] = container | 1 << low
+            return True
+        idx = bisect_left(container, low)
+        if idx < len(container) and container[idx] == low:
+            return False
+        container.insert(idx, low)
+        if len(container) > ARRAY_LIMIT:
+            self.containers[high] = _to_int(container)
+        return True
+
+    def discard(self, doc_id: int) -> bool:
+        high, low = doc_id >> 16, doc_id & 0xFFFF
+        container = self.containers.get(high)
+        if container is None or doc_id not in self:
+            return False
+        if isinstance(container, int):
+            container = _normalize(container & ~(1 << low))
+        else:
+            container.remove(low)
+            container = container or None
+        if container is None:
+            del self.containers[high]
+        else:
+            self.containers[high] = container
+        return True
+
+    def __contains__(self, doc_id: int) -> bool:
+        container = self.containers.get(doc_id >> 16)
+        if container is None:
+            return False
+        low = doc_id & 0xFFFF
+        if isinstance(container, int):
+            return bool(container >> low & 1)
+        idx = bisect_left(container, low)
+        return idx < len(container) and container[idx] == low
+
+    def __len__(self) -> int:
+        return sum([x.bit_count() if isinstance(x, int) else len(x) for x in self.containers.values()])
+
+    def __iter__(self):
+        for high in sorted(self.containers):
+            container = self.containers[high]
+            for low in container if isinstance(container, list) else _to_list(container):
+                yield high << 16 | low
+
+    def _combine(self, other: "Bitmap", op, highs) -> "Bitmap":
+        result = Bitmap()
+        for high in highs:
+            container = _normalize(
+                op(_to_int(self.containers.get(high, [])), _to_int(other.containers.get(high, [])))
+            )
+            if container is not None:
+                result.containers[high] = container
+        return result
+
+    def __and__(self, other: "Bitmap") -> "Bitmap":
+        return self._combine(other, lambda a, b: a & b, self.containers.keys() & other.containers.keys())
+
+    def __or__(self, other: "Bitmap") -> "Bitmap":
+        return self._combine(other, lambda a, b: a | b, self.containers.keys() | other.containers.keys())
+
+    def __sub__(self, other: "Bitmap") -> "Bitmap":
+        return self._combine(other, lambda a, b: a & ~b, self.containers.keys())
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Bitmap) and self.containers == other.containers
+
+    def dump(self) -> dict:
+        # json friendly form, dense containers are base64 encoded little endian bit strings
+        return {
+            str(high): container
+            if isinstance(container, list)
+            else b64encode(container.to_bytes(CONTAINER_BITS // 8, "little")).decode("ascii")
+            for high, container in self.containers.items()
+        }
+
+    @classmethod
+    def load(cls, data: dict) -> "Bitmap":
+        bitmap = cls()
+        for high, container in (data or {}).items():
+            if isinstance(container, str):
+                container = int.from_bytes(b64decode(container), "little")
+            bitmap.containers[int(high)] = container
+        return bitmap
@@ -0,0 +1,342 @@
+# offline index maintenance commands, run with `flask <command>` so the DAO has an app context
+import csv
+import os
+from functools import partial
+from multiprocessing import Pool
+
+import click
+
+from app import app, config
+from keylayout import FLAT, MIGRATING, SHARDED
+from models import (
+    DAO,
+    Locations,
+    Organizations,
+    PPPOrganizationProfile,
+    Phonetics,
+    Sketches,
+    Tags,
+    UserBitmaps,
+    Users,
+    Words,
+    fetch_parallel,
+    is_segmented,
+    location_keys,
+    rating_impact,
+    set_impact,
+    user_bitmap_keys,
+)
+from ranking import name_tokens
+from suggest import build_suggest_index, suggest_index
+from fuzzy import build_fuzzy_index
+from phonetic import phonetic_entries
+from sketch import build_sketch
+from tokenizer import STOP_WORDS
+
+
+def chunks(items: list, size: int):
+    for idx in range(0, len(items), size):
+        yield items[idx : idx + size]
+
+
+@app.cli.command("build-suggest-index")
+@click.option("--chunk-size", default=1000, help="number of word postings fetched per parallel batch")
+@click.option("--output", default=None, help="index file to write, defaults to SUGGEST_INDEX_FILE")
+def build_suggest_index_command(chunk_size: int, output: str):
+    # builds the typeahead index from the words group and the usernames
+    words = Words()
+    entries = []
+    names = words.ls()
+    click.echo(f"loading {len(names)} words")
+    for idx, chunk in enumerate(chunks(names, chunk_size)):
+        for word, data in fetch_parallel(words.get, chunk).items():
+            if data:
+                entries.append((word, len(data.get("organizations", [])), "word"))
+        click.echo(f"{min((idx + 1) * chunk_size, len(names))}/{len(names)} words loaded")
+    for name in Users().ls():
+        entries.append((name, 1, "user"))
+    count = build_suggest_index(entries, output or config.SUGGEST_INDEX_FILE)
+    click.echo(f"wrote {count} terms to {output or config.SUGGEST_INDEX_FILE}")
+
+
+@app.cli.command("build-fuzzy-index")
+@click.option("--max-distance", default=1, help="largest edit distance the index can answer")
+@click.option("--output", default=None, help="index file to write, defaults to FUZZY_INDEX_FILE")
+def build_fuzzy_index_command(max_distance: int, output: str):
+    # builds the typo tolerant word lookup from the vocabulary of the suggest index, run build-suggest-index first
+    index = suggest_index()
+    if index is None:
+        raise click.ClickException(f"{config.SUGGEST_INDEX_FILE} not found, run build-suggest-index first")
+    count = build_fuzzy_index(index, output or config.FUZZY_INDEX_FILE, max_distance=max_distance)
+    click.echo(f"wrote {count} deletes to {output or config.FUZZY_INDEX_FILE}")
+
+
+@app.cli.command("update-search-stats")
+def update_search_stats_command():
+    # stores the collection statistics used by ranked search in the words metadata
+    names = Organizations().ls()
+    token_count = sum([len(name_tokens(x)) for x in names])
+    avg_name_length = token_count / len(names) if names else 0
+    Words().dao.update_metadata_key("avg_name_length", avg_name_length)
+    click.echo(f"{len(names)} organizations, average name length {avg_name_length:.2f} tokens")
+
+
+@app.cli.command("build-rating-impacts")
+@click.option("--csv-folder", default="data/ppp", help="folder of PPP csv files to read forgiveness amounts from")
+@click.option("--chunk-size", default=1000, help="number of word postings updated per parallel batch")
+def build_rating_impacts_command(csv_folder: str, chunk_size: int):
+    # adds impacts to word postings loaded in bulk, Organizations.update keeps them current afterwards
+    impacts = dict()
+    for fn in [os.path.join(csv_folder, x) for x in sorted(os.listdir(csv_folder)) if x.endswith(".csv")]:
+        with open(fn, "r") as f:
+            for row in csv.DictReader(f):
+                try:
+                    rating = int(float(row.get("ForgivenessAmount") or 0))
+                except ValueError:
+                    rating = 0
+                impacts[row.get("BorrowerName")] = rating_impact(rating)
+        click.echo(f"{fn}: {len(impacts)} organizations")
+
+    words = Words()
+
+    def update_word(word: str):
+        word_data = words.get(word)
+        if not word_data:
+            return False
+        changed = [
+            set_impact(word_data, name, impacts[name]) for name in word_data.get("organizations", []) if name in impacts
+        ]
+        if any(changed):
+            words.update(word, word_data)
+        return any(changed)
+
+    names = words.ls()
+    updated = 0
+    for idx, chunk in enumerate(chunks(names, chunk_size)):
+        updated += sum(fetch_parallel(update_word, chunk).values())
+        click.echo(f"{min((idx + 1) * chunk_size, len(names))}/{len(names)} words, {updated} updated")
+
+
+@app.cli.command("build-location-index")
+@click.option("--csv-folder", default="data/ppp", help="folder of PPP csv files to index")
+def build_location_index_command(csv_folder: str):
+    # builds the state, city and zip postings from the PPP csvs, Organizations.update maintains them afterwards
+    locations = Locations()
+
+    def merge(key: str, names: set):
+        data = locations.get(key) or dict(key=key, organizations=[])
+        added = names - set(data["organizations"])
+        if added:
+            data["organizations"].extend(sorted(added))
+            locations.update(key, data)
+        return len(added)
+
+    for fn in [os.path.join(csv_folder, x) for x in sorted(os.listdir(csv_folder)) if x.endswith(".csv")]:
+        postings = dict()
+        with open(fn, "r") as f:
+            for row in csv.DictReader(f):
+                for key in location_keys(PPPOrganizationProfile(row)):
+                    postings.setdefault(key, set()).add(row.get("BorrowerName"))
+        added = sum(fetch_parallel(lambda x: merge(x, postings[x]), list(postings.keys())).values())
+        click.echo(f"{fn}: {len(postings)} locations, {added} entries added")
+
+
+@app.cli.command("build-user-bitmaps")
+def build_user_bitmaps_command():
+    # builds the user flag and tag bitmaps from every stored user, they are maintained on write afterwards (see
+    # models.UserBitmaps). users saved while this runs are picked up by the next run
+    bitmaps = UserBitmaps()
+    bitmaps.set_data(dict(names=[], bitmaps={}))
+    for profile in Users().users():
+        if profile:
+            bitmaps.set_keys(bitmaps.doc_id(profile.name), user_bitmap_keys(profile))
+    bitmaps.dao.put(bitmaps.name, bitmaps.data())
+    click.echo(f"{bitmaps.count('all')} users, {len(bitmaps.bitmaps)} bitmaps")
+
+
+@app.cli.command("build-tag-postings")
+@click.option("--csv-folder", default="data/ppp", help="folder of PPP csv files, every PPP borrower is tagged ppp")
+def build_tag_postings_command(csv_folder: str):
+    # rebuilds the segmented tag postings from the stored users and the PPP csvs, this also moves tags from before
+    # the postings were segmented over
+    tags = Tags()
+    postings = dict()
+    for user in Users().users():
+        for tag in user.tags:
+            postings.setdefault(("user", tag), set()).add(user.name)
+    for fn in [os.path.join(csv_folder, x) for x in sorted(os.listdir(csv_folder)) if x.endswith(".csv")]:
+        with open(fn, "r") as f:
+            for row in csv.DictReader(f):
+                profile = PPPOrganizationProfile(row)
+                for tag in profile.tags:
+                    postings.setdefault(("organization", tag), set()).add(profile.name)
+    for (profile_type, tag), names in postings.items():
+        tags.add(tag)
+        count = tags.postings(tag, profile_type).replace(names)
+        click.echo(f"{profile_type}:{tag}: {count} profiles")
+
+
+@app.cli.command("build-phonetic-index")
+@click.option("--csv-folder", default="data/ppp", help="folder of PPP csv files whose borrower names are indexed")
+@click.option("--processes", default=None, type=int, help="worker processes, defaults to the cpu count")
+@click.option("--chunk-size", default=10000, help="names per worker task")
+def build_phonetic_index_command(csv_folder: str, processes: int, chunk_size: int):
+    # rebuilds the phonetic postings from the PPP borrower names and the usernames, keys are computed in a
+    # process pool and the postings written in parallel; Organizations.update and Users.update maintain them
+    words = dict()
+    with Pool(processes) as pool:
+        for fn in [os.path.join(csv_folder, x) for x in sorted(os.listdir(csv_folder)) if x.endswith(".csv")]:
+            with open(fn, "r") as f:
+                names = [row.get("BorrowerName") or "" for row in csv.DictReader(f)]
+            tasks = pool.imap_unordered(partial(phonetic_entries, exclude=STOP_WORDS), chunks(names, chunk_size))
+            for entries in tasks:
+                for key, found in entries.items():
+                    words.setdefault(key, set()).update(found)
+            click.echo(f"{fn}: {len(names)} names, {len(words)} keys so far")
+    users = phonetic_entries(Users().ls(), by_name=True, exclude=STOP_WORDS)
+
+    phonetics = Phonetics()
+    keys = sorted(set(words.keys()) | set(users.keys()))
+    for chunk in chunks(keys, 1000):
+        fetch_parallel(
+            lambda x: phonetics.update(
+                x, dict(key=x, words=sorted(words.get(x, [])), users=sorted(users.get(x, [])))
+            ),
+            chunk,
+        )
+    click.echo(f"{len(keys)} phonetic keys, {sum([len(x) for x in words.values()])} word entries")
+
+
+@app.cli.command("build-sketches")
+@click.option("--chunk-size", default=1000, help="number of word postings sketched per parallel batch")
+def build_sketches_command(chunk_size: int):
+    # sketches every word posting for the estimated search counts, Organizations.update maintains them
+    words = Words()
+    sketches = Sketches()
+
+    def sketch_word(word: str) -> bool:
+        data = words.get(word)
+        if not data:
+            return False
+        sketches.update(word, dict(word=word, **build_sketch(data.get("organizations", []), config.SKETCH_SIZE)))
+        return True
+
+    names = words.ls()
+    built = 0
+    for idx, chunk in enumerate(chunks(names, chunk_size)):
+        built += sum(fetch_parallel(sketch_word, chunk).values())
+        click.echo(f"{min((idx + 1) * chunk_size, len(names))}/{len(names)} words, {built} sketched")
+
+
+@app.cli.command("compact-postings")
+@click.option("--chunk-size", default=1000, help="number of postings compacted per parallel batch")
+def compact_postings_command(chunk_size: int):
+    # background compaction of the word and location postings, run periodically (make compact) and never twice
+    # at once: the deltas appended by the write path are folded into the base postings (see models.PostingLog)
+    # and word postings that outgrew WORD_SEGMENT_THRESHOLD are split into segments (see models.Words),
+    # then names of orgs that no longer exist are purged - Organizations.update and delete keep the postings tight,
+    # this catches what they missed (failed writes, orgs removed outside the app). emptied postings are deleted
+    # and the sketches of changed word postings rebuilt
+    organizations = set(Organizations().ls())
+    orgs_dao = Organizations().dao
+    sketches = Sketches()
+    threshold = config.WORD_SEGMENT_THRESHOLD
+
+    def sketch(group, name: str):
+        if isinstance(group, Words):
+            data = group.get(name)
+            if data:
+                sketches.dao.put(name, dict(word=name, **build_sketch(data["organizations"], config.SKETCH_SIZE)))
+            else:
+                sketches.dao.delete(name)
+
+    def fold(group, pending: dict, name: str) -> bool:
+        if not group.log.compact(name, pending[name]):
+            return False
+        sketch(group, name)
+        return True
+
+    def purge(group, name: str) -> int:
+        data = group.get(name)
+        if not data:
+            return 0
+        if isinstance(group, Words) and not is_segmented(data) and len(data["organizations"]) > threshold:
+            # loaded in bulk or never compacted since it grew
+            group.save(name, data)
+        candidates = set([x for x in data.get("organizations", []) if x not in organizations])
+        # orgs created since the listing are still there
+        dangling = set([x for x in candidates if orgs_dao.get(x) is None])
+        if not dangling:
+            return 0
+        # removed like the write path does it and folded right away, segmented postings rewrite only their
+        # affected segments
+        group.log.append(name, removes=sorted(dangling))
+        group.log.compact(name)
+        sketch(group, name)
+        return len(dangling)
+
+    for group in [Words(), Locations()]:
+        pending = group.log.pending()
+        names = list(pending.keys())
+        folded = 0
+        for idx, chunk in enumerate(chunks(names, chunk_size)):
+            folded += sum(fetch_parallel(partial(fold, group, pending), chunk).values())
+            done = min((idx + 1) * chunk_size, len(names))
+            click.echo(f"{done}/{len(names)} {group.dao.object_group} with deltas, {folded} folded")
+
+        names = group.ls()
+        purged = 0
+        for idx, chunk in enumerate(chunks(names, chunk_size)):
+            purged += sum(fetch_parallel(partial(purge, group), chunk).values())
+            done = min((idx + 1) * chunk_size, len(names))
+            click.echo(f"{done}/{len(names)} {group.dao.object_group}, {purged} purged")
+        group.dao.update_metadata_key("count", len(group.dao.ls()))
+    sketches.dao.update_metadata_key("count", len(sketches.dao.ls()))
+
+
+@app.cli.command("compact-profiles")
+@click.option("--chunk-size", default=1000, help="number of profiles compacted per parallel batch")
+def compact_profiles_command(chunk_size: int):
+    # background compaction of the user and organization profiles, run periodically (make compact) next to
+    # compact-postings: the patches edits appended are folded into the base snapshots (see models.PatchedDAO) and
+    # the change event objects saves appended are folded into segments (see models.ChangeEvents)
+    for group in [Users(), Organizations()]:
+        pending = group.dao.pending()
+        names = list(pending.keys())
+        folded = 0
+        for idx, chunk in enumerate(chunks(names, chunk_size)):
+            folded += sum(fetch_parallel(group.dao.compact, chunk).values())
+            done = min((idx + 1) * chunk_size, len(names))
+            click.echo(f"{done}/{len(names)} {group.dao.object_group} with patches, {folded} folded")
+
+        names = group.events.pending()
+        folded = 0
+        for idx, chunk in enumerate(chunks(names, chunk_size)):
+            folded += sum(fetch_parallel(group.events.compact, chunk).values())
+            done = min((idx + 1) * chunk_size, len(names))
+            click.echo(f"{done}/{len(names)} {group.events.dao.object_group} logs, {folded} compacted")
+
+
+@app.cli.command("migrate-keys")
+@click.argument("groups", nargs=-1, required=True)
+@click.option("--cleanup", is_flag=True, help="also delete the flat objects, once the groups are S3_SHARDED_GROUPS")
+@click.option("--chunk-size", default=1000, help="number of objects copied per parallel batch")
+def migrate_keys_command(groups: tuple, cleanup: bool, chunk_size: int):
+    # online move of groups to the sharded key layout (see keylayout.py), while the app keeps serving them:
+    # 1. add the groups to S3_MIGRATING_GROUPS and roll that out - writes go to the sharded keys, reads try the
+    #    sharded key first and fall back to the flat one
+    # 2. migrate-keys GROUP... copies every flat object without a sharded copy, never over one a writer created
+    # 3. move the groups to S3_SHARDED_GROUPS, roll that out and run migrate-keys --cleanup GROUP... to copy what
+    #    is left and delete the flat objects
+    for group in groups:
+        dao = DAO(group)
+        layout = dao.layout()
+        if layout == FLAT or (layout == MIGRATING) == cleanup:
+            expected = SHARDED if cleanup else MIGRATING
+            click.echo(f"{group} is {layout}, {'cleanup' if cleanup else 'copying'} needs it to be {expected}")
+            continue
+        names = [dao.name_of(x["Key"]) for x in dao.list_keys(f"{dao.root}/") or []]
+        done = 0
+        for idx, chunk in enumerate(chunks(names, chunk_size)):
+            done += sum(fetch_parallel(partial(dao.migrate, cleanup=cleanup), chunk).values())
+            click.echo(f"{min((idx + 1) * chunk_size, len(names))}/{len(names)} {group}, {done} migrated")
@@ -27,14 +27,48 @@ class Config(BaseModel):
     METADATA_SOURCE_FOLDER: str = os.getenv(
         "METADATA_SOURCE_FOLDER", os.path.join(os.path.dirname(__file__), "metadata")
     )
+    IO_THREAD_COUNT: int = int(os.getenv("IO_THREAD_COUNT", "32"))
+    SEARCH_FETCH_TIMEOUT: float = float(os.getenv("SEARCH_FETCH_TIMEOUT", "10.0"))
+    SEARCH_FILTER_LIMIT: int = int(os.getenv("SEARCH_FILTER_LIMIT", "1000"))
+    SEARCH_BUDGET: float = float(os.getenv("SEARCH_BUDGET", "5.0"))
+    S3_CONNECT_TIMEOUT: float = float(os.getenv("S3_CONNECT_TIMEOUT", "2.0"))
+    S3_READ_TIMEOUT: float = float(os.getenv("S3_READ_TIMEOUT", "10.0"))
+    S3_MAX_CONCURRENCY: int = int(os.getenv("S3_MAX_CONCURRENCY", "128"))
+    S3_LATENCY_TARGET: float = float(os.getenv("S3_LATENCY_TARGET", "2.0"))
+    # comma separated groups whose gets are hedged ("*" for every group) and the share of gets that may be hedged
+    S3_HEDGE_GROUPS: str = os.getenv("S3_HEDGE_GROUPS", "")
+    S3_HEDGE_BUDGET: float = float(os.getenv("S3_HEDGE_BUDGET", "0.05"))
+    SEARCH_HYDRATE_TIMEOUT: float = float(os.getenv("SEARCH_HYDRATE_TIMEOUT", "1.0"))
     CACHE_FOLDER = os.getenv("CACHE_FOLDER", os.path.join(os.path.dirname(__file__), "cache"))
+    INDEX_FOLDER: str = os.getenv("INDEX_FOLDER", os.path.join(os.path.dirname(__file__), "indexes"))
+    SUGGEST_INDEX_FILE: str = os.getenv(
+        "SUGGEST_INDEX_FILE", os.path.join(os.path.dirname(__file__), "indexes", "suggest.idx")
+    )
+    FUZZY_INDEX_FILE: str = os.getenv(
+        "FUZZY_INDEX_FILE", os.path.join(os.path.dirname(__file__), "indexes", "fuzzy.idx")
+    )
+    FUZZY_MAX_CANDIDATES: int = int(os.getenv("FUZZY_MAX_CANDIDATES", "5"))
+    SEARCH_MIN_SHOULD_MATCH: str = os.getenv("SEARCH_MIN_SHOULD_MATCH", "75%")
+    SUGGEST_COUNT: int = int(os.getenv("SUGGEST_COUNT", "10"))
+    SKETCH_SIZE: int = int(os.getenv("SKETCH_SIZE", "512"))
+    POSTING_SEGMENT_SIZE: int = int(os.getenv("POSTING_SEGMENT_SIZE", "5000"))
+    WORD_SEGMENT_THRESHOLD: int = int(os.getenv("WORD_SEGMENT_THRESHOLD", "20000"))
+    IMPACT_HEAD: int = int(os.getenv("IMPACT_HEAD", "1000"))
+    INDEX_DELTA_LISTING_TTL: float = float(os.getenv("INDEX_DELTA_LISTING_TTL", "5.0"))
+    WRITE_CONFLICT_RETRIES: int = int(os.getenv("WRITE_CONFLICT_RETRIES", "5"))
+    WRITE_CONFLICT_BACKOFF: float = float(os.getenv("WRITE_CONFLICT_BACKOFF", "0.05"))
+    CHANGE_EVENT_PAGE: int = int(os.getenv("CHANGE_EVENT_PAGE", "20"))
+    CHANGE_EVENT_SEGMENT_SIZE: int = int(os.getenv("CHANGE_EVENT_SEGMENT_SIZE", "500"))
+    # comma separated groups stored under hash shard prefixes and groups being moved there (see keylayout.py)
+    S3_SHARDED_GROUPS: str = os.getenv("S3_SHARDED_GROUPS", "")
+    S3_MIGRATING_GROUPS: str = os.getenv("S3_MIGRATING_GROUPS", "")
 
 
 config = Config()
 
 print("S3 bucket: ", config.AWS_S3_BUCKET_NAME)
 
-for key in ["NEGATIVE_USER_SAVE_FOLDER", "STATIC_FOLDER", "METADATA_SOURCE_FOLDER", "CACHE_FOLDER"]:
+for key in ["NEGATIVE_USER_SAVE_FOLDER", "STATIC_FOLDER", "METADATA_SOURCE_FOLDER", "CACHE_FOLDER", "INDEX_FOLDER"]:
     if not os.path.exists(getattr(config, key)):
         os.makedirs(getattr(config, key))
 
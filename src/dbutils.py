@@ -7,6 +7,8 @@ from redis import StrictRedis
 from itertools import zip_longest
 import arrow
 
+from tokenizer import STOP_WORDS, index_tokens
+
 
 class WordOrganizationIndexer:
     def __init__(self):
@@ -65,13 +67,8 @@ class WordOrganizationIndexer:
         json.dump(self.redis.hgetall("word_org_index"), open(self.word_org_index_fn, "w"))
 
     def get_org_words(self, name, dba, existing_words=[]):
-        words = [x.lower().strip() for x in set(name.split(" ") + dba.split(" "))]
-        words = [x for x in words if x and x not in self.stop_words and len(x) > 1 and x not in existing_words]
-        replace_chars = [".", ",", ";", ":", "!", "?", "(", ")", "-", "_", "/", "\\", "'", '"']
-        for char in replace_chars:
-            words = [x.replace(char, "") for x in words]
-
-        return words
+        words = index_tokens(f"{name} {dba}", STOP_WORDS | set(self.stop_words))
+        return [x for x in words if len(x) > 1 and x not in existing_words]
 
     def extract_word_org_index(self):
         print(f"Extracting word-org index from files in {self.org_name_csv_folder}...")
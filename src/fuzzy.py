@@ -0,0 +1,129 @@
+import mmap
+import os
+import struct
+from bisect import bisect_left
+from zlib import crc32
+
+from suggest import SuggestIndex, suggest_index
+
+# symspell style deletion dictionary over the word vocabulary of the suggest index
+# every word is truncated to PREFIX_LENGTH characters and all strings reachable by deleting up to
+# max_distance characters are hashed; entries are uint64 (hash << 32 | suggest entry index) sorted so a
+# query only needs to generate its own deletes and binary search each hash. hash collisions are harmless
+# because every candidate is verified with a real edit distance before it is returned.
+#
+# fuzzy index file layout (little endian):
+#   header      magic, entry count, max distance, prefix length, suggest index term count
+#   entries     uint64 * count
+
+MAGIC = b"FZY1"
+HEADER = struct.Struct("<4sIIII")
+PREFIX_LENGTH = 7
+
+
+def deletes(word: str, max_distance: int) -> set[str]:
+    results = {word}
+    edges = {word}
+    for _ in range(max_distance):
+        next_edges = set()
+        for edge in edges:
+            for idx in range(len(edge)):
+                next_edges.add(edge[:idx] + edge[idx + 1 :])
+        next_edges -= results
+        results |= next_edges
+        edges = next_edges
+    return results
+
+
+def term_hash(term: str) -> int:
+    return crc32(term.encode("utf-8"))
+
+
+def edit_distance(a: str, b: str, max_distance: int) -> int:
+    # optimal string alignment distance, returns max_distance + 1 as soon as it is exceeded
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous2 = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous2, previous = previous, current
+    return previous[-1]
+
+
+def build_fuzzy_index(index: SuggestIndex, fn: str, max_distance: int = 1):
+    entries = []
+    for idx in range(len(index)):
+        if index.kind(idx) != "word":
+            continue
+        for delete in deletes(index.term(idx)[:PREFIX_LENGTH], max_distance):
+            entries.append(term_hash(delete) << 32 | idx)
+    entries.sort()
+
+    tmp_fn = f"{fn}.tmp"
+    with open(tmp_fn, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(entries), max_distance, PREFIX_LENGTH, len(index)))
+        for start in range(0, len(entries), 100000):
+            chunk = entries[start : start + 100000]
+            f.write(struct.pack(f"<{len(chunk)}Q", *chunk))
+    os.replace(tmp_fn, fn)
+    return len(entries)
+
+
+class FuzzyIndex:
+    def __init__(self, fn: str, index: SuggestIndex):
+        self.fn = fn
+        self.index = index
+        with open(fn, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, self.max_distance, self.prefix_length, term_count = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise Exception(f"{fn} is not a fuzzy index")
+        if term_count != len(index):
+            raise Exception(f"{fn} was built from a different suggest index, rebuild it")
+        self.entries = memoryview(self.mm)[HEADER.size : HEADER.size + 8 * self.count].cast("Q")
+
+    def lookup(self, term: str, max_distance: int = None, limit: int = None) -> list[dict]:
+        # returns the indexed words within max_distance edits of term, closest and most frequent first
+        term = term.lower().strip()
+        max_distance = self.max_distance if max_distance is None else min(max_distance, self.max_distance)
+        candidates = set()
+        for delete in deletes(term[: self.prefix_length], max_distance):
+            h = term_hash(delete) << 32
+            idx = bisect_left(self.entries, h)
+            while idx < self.count and self.entries[idx] >> 32 == h >> 32:
+                candidates.add(self.entries[idx] & 0xFFFFFFFF)
+                idx += 1
+
+        results = []
+        for candidate in candidates:
+            word = self.index.term(candidate)
+            distance = edit_distance(term, word, max_distance)
+            if distance <= max_distance:
+                results.append(dict(term=word, distance=distance, df=self.index.df(candidate)))
+        results.sort(key=lambda x: (x["distance"], -x["df"], x["term"]))
+        return results[:limit] if limit else results
+
+
+_fuzzy_index = None
+
+
+def fuzzy_index(fn: str = None):
+    # loaded once per worker process; returns None until both indexes have been built
+    global _fuzzy_index
+    if _fuzzy_index is None:
+        from config import config
+
+        fn = fn or config.FUZZY_INDEX_FILE
+        index = suggest_index()
+        if index is None or not os.path.exists(fn):
+            return None
+        _fuzzy_index = FuzzyIndex(fn, index)
+    return _fuzzy_index
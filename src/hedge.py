@@ -0,0 +1,97 @@
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+import threading
+from time import monotonic
+
+# hedged requests: a request that has not answered by the rolling p95 latency of its kind is sent a second time
+# and the first answer wins, so one slow s3 GET does not hold a page at the p99. hedges are paid for from a budget
+# that every request adds a fraction of a hedge to, which keeps the extra requests at about that fraction even
+# when s3 is slow across the board and every request would be past the p95
+
+
+class LatencyTracker:
+    # the quantile of the last size latencies, recomputed every refresh samples and None until min_samples
+    def __init__(self, size: int = 1000, quantile: float = 0.95, min_samples: int = 50, refresh: int = 50):
+        self.samples = deque(maxlen=size)
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self.refresh = refresh
+        self.value = None
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def add(self, latency: float):
+        with self.lock:
+            self.samples.append(latency)
+            self.pending += 1
+            if len(self.samples) >= self.min_samples and (self.value is None or self.pending >= self.refresh):
+                ordered = sorted(self.samples)
+                self.value = ordered[min(len(ordered) - 1, int(len(ordered) * self.quantile))]
+                self.pending = 0
+
+    def percentile(self) -> float:
+        return self.value
+
+
+class HedgeBudget:
+    # every request earns ratio of a hedge, up to burst saved hedges
+    def __init__(self, ratio: float = 0.05, burst: float = 10.0):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = 0.0
+        self.lock = threading.Lock()
+
+    def earn(self):
+        with self.lock:
+            self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def spend(self) -> bool:
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class Hedger:
+    def __init__(self, executor, budget: HedgeBudget):
+        # executor runs the requests, it must not be a pool whose threads call the hedger (they would wait on it)
+        self.executor = executor
+        self.budget = budget
+        self.trackers = {}
+        self.hedges = 0
+        self.lock = threading.Lock()
+
+    def tracker(self, kind: str) -> LatencyTracker:
+        with self.lock:
+            return self.trackers.setdefault(kind, LatencyTracker())
+
+    def call(self, kind: str, fn):
+        # fn() hedged at the p95 of the kind's latencies, returns the first result or raises the last error
+        tracker = self.tracker(kind)
+        self.budget.earn()
+
+        def timed():
+            started = monotonic()
+            result = fn()
+            tracker.add(monotonic() - started)
+            return result
+
+        delay = tracker.percentile()
+        if delay is None:
+            return timed()
+        first = self.executor.submit(timed)
+        done, _ = wait([first], timeout=delay)
+        if done or not self.budget.spend():
+            return first.result()
+        with self.lock:
+            self.hedges += 1
+        pending = {first, self.executor.submit(timed)}
+        while True:
+            # the loser runs to its end in the background
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+            if not pending:
+                return done.pop().result()
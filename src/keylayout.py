@@ -0,0 +1,54 @@
+from hashlib import sha256
+
+# s3 key layouts of a group's objects, root is "{AWS_S3_BASE_KEY}/{group}":
+#   flat:    {root}/{name}.json.gz
+#   sharded: {root}.shards/{shard}/{name}.json.gz
+# s3 scales request rates per key prefix, a flat group is one prefix and gets throttled (SlowDown) under bulk
+# loads and read bursts, a sharded one spreads over 16 ** SHARD_CHARS prefixes. the shard is a hash of the name up
+# to its first "/", so objects named "{key}/..." (posting deltas and segments) share the shard of key and are
+# still listed with one prefix. the shards live beside the flat keys rather than under them so that the two
+# layouts never share a prefix and a group can be listed in either while it is moved (see migrate-keys)
+FLAT = "flat"
+SHARDED = "sharded"
+MIGRATING = "migrating"  # written sharded, read sharded with a fallback to the flat key
+SHARD_CHARS = 2
+
+
+def shard(name: str) -> str:
+    return sha256(name.split("/")[0].encode("utf-8")).hexdigest()[:SHARD_CHARS]
+
+
+def group_layout(group: str, sharded_groups: str = "", migrating_groups: str = "") -> str:
+    # the layout of group from comma separated group lists, "*" for every group
+    def listed(groups: str) -> bool:
+        groups = [x.strip() for x in (groups or "").split(",")]
+        return group in groups or "*" in groups
+
+    if listed(migrating_groups):
+        return MIGRATING
+    if listed(sharded_groups):
+        return SHARDED
+    return FLAT
+
+
+def object_key(root: str, name: str, layout: str = FLAT) -> str:
+    if layout == FLAT:
+        return f"{root}/{name}.json.gz"
+    return f"{root}.shards/{shard(name)}/{name}.json.gz"
+
+
+def object_name(root: str, key: str) -> str:
+    # the name of the object stored at key, in either layout
+    if key.startswith(f"{root}.shards/"):
+        return key[len(f"{root}.shards/") :].split("/", 1)[1][: -len(".json.gz")]
+    return key[len(f"{root}/") : -len(".json.gz")]
+
+
+def list_prefix(root: str, prefix: str = "", layout: str = FLAT) -> str:
+    # the key prefix to list for the names starting with prefix. a sharded prefix without a "/" can be in any shard,
+    # the whole group is listed and has to be filtered
+    if layout == FLAT:
+        return f"{root}/{prefix}"
+    if "/" in prefix:
+        return f"{root}.shards/{shard(prefix)}/{prefix}"
+    return f"{root}.shards/"
@@ -1,5 +1,6 @@
 from csv import DictWriter
 from datetime import date
+import heapq
 from time import time
 from urllib.parse import quote, unquote
 
@@ -12,6 +13,7 @@ from flask import (
     redirect,
     request,
     session,
+    jsonify,
 )
 
 from app import app, config
@@ -33,6 +35,8 @@ from models import (
     Organizations,
     UserProfile,
     OrganizationProfile,
+    Phonetics,
+    Sketches,
     SocialMediaAccountProfile,
     SocialMediaPlatforms,
     SocialMediaAccounts,
@@ -40,10 +44,21 @@ from models import (
     PhysicalAddressProfile,
     TelephoneNumberProfile,
     ChangeEventProfile,
+    Deadline,
+    Locations,
     Words,
+    fetch_parallel,
     Tags,
+    impact_order,
+    is_segmented,
 )
 from auth.utils import requires_login_and_group
+from api.routes import suggestions
+from fuzzy import fuzzy_index
+from ranking import bm25_scores, min_should_match, top_by_impact
+from sketch import estimate_intersection
+from tokenizer import FIELD_WEIGHTS, index_tokens
+from query import QueryError, is_field_query, plan
 
 mod = Blueprint("main", __name__, url_prefix="/")
 
@@ -69,12 +84,18 @@ def search_entity(entity_type: str):
     # pagination
     page = request.args.get("page", 1, type=int)
     per_page = request.args.get("per_page", config.DEFAULT_PER_PAGE, type=int)
+    search_args = organization_search_args()
     start = time()
     pagination = None
     if entity_type == "user":
-        pagination = search_users(terms=terms, page=page, per_page=per_page)
+        pagination = search_users(terms=terms, page=page, per_page=per_page, phonetic=search_args["phonetic"])
+        pagination.hydrate(Users(), timeout=config.SEARCH_HYDRATE_TIMEOUT)
+    elif entity_type == "organization" and is_field_query(q):
+        pagination = query_organizations(q, page=page, per_page=per_page)
+        pagination.hydrate(Organizations(), timeout=config.SEARCH_HYDRATE_TIMEOUT)
     elif entity_type == "organization":
-        pagination = search_organizations(terms=terms, page=page, per_page=per_page)
+        pagination = search_organizations(terms=terms, page=page, per_page=per_page, **search_args)
+        pagination.hydrate(Organizations(), timeout=config.SEARCH_HYDRATE_TIMEOUT)
     else:
         return render_template("error.html", message="Invalid entity type.")
 
@@ -85,36 +106,86 @@ def search_entity(entity_type: str):
         entity_type=entity_type,
         page=page,
         per_page=per_page,
+        search_args=search_args,
         duration=round(time() - start, 2),
     )
 
 
+def organization_search_args() -> dict:
+    # organization search options from the query string, carried through the pagination links
+    return dict(
+        fuzzy=request.args.get("fuzzy", 0, type=int),
+        phonetic=request.args.get("phonetic", 0, type=int),
+        rank=request.args.get("rank", 0, type=int),
+        msm=request.args.get("msm", ""),
+        sort=request.args.get("sort", ""),
+    )
+
+
 @mod.route("/search")
 @requires_login_and_group("Users")
 def search():
     q = request.args.get("q", "").replace("'", "").replace('"', "")
     terms = [quote(x) for x in q.strip().split(" ") if x]
+    search_args = organization_search_args()
 
     users = []
     organizations = []
     org_count = 0
+    org_count_estimated = False
     user_count = 0
     print("terms", terms)
     if terms:
-        organizations = search_organizations(terms=terms)
-        users = search_users(terms)
-        org_count = organizations.total
-        users = search_users(terms=terms)
+        # plain word queries are counted from the posting sketches, the postings are only intersected
+        # once the results are viewed
+        estimate = None
+        if not is_field_query(q) and not search_args["fuzzy"] and not search_args["phonetic"]:
+            estimate = estimate_organization_count(terms)
+        if estimate is not None:
+            org_count, exact = estimate
+            org_count_estimated = not exact
+        elif is_field_query(q):
+            organizations = query_organizations(q)
+            org_count = organizations.total
+        else:
+            organizations = search_organizations(terms=terms, **search_args)
+            org_count = organizations.total
+        users = search_users(terms=terms, phonetic=search_args["phonetic"])
         user_count = users.total
     else:
         org_count = Organizations().count()
         user_count = Users().count()
     return render_template(
-        "main/search.html", users=users, organizations=organizations, q=q, org_count=org_count, user_count=user_count
+        "main/search.html",
+        users=users,
+        organizations=organizations,
+        q=q,
+        org_count=org_count,
+        org_count_estimated=org_count_estimated,
+        user_count=user_count,
     )
 
 
-def search_users(terms: list[str], page: int = 1, per_page: int = config.DEFAULT_PER_PAGE):
+# typeahead for the search box, same results as /api/search/suggest for logged in users
+@mod.route("/search/suggest")
+@requires_login_and_group("Users")
+def search_suggest():
+    return jsonify(suggestions(request.args.get("q", ""), request.args.get("k", config.SUGGEST_COUNT, type=int)))
+
+
+def search_users(
+    terms: list[str],
+    page: int = 1,
+    per_page: int = config.DEFAULT_PER_PAGE,
+    phonetic: bool = False,
+    budget: float = None,
+):
+    # tag:<name> terms are answered from the tag postings, the rest match usernames and social media handles
+    # the fetches share a latency budget; when it runs out the matches found so far are returned as partial
+    deadline = Deadline(budget or config.SEARCH_BUDGET)
+    late = set()
+    tags = [unquote(x)[4:] for x in terms if unquote(x).lower().startswith("tag:")]
+    terms = [x for x in terms if not unquote(x).lower().startswith("tag:")]
     users = Users().ls()
     social_media_accounts = SocialMediaAccounts().ls()
     matches = {}
@@ -124,11 +195,20 @@ def search_users(terms: list[str], page: int = 1, per_page: int = config.DEFAULT
         for user in users:
             if term.lower() in user.lower():
                 matches[term].append(user)
-        for sma in social_media_accounts:
-            if term.lower() in sma.lower():
-                platform, handle = sma.split(":")
-                profile = SocialMediaAccounts().get_profile(platform=platform, handle=handle, profile_type="user")
-                matches[term].append(profile.name)
+        # the owners of matching handles are looked up together
+        handles = [x for x in social_media_accounts if term.lower() in x.lower()]
+        owners = fetch_parallel(
+            lambda x: (SocialMediaAccounts().dao.get(x) or {}).get("profile_name"),
+            handles,
+            timeout=deadline.remaining(),
+            late=late,
+        )
+        matches[term].extend([x for x in owners.values() if x])
+        if phonetic:
+            # usernames with a word that sounds like the term
+            keys = list(Phonetics().keys(unquote(term)))
+            for entry in Phonetics().get_many(keys, timeout=deadline.remaining(), late=late).values():
+                matches[term].extend(entry.get("users", []))
 
     # reduce the users by intersecting the sets of users for each term
     users = set()
@@ -137,9 +217,20 @@ def search_users(terms: list[str], page: int = 1, per_page: int = config.DEFAULT
             users = set(usrs)
         else:
             users = users.intersection(set(usrs))
+    if tags:
+        tagged = set.intersection(*[set(Tags().postings(x).all()) for x in tags])
+        users = users & tagged if terms else tagged
+
+    pagination = LazyPagination(users, page, per_page, lambda x: UserProfile(name=x, uid="placeholder"))
+    return mark_partial(pagination, late)
+
 
-    users = [UserProfile(name=x, uid="placeholder") for x in sorted(users, key=lambda x: x.lower())]
-    return ListPagination(users, page, per_page, len(users))
+def mark_partial(pagination, late: set):
+    # flags results computed without some of the fetches that missed the search deadline
+    if late:
+        pagination.partial = True
+        pagination.message = "The search ran out of time, these results may be incomplete - refine your query."
+    return pagination
 
 
 class StubProfile:
@@ -151,6 +242,9 @@ class StubProfile:
 class ListPagination:
     def __init__(self, items: list, page: int, per_page: int, total: int):
         self.items = items[(page - 1) * per_page : page * per_page]
+        self.set_page_info(page, per_page, total)
+
+    def set_page_info(self, page: int, per_page: int, total: int):
         self.page = page
         self.per_page = per_page
         self.total = total
@@ -161,17 +255,158 @@ class ListPagination:
         self.next_num = min(page + 1, self.pages)
 
 
-def search_organizations(terms: list[str], page: int = 1, per_page: int = config.DEFAULT_PER_PAGE):
+class LazyPagination(ListPagination):
+    # paginates over profile names and only builds profile objects for the requested page
+    # when the requested page is near the front of a large result set, a bounded heap is used
+    # to pick the first page * per_page names instead of sorting every match
+    heap_ratio = 4
+
+    def __init__(
+        self,
+        names,
+        page: int,
+        per_page: int,
+        factory,
+        sort_key=lambda x: x.lower(),
+        total: int = None,
+        presorted: bool = False,
+        offset: int = 0,
+    ):
+        # presorted names are already in display order and only need to reach the end of the page,
+        # offset is the position of the first of them when they do not start at the first result
+        self.names = names
+        self.offset = offset
+        self.factory = factory
+        self.sort_key = sort_key
+        self.presorted = presorted
+        self._items = None
+        self.hydrated = set()
+        self.message = None
+        self.partial = False
+        self.plan = []
+        self.set_page_info(page, per_page, len(names) if total is None else total)
+
+    def page_names(self) -> list[str]:
+        start = (self.page - 1) * self.per_page
+        end = self.page * self.per_page
+        if start >= self.total or start < 0:
+            return []
+        if self.presorted:
+            return list(self.names)[start - self.offset : end - self.offset]
+        if end * self.heap_ratio < self.total:
+            return heapq.nsmallest(end, self.names, key=self.sort_key)[start:end]
+        return sorted(self.names, key=self.sort_key)[start:end]
+
+    @property
+    def items(self) -> list:
+        if self._items is None:
+            self._items = [self.factory(x) for x in self.page_names()]
+        return self._items
+
+    def hydrate(self, group, timeout: float = None):
+        # swap the placeholders on this page for the stored profiles, loaded in parallel
+        # placeholders stay in place for any profile that is not loaded within timeout seconds
+        profiles = group.get_many([x.name for x in self.items], timeout=timeout)
+        self._items = [profiles.get(x.name, x) for x in self.items]
+        self.hydrated = set(profiles.keys())
+        return self
+
+
+def search_organizations(
+    terms: list[str],
+    page: int = 1,
+    per_page: int = config.DEFAULT_PER_PAGE,
+    fuzzy: bool = False,
+    phonetic: bool = False,
+    rank: bool = False,
+    msm: str = None,
+    sort: str = None,
+    budget: float = None,
+):
     concat_terms = "".join([x.lower() for x in sorted(terms)])
     organizations = []
 
-    exclude_terms = ["llc", "inc"]
+    # every fetch below shares one latency budget, terms whose postings miss it are left out of the
+    # intersection and the results are flagged as partial
+    deadline = Deadline(budget or config.SEARCH_BUDGET)
+    late = set()
     words_group = Words()
     words = dict()
-    for term in [x.lower() for x in terms if x and x not in exclude_terms]:
-        word = words_group.get(term)
-        if word and "organizations" in word:
+    word_datas = dict()
+    query_terms = index_tokens(" ".join([unquote(x) for x in terms]))
+    # fetch every term's posting at once so a multi word query costs about one round trip. segmented postings
+    # (see models.Words) come back as their header and only have the segments that are needed loaded below
+    fetched = dict()
+    if not fuzzy and not phonetic:
+        fetched = words_group.heads(query_terms, timeout=deadline.remaining(), late=late)
+    sounds_like = phonetic_postings(words_group, query_terms, deadline, late) if phonetic else {}
+    for term in [x for x in query_terms if x not in late]:
+        # with fuzzy matching every term is expanded to its close spellings, otherwise only terms
+        # that are not in the index at all are
+        word = fetched.get(term)
+        if word and is_segmented(word):
+            word_datas[term] = word
+        elif word and "organizations" in word:
             words[term] = word.get("organizations", [])
+            word_datas[term] = word
+        elif phonetic:
+            if sounds_like.get(term):
+                words[term] = sounds_like[term]
+        else:
+            orgs = fuzzy_postings(words_group, term, deadline, late)
+            if orgs:
+                words[term] = orgs
+
+    segmented = {x: y for x, y in word_datas.items() if x not in words}
+    if segmented and not words and len(segmented) == 1 and sort != "rating" and not rank:
+        # a lone segmented term is paged straight off its segments
+        posting = list(segmented.values())[0]
+        offset = (page - 1) * per_page
+        names = words_group.page(posting, offset, per_page)
+        total = words_group.total(posting)
+        factory = lambda x: OrganizationProfile(name=x)
+        pagination = LazyPagination(names, page, per_page, factory, total=total, presorted=True, offset=offset)
+        return mark_partial(pagination, late)
+    if segmented and words and sort != "rating" and not rank:
+        # the loaded postings are intersected first and the segmented ones probed only where the candidates fall
+        organizations = set.intersection(*[set(x) for x in words.values()])
+        for posting in segmented.values():
+            organizations = words_group.intersect(posting, organizations)
+        pagination = LazyPagination(organizations, page, per_page, lambda x: OrganizationProfile(name=x))
+        return mark_partial(pagination, late)
+    for term, posting in segmented.items():
+        words[term] = words_group.expand(posting)["organizations"]
+
+    if rank:
+        # relevance order - any org matching at least msm of the terms in its name, dba or street, best
+        # field weighted bm25 score first
+        keys = [f"street:{x}" for x in query_terms if x not in late]
+        streets = Locations().get_many(keys, timeout=deadline.remaining(), late=late)
+        postings, weights = field_postings(words, word_datas, streets)
+        scores = bm25_scores(
+            postings,
+            doc_count=Organizations().count(),
+            avg_length=words_group.avg_name_length(),
+            min_should_match=min_should_match(len(postings), msm or config.SEARCH_MIN_SHOULD_MATCH),
+            weights=weights,
+        )
+        pagination = LazyPagination(
+            scores, page, per_page, lambda x: OrganizationProfile(name=x), sort_key=lambda x: (-scores[x], x.lower())
+        )
+        return mark_partial(pagination, late)
+
+    if sort == "rating" and words:
+        # highest antisocial rating first - walk the smallest posting in impact order and probe the others
+        driver = min(word_datas or words, key=lambda x: len(words[x]))
+        filters = [set(words[x]) for x in words if x != driver]
+        total = len(set(words[driver]).intersection(*filters))
+        ordered = top_by_impact(
+            impact_order(word_datas.get(driver, dict(organizations=words[driver]))), filters, page * per_page
+        )
+        pagination = LazyPagination(
+            ordered, page, per_page, lambda x: OrganizationProfile(name=x), total=total, presorted=True
+        )
+        return mark_partial(pagination, late)
 
     # reduce the orgs by intersecting the sets of orgs for each word
     organizations = set()
@@ -180,12 +415,85 @@ def search_organizations(terms: list[str], page: int = 1, per_page: int = config
             organizations = set(orgs)
         else:
             organizations = organizations.intersection(set(orgs))
-    organizations = list(organizations)
-    organizations = [OrganizationProfile(name=x) for x in sorted(organizations, key=lambda x: x.lower())]
-    pagination = ListPagination(organizations, page, per_page, len(organizations))
+    pagination = LazyPagination(organizations, page, per_page, lambda x: OrganizationProfile(name=x))
+    return mark_partial(pagination, late)
+
+
+def field_postings(words: dict, word_datas: dict, streets: dict) -> tuple[dict, dict]:
+    # ({term: names}, {term: {name: weight}}) over the name, dba and street fields: name and dba matches
+    # are in the word postings, dba ones flagged in the posting's "dba" list, street ones in the locations
+    postings = dict()
+    weights = dict()
+    terms = list(words.keys()) + [x.split(":", 1)[1] for x in streets if x.split(":", 1)[1] not in words]
+    for term in terms:
+        names = set(words.get(term, []))
+        street = set(streets.get(f"street:{term}", {}).get("organizations", [])) - names
+        postings[term] = names | street
+        weights[term] = {x: FIELD_WEIGHTS["dba"] for x in word_datas.get(term, {}).get("dba", [])}
+        weights[term].update({x: FIELD_WEIGHTS["street"] for x in street})
+    return postings, weights
+
+
+def estimate_organization_count(terms: list[str]):
+    # (count, exact) from the sketches of the terms' postings, None if a term has no sketch or the
+    # sketches cannot tell and the postings have to be intersected
+    query_terms = index_tokens(" ".join([unquote(x) for x in terms]))
+    sketches = Sketches().get_many(query_terms, timeout=config.SEARCH_FETCH_TIMEOUT)
+    if not query_terms or len(sketches) < len(query_terms):
+        return None
+    return estimate_intersection(list(sketches.values()))
+
+
+def query_organizations(q: str, page: int = 1, per_page: int = config.DEFAULT_PER_PAGE):
+    # field scoped query, e.g. `state:TX tag:ppp rating>100000 roofing` - see query.py
+    message = None
+    query_plan = None
+    factory = lambda x: OrganizationProfile(name=x)
+    try:
+        query_plan = plan(q)
+        if query_plan.is_paged():
+            names, total = query_plan.page(page, per_page)
+            offset = (page - 1) * per_page
+            pagination = LazyPagination(names, page, per_page, factory, total=total, presorted=True, offset=offset)
+        else:
+            pagination = LazyPagination(query_plan.execute(), page, per_page, factory)
+    except QueryError as e:
+        pagination = LazyPagination(set(), page, per_page, factory)
+        message = str(e)
+    pagination.message = message
+    pagination.plan = query_plan.describe() if query_plan else []
     return pagination
 
 
+def fuzzy_postings(words_group: Words, term: str, deadline: Deadline = None, late: set = None) -> set:
+    # union of the postings of the indexed words within edit distance of term
+    index = fuzzy_index()
+    if index is None:
+        return set()
+    deadline = deadline or Deadline(config.SEARCH_FETCH_TIMEOUT)
+    candidates = [x["term"] for x in index.lookup(term, limit=config.FUZZY_MAX_CANDIDATES)]
+    orgs = set()
+    for word in words_group.get_many(candidates, timeout=deadline.remaining(), late=late).values():
+        orgs.update(word.get("organizations", []))
+    return orgs
+
+
+def phonetic_postings(words_group: Words, terms: list[str], deadline: Deadline = None, late: set = None) -> dict:
+    # {term: orgs} with the union of the postings of every indexed word that shares a phonetic key with
+    # the term, all keys and then all words are fetched in one batch each
+    deadline = deadline or Deadline(config.SEARCH_FETCH_TIMEOUT)
+    keys = {term: Phonetics().keys(term) for term in terms}
+    entries = Phonetics().get_many(list(set().union(*keys.values())), timeout=deadline.remaining(), late=late)
+    similar = {
+        term: set([term]).union(*[entries[x].get("words", []) for x in keys[term] if x in entries]) for term in terms
+    }
+    postings = words_group.get_many(list(set().union(*similar.values())), timeout=deadline.remaining(), late=late)
+    return {
+        term: set().union(*[postings[x].get("organizations", []) for x in similar[term] if x in postings])
+        for term in terms
+    }
+
+
 @mod.route("/profile")
 @mod.route("/profile/username/<string:username>")
 @requires_login_and_group("Users")
@@ -195,21 +503,24 @@ def profile(username=None):
     if _username is None:
         return redirect(url_for("auth.login"))
 
-    user = Users().get(name=_username)
+    users = Users()
+    user = users.get(name=_username)
     if not user:
         return render_template("error.html", message="User not found.")
 
-    return render_template("main/profile.html", profile=user, system_tags=Tags().ls())
+    change_events = users.events.latest(user.name, embedded=user.change_events)
+    return render_template("main/profile.html", profile=user, change_events=change_events, system_tags=Tags().ls())
 
 
 @mod.route("/profile/orgname/<string:name>", methods=["GET"])
 @requires_login_and_group("Users")
 def profile_organization(name: str):
-    organization = Organizations().get(name)
-    if name is None:
+    organizations = Organizations()
+    organization = organizations.get(name)
+    if organization is None:
         return render_template("error.html", message="Organization not found.")
-    print("organization", organization, type(organization))
-    return render_template("main/profile.html", profile=organization)
+    change_events = organizations.events.latest(organization.name, embedded=organization.change_events)
+    return render_template("main/profile.html", profile=organization, change_events=change_events)
 
 
 @mod.route("/profile/personal/", methods=["GET", "POST"])
@@ -1,18 +1,33 @@
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor, wait
+from copy import deepcopy
 import json
 import gzip
 from hashlib import sha256
+from math import log2
 import os
-from random import choice
+from random import choice, random
 from string import ascii_lowercase, digits
 from uuid import uuid4
-from time import time
+from threading import current_thread
+from time import sleep, time, time_ns
 from urllib.parse import quote
 from pydantic import BaseModel
 from pydantic import validator
 import boto3
-from flask import current_app
+from botocore.config import Config as BotoConfig
+from botocore.exceptions import ClientError
+from flask import current_app, has_app_context
 
+from bitmap import Bitmap
 from config import config
+from hedge import HedgeBudget, Hedger
+from keylayout import FLAT, MIGRATING, SHARDED, group_layout, list_prefix, object_key, object_name
+from patch import apply_patch, diff
+from phonetic import phonetic_keys, phonetic_tokens
+from sketch import build_sketch, sketch_add, sketch_rm
+from throttle import AdaptiveLimiter, LimitedClient
+from tokenizer import STOP_WORDS, organization_fields, street_tokens
 
 s3_config = dict(
     aws_access_key_id=config.AWS_ACCESS_KEY_ID,
@@ -20,15 +35,22 @@ s3_config = dict(
     region_name=config.AWS_DEFAULT_REGION,
 )
 
+# bounded s3 timeouts so requests abandoned by a search deadline do not hold pool threads for long
+s3_config["config"] = BotoConfig(
+    connect_timeout=config.S3_CONNECT_TIMEOUT,
+    read_timeout=config.S3_READ_TIMEOUT,
+    retries=dict(max_attempts=2),
+    max_pool_connections=config.S3_MAX_CONCURRENCY,
+)
+
 if os.getenv("LOCALONLY", "FALSE").upper() == "TRUE":
     s3_config["endpoint_url"]=os.getenv("LOCALS3URL", "http://localhost:9000")
     # s3_config["config"]=boto3.session.Config(signature_version='v4'),
     s3_config["verify"]=False
 
-s3 = boto3.client(
-    "s3",
-    **s3_config
-)
+# every s3 request of the process goes through one adaptive concurrency limit (see throttle.py)
+limiter = AdaptiveLimiter(maximum=config.S3_MAX_CONCURRENCY, latency_target=config.S3_LATENCY_TARGET)
+s3 = LimitedClient(boto3.client("s3", **s3_config), limiter)
 
 
 class FileSystemCache:
@@ -61,28 +83,126 @@ class FileSystemCache:
 
 r = FileSystemCache()
 
+# shared pool for fanning out s3 requests
+executor = ThreadPoolExecutor(max_workers=config.IO_THREAD_COUNT, thread_name_prefix="s3io")
+
+
+def submit(fn, *args, **kwargs):
+    # run fn on the shared pool inside the current app context so current_app logging keeps working
+    app = current_app._get_current_object() if has_app_context() else None
+
+    def run():
+        if app is None:
+            return fn(*args, **kwargs)
+        with app.app_context():
+            return fn(*args, **kwargs)
+
+    return executor.submit(run)
+
+
+# hedged gets (see hedge.py) run on their own pool, the fetches on the shared one wait on them
+hedger = Hedger(
+    ThreadPoolExecutor(max_workers=config.IO_THREAD_COUNT, thread_name_prefix="s3hedge"),
+    HedgeBudget(config.S3_HEDGE_BUDGET),
+)
+
+
+def fetch_parallel(fn, keys, timeout: float = None, late: set = None) -> dict:
+    # calls fn(key) for each key on the shared pool and returns {key: result} for every call
+    # that finished within timeout seconds; calls that miss the deadline are abandoned - queued ones are
+    # cancelled, running ones finish in the background - and their keys are added to late
+    if current_thread().name.startswith(executor._thread_name_prefix):
+        # already on the pool: waiting on more pool work could starve it, so run the calls here one by one. the
+        # timeout is checked between calls, the keys not reached in time are late
+        deadline = Deadline(timeout)
+        keys = list(keys)
+        results = {}
+        for idx, key in enumerate(keys):
+            if deadline.expired:
+                if late is not None:
+                    late.update(keys[idx:])
+                break
+            try:
+                results[key] = fn(key)
+            except Exception as e:
+                current_app.logger.error(f"Error fetching {key}: {e}")
+        return results
+    futures = {submit(fn, key): key for key in keys}
+    done, not_done = wait(futures, timeout=timeout)
+    for future in not_done:
+        future.cancel()
+    if late is not None:
+        late.update([futures[x] for x in not_done])
+    results = {}
+    for future in done:
+        try:
+            results[futures[future]] = future.result()
+        except Exception as e:
+            current_app.logger.error(f"Error fetching {futures[future]}: {e}")
+    return results
+
+
+# conditional writes: read() returns an object with its version, the s3 etag, and put(name, data, version) only
+# goes through if the stored object is still at that version - ABSENT for one that did not exist yet. a writer
+# that loses the race gets WriteConflict, re-reads and applies its change again (see DAO.modify), so concurrent
+# read-modify-writes of one object never drop each other's changes
+ABSENT = "*"
+CONFLICT_CODES = ["PreconditionFailed", "ConditionalRequestConflict"]
+
+
+class WriteConflict(Exception):
+    pass
+
+
+def conditions(version: str) -> dict:
+    # s3 request arguments that make a write conditional on the stored version
+    if version == ABSENT:
+        return dict(IfNoneMatch="*")
+    if version:
+        return dict(IfMatch=version)
+    return {}
+
+
+def error_code(e: Exception) -> str:
+    return e.response.get("Error", {}).get("Code") if isinstance(e, ClientError) else None
+
+
+def is_conflict(e: Exception) -> bool:
+    return error_code(e) in CONFLICT_CODES
+
 
-stop_words = [
-    "the",
-    "and",
-    "of",
-    "to",
-    "in",
-    "for",
-    "a",
-    "is",
-    "that",
-    "on",
-    "with",
-    "as",
-    "at",
-    "by",
-    "from",
-    "be",
-    "&",
-    "llc",
-    "inc",
-]
+def backoff(attempt: int):
+    # jittered exponential backoff before retrying a conflicting write
+    sleep(random() * config.WRITE_CONFLICT_BACKOFF * 2**attempt)
+
+
+def retry_conflicts(change, retries: int = None):
+    # calls change() until it gets through without a WriteConflict, at most retries more times, and returns its
+    # result - False if it kept conflicting
+    retries = config.WRITE_CONFLICT_RETRIES if retries is None else retries
+    for attempt in range(retries + 1):
+        try:
+            return change()
+        except WriteConflict as e:
+            if attempt == retries:
+                current_app.logger.error(f"Giving up on {e} after {retries + 1} conflicting writes")
+                return False
+            backoff(attempt)
+
+
+class Deadline:
+    # a latency budget shared by every fetch of one request, remaining() is the timeout for the next fetch
+    def __init__(self, budget: float = None):
+        self.end = time() + budget if budget else None
+
+    def remaining(self) -> float:
+        if self.end is None:
+            return None
+        return max(0.0, self.end - time())
+
+    @property
+    def expired(self) -> bool:
+        return self.end is not None and time() >= self.end
 
 
 def generate_random_id(length=12):
@@ -261,6 +381,11 @@ class OrganizationProfile(BaseModel):
     class Config:
         arbitrary_types_allowed = True
 
+    @property
+    def derived_change_events(self) -> list[ChangeEventProfile]:
+        # events rebuilt from the document on every load, they are not new events to log
+        return []
+
 
 class PPPOrganizationProfile(OrganizationProfile):
     def __init__(self, data: dict):
@@ -303,6 +428,10 @@ class PPPOrganizationProfile(OrganizationProfile):
             )
         )
 
+    @property
+    def derived_change_events(self) -> list[ChangeEventProfile]:
+        return PPPOrganizationProfile(self.raw_data).change_events
+
 
 class AccessTokenModel(BaseModel):
     jti: str
@@ -329,34 +458,89 @@ class DAO:
     def __init__(self, object_group: str):
         self.object_group = object_group
 
+    @property
+    def root(self) -> str:
+        return f"{config.AWS_S3_BASE_KEY}/{self.object_group}"
+
+    def layout(self) -> str:
+        # see keylayout.py
+        return group_layout(self.object_group, config.S3_SHARDED_GROUPS, config.S3_MIGRATING_GROUPS)
+
+    def key(self, name: str, layout: str = None) -> str:
+        # the key an object is written to, in the group's layout by default
+        return object_key(self.root, name, layout or self.layout())
+
+    def name_of(self, key: str) -> str:
+        # the name of the object stored at a listed key
+        return object_name(self.root, key)
+
+    def is_cached(self, name: str) -> bool:
+        return os.path.exists(os.path.join(r.cache_dir, self.key(name)))
+
+    def hedged(self) -> bool:
+        groups = [x.strip() for x in config.S3_HEDGE_GROUPS.split(",")]
+        return self.object_group in groups or "*" in groups
+
     def get(self, name: str):
-        # load from s3
-        key = f"{config.AWS_S3_BASE_KEY}/{self.object_group}/{name}.json.gz"
-        data = r.get(key)
+        # load from cache, or from s3
+        data = r.get(self.key(name))
         if data:
             return json.loads(data)
+        return self.read(name)[0]
+
+    def read(self, name: str):
+        # (data, version) straight from s3 for a conditional put, (None, ABSENT) if there is no object. an object
+        # that cannot be read is ABSENT too, a put conditional on that fails instead of overwriting it
+        key = self.key(name)
+        data, version = self.fetch(key, name)
+        if version == ABSENT and self.layout() == MIGRATING:
+            # not copied to its sharded key yet (see migrate-keys), the next write creates that
+            data = self.fetch(self.key(name, FLAT), name)[0]
+        if data is not None:
+            # add to cache
+            r.set(key, json.dumps(data))
+        return data, version
+
+    def fetch(self, key: str, name: str):
+        def get_object():
+            obj = s3.get_object(Bucket=config.AWS_S3_BUCKET_NAME, Key=key)
+            return obj["Body"].read(), obj.get("ETag")
 
-        # retrieve, unzip with gzip, and load json
         try:
-            obj = s3.get_object(Bucket=config.AWS_S3_BUCKET_NAME, Key=key)
+            if self.hedged():
+                body, version = hedger.call(self.object_group, get_object)
+            else:
+                body, version = get_object()
         except s3.exceptions.NoSuchKey as e:
             current_app.logger.debug(f"No key found at {config.AWS_S3_BUCKET_NAME}/{key}: {e}")
-            return None
+            return None, ABSENT
         except Exception as e:
             current_app.logger.error(f"Error loading {self.object_group} {name}: {e} ({e.__class__.__name__})")
-            return None
+            return None, ABSENT
         try:
-            data = json.loads(gzip.decompress(obj["Body"].read()).decode("utf-8"))
+            data = json.loads(gzip.decompress(body).decode("utf-8"))
         except Exception as e:
             current_app.logger.error(f"Error loading {self.object_group} {name}: {e}")
-            return None
-        # add to cache
-        r.set(key, json.dumps(data))
-        return data
-
-    def ls(self):
-        # list the objects in the group
-        key = f"{config.AWS_S3_BASE_KEY}/{self.object_group}/"
+            return None, version
+        return data, version
+
+    def ls(self, prefix: str = ""):
+        # list the objects in the group, or the ones whose name starts with prefix. a group being migrated is
+        # listed in both layouts and an object in both is listed once
+        layouts = [SHARDED, FLAT] if self.layout() == MIGRATING else [self.layout()]
+        results = {}
+        for layout in layouts:
+            objs = self.list_keys(list_prefix(self.root, prefix, layout))
+            if objs is None:
+                return None
+            for obj in objs:
+                name = self.name_of(obj["Key"])
+                if name.startswith(prefix) and name not in results:
+                    results[name] = obj
+        return list(results.values())
+
+    def list_keys(self, key: str):
+        # every object whose key starts with key
         results = []
         try:
             continuation_token = None
@@ -376,46 +560,103 @@ class DAO:
 
                 continuation_token = result["NextContinuationToken"]
         except Exception as e:
-            current_app.logger.error(f"Error listing {self.object_group} {self.name}: {e}")
+            current_app.logger.error(f"Error listing {key}: {e}")
             return None
         return results
 
     def rm(self, name: str):
-        key = f"{config.AWS_S3_BASE_KEY}/{self.object_group}/{name}.json.gz"
+        if not self.delete(name):
+            return False
+        # update count
+        self.update_metadata_key("count", len(self.ls()))
+        return True
+
+    def delete(self, name: str, version: str = None):
+        # delete from s3 - no count update. with a version only if the object is still at it, see put. a group being
+        # migrated loses the flat copy first, so that migrate-keys cannot copy it back
+        key = self.key(name)
         try:
-            s3.delete_object(Bucket=config.AWS_S3_BUCKET_NAME, Key=key)
+            if self.layout() == MIGRATING:
+                s3.delete_object(Bucket=config.AWS_S3_BUCKET_NAME, Key=self.key(name, FLAT))
+            s3.delete_object(
+                Bucket=config.AWS_S3_BUCKET_NAME, Key=key, **(conditions(version) if version != ABSENT else {})
+            )
         except Exception as e:
+            r.delete(key)
+            if is_conflict(e):
+                raise WriteConflict(f"{self.object_group} {name}")
             current_app.logger.error(f"Error deleting {self.object_group} {name}: {e}")
             return False
         # invalidate cache
         r.delete(key)
-        # update count
-        self.update_metadata_key("count", len(self.ls()))
+        return True
+
+    def migrate(self, name: str, cleanup: bool = False) -> bool:
+        # migrate-keys: copies the flat object to its sharded key unless a writer created that meanwhile, with
+        # cleanup the flat object is deleted after
+        flat_key = self.key(name, FLAT)
+        try:
+            s3.copy_object(
+                Bucket=config.AWS_S3_BUCKET_NAME,
+                Key=self.key(name, SHARDED),
+                CopySource=dict(Bucket=config.AWS_S3_BUCKET_NAME, Key=flat_key),
+                IfNoneMatch="*",
+            )
+        except Exception as e:
+            # written or deleted by the app since it was listed
+            if not is_conflict(e) and error_code(e) != "NoSuchKey":
+                current_app.logger.error(f"Error migrating {self.object_group} {name}: {e}")
+                return False
+        if cleanup:
+            try:
+                s3.delete_object(Bucket=config.AWS_S3_BUCKET_NAME, Key=flat_key)
+            except Exception as e:
+                current_app.logger.error(f"Error deleting {flat_key}: {e}")
+                return False
         return True
 
     def update(self, name: str, data: dict):
-        key = f"{config.AWS_S3_BASE_KEY}/{self.object_group}/{name}.json.gz"
-        existing_data = self.get(name)
-        if existing_data:
-            existing_data.update(data)
-            data = existing_data
-        # save to s3
+        # merged into the stored object, merged again into what another writer stored meanwhile
+        return self.modify(name, lambda existing_data: {**(existing_data or {}), **data})
+
+    def modify(self, name: str, change) -> bool:
+        # read-modify-write: change(data) gets the stored object, None if there is none, and returns the object to
+        # store, None to delete it. it is called again on a fresh read whenever another writer got in between.
+        # keeps the count of the group
+        def attempt():
+            data, version = self.read(name)
+            existed = data is not None
+            data = change(data)
+            if data is None:
+                if not existed:
+                    return True
+                return self.delete(name, version=version) and self.adjust_count(-1) is not False
+            if not self.put(name, data, version=version):
+                return False
+            return existed or self.adjust_count(1) is not False
+
+        return retry_conflicts(attempt)
+
+    def put(self, name: str, data: dict, version: str = None):
+        # save to s3 as is - no merge with the stored object and no count update. with a version (see read) it
+        # raises WriteConflict if the stored object is not at that version anymore. returns the new version
+        key = self.key(name)
         try:
-            s3.put_object(
+            obj = s3.put_object(
                 Bucket=config.AWS_S3_BUCKET_NAME,
                 Key=key,
                 Body=gzip.compress(json.dumps(data).encode("utf-8")),
+                **conditions(version),
             )
         except Exception as e:
+            r.delete(key)
+            if is_conflict(e):
+                raise WriteConflict(f"{self.object_group} {name}")
             current_app.logger.error(f"Error saving {self.object_group} {name}: {e}")
             return False
         # invalidate cache
         r.delete(key)
-
-        # update count
-        if existing_data is None:  # increment if new
-            self.update_metadata_key("count", self.count() + 1)
-        return True
+        return obj.get("ETag") or True
 
     def load_metadata(self):
         key = f"{config.AWS_S3_BASE_KEY}/metadata/{self.object_group}.json"
@@ -438,38 +679,433 @@ class DAO:
         r.set(key, json.dumps(data))
         return data
 
-    def update_metadata(self, data):
+    def read_metadata(self):
+        # (metadata, version) straight from s3 for a conditional update_metadata, see read
+        key = f"{config.AWS_S3_BASE_KEY}/metadata/{self.object_group}.json"
+        try:
+            obj = s3.get_object(Bucket=config.AWS_S3_BUCKET_NAME, Key=key)
+        except s3.exceptions.NoSuchKey:
+            return None, ABSENT
+        except Exception as e:
+            current_app.logger.error(f"Error loading {self.object_group} metadata: {e}")
+            return None, ABSENT
+        try:
+            return json.loads(obj["Body"].read().decode("utf-8")), obj.get("ETag")
+        except Exception as e:
+            current_app.logger.error(f"Error loading {self.object_group} metadata: {e}")
+            return None, obj.get("ETag")
+
+    def update_metadata(self, data, version: str = None):
         key = f"{config.AWS_S3_BASE_KEY}/metadata/{self.object_group}.json"
         try:
             s3.put_object(
                 Bucket=config.AWS_S3_BUCKET_NAME,
                 Key=key,
                 Body=json.dumps(data).encode("utf-8"),
+                **conditions(version),
             )
         except Exception as e:
+            r.delete(key)
+            if is_conflict(e):
+                raise WriteConflict(f"{self.object_group} metadata")
             current_app.logger.error(f"Error saving {self.object_group} metadata: {e}")
             return False
         # invalidate cache
         r.delete(key)
         return True
 
+    def modify_metadata(self, change):
+        # read-modify-write of the metadata like modify, returns the metadata written or False
+        def attempt():
+            metadata, version = self.read_metadata()
+            metadata = change(metadata or {})
+            return self.update_metadata(metadata, version=version) and metadata
+
+        return retry_conflicts(attempt)
+
     def count(self):
         metadata = self.load_metadata()
         if metadata and "count" in metadata:
             return metadata["count"]
-        if not metadata:
-            metadata = {}
-        self.update_metadata_key("count", len(self.ls()))
-        return self.count()
+        self.update_metadata_key("count", len(self.ls() or []))
+        return (self.load_metadata() or {}).get("count", 0)
+
+    def adjust_count(self, delta: int):
+        # count += delta without losing concurrent adjustments, a group without a count yet is counted
+        def change(metadata):
+            count = metadata.get("count")
+            metadata["count"] = max(0, count + delta) if count is not None else len(self.ls() or [])
+            return metadata
+
+        return self.modify_metadata(change)
 
     def update_metadata_key(self, key, value):
-        metadata = self.load_metadata()
-        if metadata is None:
-            metadata = {}
+        return self.modify_metadata(lambda metadata: {**metadata, key: value})
+
+
+# profiles are stored as a base snapshot plus small patch objects (see patch.py) instead of being rewritten whole
+# on every edit: "{group}_patches/{name}/{seq}" holds the diff that took the profile from version seq - 1 to seq,
+# and the base records in PATCHED_THROUGH the last patch folded into it. a write reads the profile with its seq,
+# diffs and creates patch seq + 1 only if nobody else did (IfNoneMatch), so concurrent edits conflict and are
+# retried like any other conditional write (see DAO.modify). compact-profiles folds the patches into the base.
+# patches are only ever added as the next seq, so readers find the ones after the base by getting seq + 1,
+# seq + 2, ... until one is not there, instead of listing them. listing is left to the compactor, and to creating
+# and deleting a profile, which have to find patches a deleted profile of the same name left behind
+PATCHED_THROUGH = "_patched_through"
+patch_listings = {}  # "group/name" -> (probed at, patch seqs)
+
+
+class PatchedDAO(DAO):
+    def __init__(self, object_group: str):
+        super().__init__(object_group)
+        self.patches = DAO(f"{object_group}_patches")
 
-        metadata[key] = value
-        self.update_metadata(metadata)
-        return metadata
+    def patch_name(self, name: str, seq: int) -> str:
+        return f"{name}/{seq:010d}"
+
+    def patch_seqs(self, name: str) -> list[int]:
+        # seqs of the stored patches of name in order, None if they cannot be listed
+        objs = self.patches.ls(prefix=f"{name}/")
+        if objs is None:
+            return None
+        # "{name}/..." also lists the patches of names that start with "{name}/"
+        rests = [self.patches.name_of(x["Key"])[len(name) + 1 :] for x in objs]
+        return sorted([int(x) for x in rests if x.isdigit()])
+
+    def newer_seqs(self, name: str, seq: int) -> list[int]:
+        # seqs of the patches after seq, one GET each and one for the first that is not there. the patches read
+        # are cached, so merge does not read them again
+        seqs = []
+        while self.patches.get(self.patch_name(name, seq + len(seqs) + 1)) is not None:
+            seqs.append(seq + len(seqs) + 1)
+        return seqs
+
+    def known_seqs(self, name: str, seq: int) -> list[int]:
+        # seqs of the patches after seq as probed for in the last INDEX_DELTA_LISTING_TTL seconds, probed for
+        # again past the last one known after that
+        listing = patch_listings.get(f"{self.object_group}/{name}")
+        known = [x for x in (listing[1] if listing else []) if x > seq]
+        if listing and time() - listing[0] < config.INDEX_DELTA_LISTING_TTL:
+            return known
+        seqs = known + self.newer_seqs(name, max(known, default=seq))
+        patch_listings[f"{self.object_group}/{name}"] = (time(), seqs)
+        return seqs
+
+    def merge(self, name: str, data: dict, seqs: list[int]):
+        # (profile, seq) of a base with the listed patches it does not have yet, None if one of them is gone
+        if data is None:
+            return None, 0
+        seq = data.pop(PATCHED_THROUGH, 0)
+        for patch_seq in [x for x in seqs if x > seq]:
+            patch = self.patches.get(self.patch_name(name, patch_seq)) if patch_seq == seq + 1 else None
+            if patch is None:
+                return None
+            data = apply_patch(data, patch)
+            seq = patch_seq
+        return data, seq
+
+    def is_cached(self, name: str) -> bool:
+        listing = patch_listings.get(f"{self.object_group}/{name}")
+        if not listing or time() - listing[0] >= config.INDEX_DELTA_LISTING_TTL:
+            return False
+        return super().is_cached(name) and all([self.patches.is_cached(self.patch_name(name, x)) for x in listing[1]])
+
+    def get(self, name: str):
+        # the base as stored, with its PATCHED_THROUGH - DAO.get would load a miss through read below, merged already
+        data = r.get(self.key(name))
+        data = json.loads(data) if data else DAO.read(self, name)[0]
+        merged = self.merge(name, data, self.known_seqs(name, (data or {}).get(PATCHED_THROUGH, 0)))
+        if merged is None:
+            # the cached base is older than the compaction that removed a known patch
+            return self.read(name)[0]
+        return merged[0]
+
+    def read(self, name: str, attempts: int = 2):
+        # (profile, version) with version (seq, profile as read) for put to diff against, (None, ABSENT) if there
+        # is no profile. a compactor can fold and delete the patches after the base between reading it and probing
+        # for them, so the base is checked to still be the one read: patch seq + 1 would be created for a seq
+        # already folded into the new base, and be ignored
+        data, base_version = super().read(name)
+        seqs = self.newer_seqs(name, (data or {}).get(PATCHED_THROUGH, 0))
+        merged = self.merge(name, data, seqs)
+        if data is not None and self.fetch(self.key(name), name)[1] != base_version:
+            merged = None
+        if merged is None and attempts > 1:
+            return self.read(name, attempts - 1)
+        if merged is None or merged[0] is None:
+            return None, ABSENT
+        patch_listings[f"{self.object_group}/{name}"] = (time(), seqs)
+        data, seq = merged
+        return data, (seq, deepcopy(data))
+
+    def put(self, name: str, data: dict, version=None):
+        # with a version from read only the changes since are written, as the next patch - nothing at all if there
+        # are none. raises WriteConflict if another writer added that patch first. ABSENT creates the profile and
+        # no version rewrites it whole, the new base folds in every patch there is (left over from a deleted
+        # profile of the same name, or raced in by an unconditional write)
+        if isinstance(version, tuple):
+            seq, previous = version
+            patch = diff(previous, data)
+            if not patch:
+                return version
+            if not self.patches.put(self.patch_name(name, seq + 1), patch, version=ABSENT):
+                return False
+            listing = patch_listings.get(f"{self.object_group}/{name}")
+            if listing:
+                patch_listings[f"{self.object_group}/{name}"] = (listing[0], listing[1] + [seq + 1])
+            return seq + 1, deepcopy(data)
+        seqs = self.patch_seqs(name)
+        if seqs is None:
+            return False
+        return super().put(name, {**data, PATCHED_THROUGH: max(seqs, default=0)}, version=version)
+
+    def delete(self, name: str, version=None):
+        # the base goes first, patches a failure leaves behind are folded into the next profile of that name. with
+        # a version it raises WriteConflict if a patch was added since
+        if isinstance(version, tuple):
+            if self.newer_seqs(name, version[0]):
+                raise WriteConflict(f"{self.object_group} {name}")
+            version = None
+        if not super().delete(name, version=version):
+            return False
+        for seq in self.patch_seqs(name) or []:
+            self.patches.delete(self.patch_name(name, seq))
+        patch_listings.pop(f"{self.object_group}/{name}", None)
+        return True
+
+    def pending(self) -> dict:
+        # {name: patch seqs} of every profile with patches, for the compactor
+        names = {}
+        for key in [self.patches.name_of(x["Key"]) for x in self.patches.ls() or []]:
+            name, seq = key.rsplit("/", 1)
+            names.setdefault(name, []).append(int(seq))
+        return {x: sorted(y) for x, y in names.items()}
+
+    def compact(self, name: str) -> bool:
+        # folds the patches into the base, which is only written if nobody changed it meanwhile (a rewrite or a
+        # delete). patches added meanwhile are left for the next run, patches without a base are deleted
+        seqs = self.patch_seqs(name)
+        if not seqs:
+            return False
+        data, version = super().read(name)
+        folded = (data or {}).get(PATCHED_THROUGH, 0)
+        merged = self.merge(name, data, seqs)
+        if merged is None:
+            return False
+        data, seq = merged
+        if data is not None and seq > folded:
+            try:
+                if not super().put(name, {**data, PATCHED_THROUGH: seq}, version=version):
+                    return False
+            except WriteConflict:
+                return False
+        for patch_seq in [x for x in seqs if data is None or x <= seq]:
+            self.patches.delete(self.patch_name(name, patch_seq))
+        patch_listings.pop(f"{self.object_group}/{name}", None)
+        return True
+
+
+# change events are kept out of the profile documents, in an append-only log per profile:
+# "{group}_events/{name}/{time_ns}-{random}-{count}" objects of {"events": [...]} in time order. a save appends
+# the new events as one small object, compact-profiles folds runs of them into segments of up to
+# CHANGE_EVENT_SEGMENT_SIZE events, and a profile view fetches only the objects holding its latest
+# CHANGE_EVENT_PAGE events - the counts in the names tell which without reading anything else. the ratings on
+# the profile are the snapshot of its events, saved with them
+event_listings = {}  # "group/name" -> (listed at, log object names)
+
+
+class ChangeEvents:
+    def __init__(self, group: str):
+        self.group = group
+        self.dao = DAO(f"{group}_events")
+
+    def names(self, name: str, cached: bool = True) -> list[str]:
+        # the log objects of a profile in time order, None if they cannot be listed
+        listing = event_listings.get(f"{self.group}/{name}")
+        if cached and listing and time() - listing[0] < config.INDEX_DELTA_LISTING_TTL:
+            return listing[1]
+        objs = self.dao.ls(prefix=f"{name}/")
+        if objs is None:
+            return None
+        # "{name}/..." also lists the logs of names that start with "{name}/"
+        names = sorted([x for x in [self.dao.name_of(y["Key"]) for y in objs] if "/" not in x[len(name) + 1 :]])
+        event_listings[f"{self.group}/{name}"] = (time(), names)
+        return names
+
+    def append(self, name: str, events: list) -> bool:
+        events = [x.dict() if isinstance(x, BaseModel) else x for x in events]
+        if not events:
+            return True
+        log_name = f"{name}/{time_ns():020d}-{uuid4().hex[:8]}-{len(events)}"
+        if not self.dao.put(log_name, dict(events=events)):
+            return False
+        listing = event_listings.get(f"{self.group}/{name}")
+        if listing:
+            event_listings[f"{self.group}/{name}"] = (listing[0], listing[1] + [log_name])
+        return True
+
+    def latest(self, name: str, count: int = None, embedded: list = []) -> list[ChangeEventProfile]:
+        # the newest count events, newest first, along with those still embedded in the profile document. an
+        # event folded by the compactor while it was read can be in two objects, it is listed once
+        count = count or config.CHANGE_EVENT_PAGE
+        wanted = []
+        for log_name in reversed(self.names(name) or []):
+            if sum([int(x.rsplit("-", 1)[1]) for x in wanted]) >= count:
+                break
+            wanted.append(log_name)
+        objs = fetch_parallel(self.dao.get, wanted) if wanted else {}
+        events = []
+        for log_name in wanted:
+            for event in reversed((objs.get(log_name) or {}).get("events", [])):
+                event = ChangeEventProfile(**event)
+                if event not in events:
+                    events.append(event)
+        events += [x for x in embedded if x not in events]
+        return sorted(events, key=lambda x: x.change_date or "", reverse=True)[:count]
+
+    def rename(self, name: str, new_name: str) -> bool:
+        # moves the log along with a renamed profile
+        for log_name in self.names(name, cached=False) or []:
+            data = self.dao.get(log_name)
+            if data and not self.dao.put(f"{new_name}/{log_name[len(name) + 1 :]}", data):
+                return False
+        event_listings.pop(f"{self.group}/{new_name}", None)
+        return self.delete(name)
+
+    def delete(self, name: str) -> bool:
+        deleted = all([self.dao.delete(x) for x in self.names(name, cached=False) or []])
+        event_listings.pop(f"{self.group}/{name}", None)
+        return deleted
+
+    def pending(self) -> list[str]:
+        # names of the profiles whose log is more than one object, for the compactor
+        names = {}
+        for log_name in [self.dao.name_of(x["Key"]) for x in self.dao.ls() or []]:
+            name = log_name.rsplit("/", 1)[0]
+            names[name] = names.get(name, 0) + 1
+        return [x for x, y in names.items() if y > 1]
+
+    def compact(self, name: str) -> bool:
+        # folds runs of log objects into segments of up to CHANGE_EVENT_SEGMENT_SIZE events, named after the
+        # last object of the run so the log stays in time order. objects appended meanwhile are left for the next run
+        runs = [[]]
+        for log_name in self.names(name, cached=False) or []:
+            size = sum([int(x.rsplit("-", 1)[1]) for x in runs[-1]])
+            if runs[-1] and size + int(log_name.rsplit("-", 1)[1]) > config.CHANGE_EVENT_SEGMENT_SIZE:
+                runs.append([])
+            runs[-1].append(log_name)
+        runs = [x for x in runs if len(x) > 1]
+        for run in runs:
+            objs = fetch_parallel(self.dao.get, run)
+            if len([x for x in run if objs.get(x)]) < len(run):
+                return False
+            events = [x for log_name in run for x in objs[log_name]["events"]]
+            segment = f"{run[-1].rsplit('-', 2)[0]}-{uuid4().hex[:8]}-{len(events)}"
+            if not self.dao.put(segment, dict(events=events)):
+                return False
+            for log_name in run:
+                self.dao.delete(log_name)
+        event_listings.pop(f"{self.group}/{name}", None)
+        return len(runs) > 0
+
+
+class IndexBatch:
+    # index maintenance in waves instead of a get/update per object: read() fetches the objects of any
+    # groups in one parallel wave, callers change them in memory and set() (or delete()) the ones that changed,
+    # and write() saves every changed object in one parallel wave, adjusting each group's count once.
+    # objects are written conditionally on the version read: one changed with modify() has its changes replayed
+    # on a fresh read when another writer got in between, one that was set() is left out and listed in conflicts
+    def __init__(self):
+        self.objects = {}  # (dao, name) -> data, None if the object does not exist
+        self.versions = {}
+        self.missing = set()
+        self.changed = set()
+        self.changes = {}  # (dao, name) -> [change], see modify()
+        self.conflicts = set()
+        self.deltas = {}  # (log, key) -> {"adds": [...], "removes": [...]}
+
+    def read(self, keys: list[tuple]):
+        keys = [x for x in dict.fromkeys(keys) if x not in self.objects]
+        if keys:
+            # posting logs (see PostingLog) are only appended to, they have no version
+            results = fetch_parallel(
+                lambda key: key[0].read(key[1]) if isinstance(key[0], DAO) else (key[0].get(key[1]), None), keys
+            )
+            for key in keys:
+                self.objects[key], self.versions[key] = results.get(key, (None, ABSENT))
+                if self.objects[key] is None:
+                    self.missing.add(key)
+
+    def get(self, dao, name: str):
+        return self.objects.get((dao, name))
+
+    def set(self, dao, name: str, data: dict):
+        self.changed.add((dao, name))
+        self.objects[(dao, name)] = data
+
+    def delete(self, dao, name: str):
+        self.set(dao, name, None)
+
+    def modify(self, dao, name: str, change):
+        # change(data) returns the changed object, None to delete it (see DAO.modify). it is applied to the object
+        # read now and again to whatever is stored if the write conflicts
+        self.set(dao, name, change(self.get(dao, name)))
+        self.changes.setdefault((dao, name), []).append(change)
+
+    def append(self, log, key: str, adds: list[dict] = [], removes: list[str] = []):
+        # collects the delta of a log structured posting (see PostingLog), written as one delta per posting
+        delta = self.deltas.setdefault((log, key), dict(adds=[], removes=[]))
+        delta["adds"] += adds
+        delta["removes"] += removes
+
+    def save(self, key: tuple):
+        # writes one changed object, returns (written, count change)
+        dao, name = key
+        data = self.objects[key]
+        try:
+            if data is not None:
+                written = dao.put(name, data, version=self.versions.get(key))
+                if isinstance(written, str):
+                    self.versions[key] = written
+                return written, int(key in self.missing)
+            if key in self.missing:
+                return True, 0
+            return dao.delete(name, version=self.versions.get(key)), -1
+        except WriteConflict:
+            if key not in self.changes:
+                self.conflicts.add(key)
+                return True, 0
+
+        def replay(data):
+            for change in self.changes[key]:
+                data = change(data)
+            return data
+
+        # DAO.modify keeps the count itself
+        return dao.modify(name, replay), 0
+
+    def write(self) -> bool:
+        # True if everything was written, conflicts of set() objects aside
+        tasks = {}
+        for key in self.changed:
+            tasks[key] = lambda key=key: self.save(key)
+        for key, delta in self.deltas.items():
+            tasks[key] = lambda key=key, delta=delta: (key[0].append(key[1], **delta), 0)
+        results = fetch_parallel(lambda key: tasks[key](), list(tasks.keys()))
+        counts = {}
+        for key, (_, count) in results.items():
+            counts[key[0]] = counts.get(key[0], 0) + count
+        # counts are adjusted once the writes are in, they depend on who won a conflict
+        counted = fetch_parallel(lambda dao: dao.adjust_count(counts[dao]), [x for x in counts if counts[x]])
+        self.missing = {x for x in self.objects if self.objects[x] is None}
+        self.changed = set()
+        self.changes = {}
+        self.deltas = {}
+        return (
+            len(results) == len(tasks)
+            and all([x[0] is not False for x in results.values()])
+            and all([x is not False for x in counted.values()])
+        )
 
 
 class Grouping:
@@ -486,16 +1122,38 @@ class Grouping:
     def count(self):
         return self.dao.count()
 
+    def is_cached(self, name: str) -> bool:
+        return self.dao.is_cached(name)
+
     def update(self, profile: BaseModel):
         raise Exception("Not implemented")
 
+    def get_many(self, names: list[str], timeout: float = None, late: set = None, get=None) -> dict:
+        # loads several objects at once - cached objects are read inline and the rest are fetched
+        # in parallel; anything not loaded within timeout seconds is left out of the result and added to late.
+        # get loads one object, self.get by default
+        get = get or self.get
+        results = {}
+        misses = []
+        for name in names:
+            if self.is_cached(name):
+                results[name] = get(name)
+            else:
+                misses.append(name)
+        if misses:
+            results.update(fetch_parallel(get, misses, timeout=timeout, late=late))
+        return {k: v for k, v in results.items() if v is not None}
+
 
 class Organizations(Grouping):
     def __init__(self):
-        self.dao = DAO("organizations")
+        self.dao = PatchedDAO("organizations")
+        self.events = ChangeEvents("organizations")
 
     def get(self, name):
-        data = self.dao.get(name)
+        return self.profile(self.dao.get(name))
+
+    def profile(self, data: dict):
         if not data:
             return None
         if "schema" in data and data["schema"].lower() == "ppp":
@@ -511,30 +1169,166 @@ class Organizations(Grouping):
     def count(self):
         return self.dao.count()
 
-    def update(self, organization: OrganizationProfile):
-        name = organization.name
-        data = organization.dict()
-
-        existing_org = self.get(name)
-        increment_count = False
-        if not existing_org:
-            increment_count = True
-
-        # update the word indices
-        for word in list(set([x for x in name.split(" ") if x not in stop_words])):
-            word_data = Words().get(word)
-            if not word_data:
-                word_data = dict(word=word, organizations=[])
-            if name not in word_data["organizations"]:
-                word_data["organizations"].append(name)
-            Words().update(word, word_data)
+    def update(self, organization: OrganizationProfile, previous_name: str = None):
+        # previous_name is the org's name before a rename: the old org leaves its postings and is deleted in
+        # the same batched write that indexes the new name
+        # new change events are appended to the org's log once the org is saved, so a failed save leaves no events
+        # behind that its rating does not have. the document keeps none (see ChangeEvents)
+        events = [x for x in organization.change_events if x not in organization.derived_change_events]
+        organization = organization.copy(update=dict(change_events=[]))
+        changes = {organization.name: organization}
+        renamed = previous_name and previous_name != organization.name
+        if renamed:
+            changes[previous_name] = None
+        if not self.apply(changes):
+            return False
+        if renamed and not self.events.rename(previous_name, organization.name):
+            return False
+        return not events or self.events.append(organization.name, events)
+
+    def delete(self, name: str):
+        return self.apply({name: None}) and self.events.delete(name)
+
+    def apply(self, changes: dict, retries: int = None) -> bool:
+        # saves {name: profile} and deletes {name: None}, keeping the indices in step. the orgs and their
+        # word postings are read in one parallel wave, the index objects those lead to in at most one more,
+        # everything is updated in memory and what changed is written back in one last wave (see IndexBatch).
+        # word and location postings only get small deltas appended (see PostingLog), sketches and phonetic
+        # postings are changed with IndexBatch.modify. an org another writer saved since it was read is applied
+        # again on top of what that writer saved, at most retries times
+        words, sketches, phonetics, locations = Words().log, Sketches().dao, Phonetics().dao, Locations().log
+        word_segments = DAO("words_segments")
+        fields = {x: organization_fields(x) for x in changes}
+        org_words = {x: fields[x]["name"] + fields[x]["dba"] for x in changes}
+        batch = IndexBatch()
+        batch.read([(self.dao, x) for x in changes] + [(words, y) for x in changes for y in org_words[x]])
+        existing = {x: batch.get(self.dao, x) for x in changes}
+        existing_orgs = {x: self.profile(existing[x]) for x in changes}
+
+        # word postings gain the names they are missing and lose deleted ones, with their sketches. words that
+        # enter or leave the vocabulary go in or out of the phonetic postings. a segmented posting (see Words) is
+        # only its header, whether a name is in it is read off the segment the name sorts into
+        postings = {}
+        for name, organization in changes.items():
+            for word in org_words[name]:
+                word_data = postings.get(word) or batch.get(words, word) or dict(word=word, organizations=[])
+                postings[word] = word_data
+        segmented = set([x for x in postings if is_segmented(postings[x])])
+        segment_names = {
+            (x, y): Words().segment_name(postings[y], x) for x in changes for y in org_words[x] if y in segmented
+        }
 
-        return self.dao.update(name, data)
+        def member(name: str, word: str) -> bool:
+            posting = postings[word]
+            if word not in segmented:
+                return name in posting["organizations"]
+            if name in posting.get("added", []) or name in posting.get("removed", []):
+                return name in posting.get("added", [])
+            return name in (batch.get(word_segments, segment_names[(name, word)]) or {}).get("names", [])
+
+        pairs = [(x, y) for x in changes for y in org_words[x] if y not in segmented]
+        added = [(x, y) for x, y in pairs if changes[x] and not member(x, y)]
+        dropped = [(x, y) for x, y in pairs if not changes[x] and member(x, y)]
+        remaining = {x: set(y["organizations"]) for x, y in postings.items() if x not in segmented}
+        for name, word in added:
+            remaining[word].add(name)
+        for name, word in dropped:
+            remaining[word].discard(name)
+        new_vocabulary = [x for x in remaining if batch.get(words, x) is None and remaining[x]]
+        old_vocabulary = [x for x in remaining if batch.get(words, x) is not None and not remaining[x]]
+        token_keys = {}
+        for word in new_vocabulary + old_vocabulary:
+            for token in phonetic_tokens(word):
+                token_keys[token] = Phonetics().keys(token)
+
+        # location postings the orgs move in or out of
+        key_changes = {}
+        for name, organization in changes.items():
+            before = location_keys(existing_orgs[name]) if existing_orgs[name] else set()
+            after = location_keys(organization) if organization else set()
+            key_changes[name] = (after - before, before - after)
+
+        batch.read(
+            [(sketches, x) for x in dict.fromkeys([y for _, y in added + dropped] + sorted(segmented))]
+            + [(word_segments, x) for x in segment_names.values() if x]
+            + [(phonetics, y) for x in token_keys.values() for y in x]
+            + [(locations, y) for x in key_changes.values() for y in x[0] | x[1]]
+        )
+        added += [(x, y) for x, y in segment_names if changes[x] and not member(x, y)]
+        dropped += [(x, y) for x, y in segment_names if not changes[x] and member(x, y)]
+
+        for name, word in dropped:
+            drop_names(postings[word], {name})
+            if batch.get(sketches, word):
+                batch.modify(sketches, word, sketch_change(name, add=False))
+            batch.append(words, word, removes=[name])
+        for name, organization in [x for x in changes.items() if x[1]]:
+            impact = rating_impact(organization.antisocial_rating)
+            for word in org_words[name]:
+                word_data = postings[word]
+                changed = (name, word) in added
+                if changed and word in segmented:
+                    # a missing sketch of a segmented posting is left to the compactor
+                    if batch.get(sketches, word):
+                        batch.modify(sketches, word, sketch_change(name, add=True))
+                elif changed:
+                    batch.modify(sketches, word, sketch_change(name, add=True, posting=word_data))
+                    word_data["organizations"].append(name)
+                changed = set_impact(word_data, name, impact) or changed
+                changed = set_field(word_data, "dba", name, word in fields[name]["dba"]) or changed
+                if changed:
+                    batch.append(words, word, adds=[dict(name=name, impact=impact, dba=word in fields[name]["dba"])])
+        # emptied postings are deleted by the compactor
+        for word in old_vocabulary:
+            batch.modify(sketches, word, lambda sketch: None)
+
+        for word in new_vocabulary + old_vocabulary:
+            for token in phonetic_tokens(word):
+                for key in token_keys[token]:
+                    phonetic_words = (batch.get(phonetics, key) or {}).get("words", [])
+                    if (word in new_vocabulary) != (token in phonetic_words):
+                        batch.modify(phonetics, key, Phonetics().change(key, "words", token, word in new_vocabulary))
+
+        for name, (add_keys, rm_keys) in key_changes.items():
+            for key in add_keys | rm_keys:
+                location_names = (batch.get(locations, key) or {}).get("organizations", [])
+                if key in add_keys and name not in location_names:
+                    batch.append(locations, key, adds=[dict(name=name)])
+                elif key in rm_keys and name in location_names:
+                    batch.append(locations, key, removes=[name])
+
+        # the orgs themselves, merged into the stored object like DAO.update does
+        for name, organization in changes.items():
+            if organization:
+                batch.set(self.dao, name, {**(existing[name] or {}), **organization.dict()})
+            elif existing[name] is not None:
+                batch.delete(self.dao, name)
+        written = batch.write()
+        conflicts = {x: changes[x] for x in changes if (self.dao, x) in batch.conflicts}
+
+        # update the tag postings
+        for name, organization in [x for x in changes.items() if x[0] not in conflicts]:
+            existing_tags = set(existing_orgs[name].tags) if existing_orgs[name] else set()
+            new_tags = set(organization.tags) if organization else set()
+            for tag in new_tags - existing_tags:
+                Tags().add_profile(tag, name, profile_type="organization")
+            for tag in existing_tags - new_tags:
+                Tags().rm_profile(tag, name, profile_type="organization")
+
+        if conflicts:
+            retries = config.WRITE_CONFLICT_RETRIES if retries is None else retries
+            if retries <= 0:
+                current_app.logger.error(f"Giving up on conflicting writes of organizations {list(conflicts)}")
+                return False
+            backoff(config.WRITE_CONFLICT_RETRIES - retries)
+            return self.apply(conflicts, retries - 1) and written
+        return written
 
 
 class Users(Grouping):
     def __init__(self):
-        self.dao = DAO("users")
+        self.dao = PatchedDAO("users")
+        self.events = ChangeEvents("users")
 
     def get(self, name: str) -> UserProfile:
         data = self.dao.get(name)
@@ -572,21 +1366,144 @@ class Users(Grouping):
         for tag in existing_tags - new_tags:
             Tags().rm_profile(tag, user_profile.name)
 
-        # update the user profile
+        # update the flag and tag bitmaps
+        UserBitmaps().update_profile(user_profile, existing_user_profile)
+
+        # new usernames go into the phonetic postings
+        if existing_user_profile is None:
+            Phonetics().add("users", user_profile.name)
+
+        # update the user profile, the document keeps no change events (see ChangeEvents)
         name = user_profile.name
         data = user_profile.dict()
-        return self.dao.update(name, data)
+        data["change_events"] = []
+        if not self.dao.update(name, data):
+            return False
+
+        # new change events are appended to the user's log once the profile is saved, so a failed save leaves no
+        # events behind that its rating does not have
+        return self.events.append(name, user_profile.change_events)
 
     def delete(self, user_profile: UserProfile):
         # delete the user profile
         name = user_profile.name
-        return self.dao.rm(name)
+        UserBitmaps().remove_profile(name)
+        Phonetics().rm("users", name)
+        return self.dao.rm(name) and self.events.delete(name)
 
     def users(self):
         # loads all users
         return [self.get(x) for x in self.ls()]
 
 
+def user_bitmap_keys(profile: UserProfile) -> set[str]:
+    keys = set(["all", f"create_method:{profile.create_method}"])
+    for flag in ["is_blocked", "is_active", "is_premium_user", "is_admin"]:
+        if getattr(profile, flag):
+            keys.add(flag)
+    for tag in profile.tags:
+        keys.add(f"tag:{tag}")
+    return keys
+
+
+class UserBitmaps(Grouping):
+    # bitmap indexes over user doc ids for the profile flags, create method and tags, kept in one object:
+    # {"names": [user name by doc id], "bitmaps": {"is_admin": ..., "create_method:manual": ..., "tag:x": ...}}
+    # doc ids are never reused, a deleted user's slot is set to None. the object is built by build-user-bitmaps
+    # and changed with DAO.modify, a change is applied again to what another writer saved meanwhile
+    def __init__(self):
+        self.dao = DAO("bitmaps")
+        self.name = "users"
+        self.names = None
+        self.ids = None
+        self.bitmaps = None
+        self.missing = False
+
+    def load(self):
+        if self.names is not None or self.missing:
+            return
+        data = self.dao.get(self.name)
+        if data is None:
+            # not built yet, callers fall back to loading the profiles
+            self.missing = True
+            return
+        self.set_data(data)
+
+    def set_data(self, data: dict):
+        self.names = data["names"]
+        self.ids = {name: idx for idx, name in enumerate(self.names) if name is not None}
+        self.bitmaps = {k: Bitmap.load(v) for k, v in data["bitmaps"].items()}
+        self.missing = False
+
+    def data(self) -> dict:
+        return dict(names=self.names, bitmaps={k: v.dump() for k, v in self.bitmaps.items() if len(v)})
+
+    def available(self) -> bool:
+        self.load()
+        return not self.missing
+
+    def save(self, change) -> bool:
+        # change() changes this instance, it is applied to the stored object as read for the write. bitmaps that
+        # are not built are left alone
+        def modify(data):
+            if data is None:
+                self.missing = True
+                return None
+            self.set_data(data)
+            change()
+            return self.data()
+
+        return self.dao.modify(self.name, modify)
+
+    def doc_id(self, name: str) -> int:
+        if name not in self.ids:
+            self.ids[name] = len(self.names)
+            self.names.append(name)
+        return self.ids[name]
+
+    def set_keys(self, doc_id: int, add: set, remove: set = set()) -> bool:
+        changed = False
+        for key in add:
+            changed = self.bitmaps.setdefault(key, Bitmap()).add(doc_id) or changed
+        for key in remove:
+            if key in self.bitmaps:
+                changed = self.bitmaps[key].discard(doc_id) or changed
+        return changed
+
+    def get(self, key: str) -> Bitmap:
+        self.load()
+        return self.bitmaps.get(key, Bitmap())
+
+    def count(self, key: str) -> int:
+        return len(self.get(key))
+
+    def profile_names(self, bitmap: Bitmap) -> list[str]:
+        self.load()
+        return [self.names[x] for x in bitmap if self.names[x] is not None]
+
+    def update_profile(self, profile: UserProfile, existing_profile: UserProfile = None):
+        if not self.available():
+            return True
+        existing_keys = user_bitmap_keys(existing_profile) if existing_profile else set()
+        new_keys = user_bitmap_keys(profile)
+        if profile.name in self.ids and new_keys == existing_keys:
+            return True
+        added, removed = new_keys - existing_keys, existing_keys - new_keys
+        return self.save(lambda: self.set_keys(self.doc_id(profile.name), added, removed))
+
+    def remove_profile(self, name: str):
+        if not self.available() or name not in self.ids:
+            return True
+
+        def change():
+            if name in self.ids:
+                doc_id = self.ids.pop(name)
+                self.set_keys(doc_id, set(), set(self.bitmaps.keys()))
+                self.names[doc_id] = None
+
+        return self.save(change)
+
+
 class AccessTokens(Grouping):
     def __init__(self):
         self.dao = DAO("access_tokens")
@@ -707,8 +1624,160 @@ class SocialMediaPlatforms(Grouping):
 
 
 class Words(Grouping):
+    # word postings are log structured (see PostingLog): head() merges the base posting with its deltas.
+    # postings of more than WORD_SEGMENT_THRESHOLD names are split into sorted segments (see SegmentedPostings)
+    # when they are compacted, the base object becomes the segments' header and keeps only the dba list and
+    # the IMPACT_HEAD highest rated names of the impacts, the rest of them go to the word's impact tail object
+    # {"word": "roofing", "impacts": [...]}. get() loads every segment and the tail, page() and intersect() only
+    # the segments they need
     def __init__(self):
         self.dao = DAO("words")
+        self.impacts = DAO("words_impacts")
+        self.log = PostingLog("words", key_field="word", save=self.save)
+
+    def get(self, word: str) -> dict:
+        # the full posting
+        return self.expand(self.head(word))
+
+    def head(self, word: str) -> dict:
+        # the posting without the names of a segmented one
+        return self.log.get(word)
+
+    def heads(self, words: list[str], timeout: float = None, late: set = None) -> dict:
+        return self.get_many(words, timeout=timeout, late=late, get=self.head)
+
+    def is_cached(self, word: str) -> bool:
+        return self.log.is_cached(word)
+
+    def update(self, word: str, data: dict):
+        if is_segmented(data):
+            data = {k: v for k, v in data.items() if k not in ["organizations", "added", "removed"]}
+            self.save_impacts(word, data)
+        self.dao.update(word, data)
+
+    def segments(self, posting: dict) -> "SegmentedPostings":
+        return SegmentedPostings("words", posting["word"], header=posting)
+
+    def segment_name(self, posting: dict, name: str) -> str:
+        # the segment object name would be in
+        segments = self.segments(posting)
+        if not segments.header()["segments"]:
+            return None
+        return segments.segment_name(segments.header()["segments"][segments.segment_for(name)]["id"])
+
+    def expand(self, posting: dict) -> dict:
+        if posting and is_segmented(posting) and "organizations" not in posting:
+            removed = set(posting.get("removed", []))
+            names = [x for x in self.segments(posting).all() if x not in removed]
+            posting["organizations"] = names + [x for x in posting.get("added", []) if x not in names]
+            # the impacts past the head, of names still in the posting whose impact the head does not have
+            tail = (self.impacts.get(posting["word"]) or {}).get("impacts", [])
+            if tail:
+                members = set(posting["organizations"])
+                seen = set([x for _, names in posting.get("impacts", []) for x in names])
+                buckets = {x: list(y) for x, y in posting.get("impacts", [])}
+                for impact, names in tail:
+                    names = [x for x in names if x in members and x not in seen]
+                    if names:
+                        buckets.setdefault(impact, []).extend(names)
+                posting["impacts"] = sorted([[x, y] for x, y in buckets.items()], key=lambda x: -x[0])
+        return posting
+
+    def pending(self, posting: dict) -> tuple[list[str], list[str]]:
+        # (added, removed) of a segmented posting's deltas not compacted yet, as changes to its segments: the added
+        # names they do not hold and the removed ones they do. a rating change re-adds a name they hold
+        added, removed = set(posting.get("added", [])), set(posting.get("removed", []))
+        held = self.segments(posting).intersect(added | removed) if added or removed else set()
+        return sorted(added - held), sorted(removed & held)
+
+    def total(self, posting: dict) -> int:
+        # the number of names page() goes through, deltas not compacted yet included
+        if not is_segmented(posting):
+            return len(posting["organizations"])
+        added, removed = self.pending(posting)
+        return posting["count"] + len(added) - len(removed)
+
+    def page(self, posting: dict, start: int, length: int) -> list[str]:
+        # names [start, start + length) of a segmented posting in sorted order, with the deltas not compacted yet
+        # merged in (see total). the segment names of the page are at most len(added) before start and len(removed)
+        # past its end, the added names that sort among them are merged in and base is the position of the first
+        added, removed = self.pending(posting)
+        removed = set(removed)
+        count = posting["count"]
+        lo = max(0, start - len(added))
+        hi = min(count, start + length + len(removed))
+        names = self.segments(posting).range(lo, hi - lo) if lo < hi else []
+        if lo and not names:
+            return []
+        first = names[0] if lo else ""
+        last = names[-1] if hi < count else None
+        base = lo - len([x for x in removed if x < first]) + len([x for x in added if x < first])
+        merged = [x for x in names if x not in removed]
+        merged += [x for x in added if x >= first and (last is None or x <= last)]
+        merged.sort()
+        return merged[start - base : start - base + length]
+
+    def intersect(self, posting: dict, names: set) -> set:
+        if not is_segmented(posting):
+            return names.intersection(posting["organizations"])
+        found = self.segments(posting).intersect(names) - set(posting.get("removed", []))
+        return found | names.intersection(posting.get("added", []))
+
+    def save(self, word: str, posting: dict) -> bool:
+        # writes a compacted posting (see PostingLog.compact): a segmented posting rewrites only the segments
+        # its changes fall in, a posting that outgrew WORD_SEGMENT_THRESHOLD is split
+        removed = []
+        if is_segmented(posting):
+            segments = self.segments(posting)
+            removed = posting.pop("removed", [])
+            for name in removed:
+                segments.remove(name)
+            for name in posting.pop("added", []):
+                segments.add(name)
+        elif len(posting["organizations"]) > config.WORD_SEGMENT_THRESHOLD:
+            self.segments(posting).replace(posting.pop("organizations"))
+        else:
+            return self.dao.put(word, posting)
+        posting.pop("organizations", None)
+        if not self.save_impacts(word, posting, removed):
+            return False
+        return self.dao.put(word, posting)
+
+    def save_impacts(self, word: str, posting: dict, removed: list[str] = []) -> bool:
+        # trims the impacts of a segmented posting to the head and moves what is cut off to the impact tail. the
+        # head keeps whole buckets, every name in the tail ranks below every name in the head
+        head = impact_head(posting.get("impacts", []))
+        tail = posting.get("impacts", [])[len(head) :]
+        posting["impacts"] = head
+        if not tail and not removed:
+            return True
+        head_names = set([x for _, names in head for x in names])
+        removed = set(removed)
+
+        def change(data):
+            impacts = {y: x for x, names in (data or {}).get("impacts", []) for y in names}
+            impacts.update({y: x for x, names in tail for y in names})
+            buckets = {}
+            for name, impact in impacts.items():
+                if name not in head_names and name not in removed:
+                    buckets.setdefault(impact, []).append(name)
+            return dict(word=word, impacts=sorted([[x, y] for x, y in buckets.items()], key=lambda x: -x[0]))
+
+        return self.impacts.modify(word, change)
+
+    def avg_name_length(self) -> float:
+        # average number of tokens in an indexed organization name, used for bm25 length normalization
+        metadata = self.dao.load_metadata()
+        if metadata and "avg_name_length" in metadata:
+            return metadata["avg_name_length"]
+        return None
+
+
+class Sketches(Grouping):
+    # a small sketch of every word posting for estimated result counts (see sketch.py),
+    # {"word": "roofing", "count": 1234, "hashes": [...]}
+    def __init__(self):
+        self.dao = DAO("sketches")
 
     def get(self, word: str) -> dict:
         data = self.dao.get(word)
@@ -720,7 +1789,557 @@ class Words(Grouping):
         self.dao.update(word, data)
 
 
+class Phonetics(Grouping):
+    # phonetic postings, {"key": "JN", "words": ["john", "jon"], "users": ["jon_smith"]}: the indexed words and
+    # the usernames with a word whose double metaphone key (see phonetic.py) is key
+    def __init__(self):
+        self.dao = DAO("phonetics")
+
+    def get(self, key: str) -> dict:
+        data = self.dao.get(key)
+        if data:
+            return data
+        return None
+
+    def update(self, key: str, data: dict):
+        self.dao.update(key, data)
+
+    def keys(self, name: str) -> set[str]:
+        keys = set()
+        for token in [x for x in phonetic_tokens(name) if x not in STOP_WORDS]:
+            keys.update(phonetic_keys(token))
+        return keys
+
+    def change(self, key: str, field: str, name: str, add: bool):
+        # a change (see DAO.modify) adding name to or removing it from a field of the posting at key
+        def change(data):
+            data = data or dict(key=key, words=[], users=[])
+            names = data.setdefault(field, [])
+            if add and name not in names:
+                names.append(name)
+            elif not add and name in names:
+                names.remove(name)
+            return data
+
+        return change
+
+    def add(self, field: str, name: str):
+        for key in self.keys(name):
+            if name not in (self.get(key) or {}).get(field, []):
+                self.dao.modify(key, self.change(key, field, name, True))
+
+    def rm(self, field: str, name: str):
+        for key in self.keys(name):
+            if name in (self.get(key) or {}).get(field, []):
+                self.dao.modify(key, self.change(key, field, name, False))
+
+
+# word postings carry the antisocial rating of each org quantized into "impacts", a list of
+# [impact, [names]] ordered by impact descending, so the highest rated matches of a query can be
+# read off the front of a posting without loading any organization
+IMPACT_STEPS = 8  # buckets per doubling of the rating
+
+
+def rating_impact(rating: int) -> int:
+    if not rating or rating <= 0:
+        return 0
+    return int(log2(rating + 1) * IMPACT_STEPS)
+
+
+def set_impact(word_data: dict, name: str, impact: int) -> bool:
+    # moves name to the impact bucket, returns False if it was already there
+    impacts = word_data.setdefault("impacts", [])
+    for entry in impacts:
+        if name in entry[1]:
+            if entry[0] == impact:
+                return False
+            entry[1].remove(name)
+            break
+    for entry in impacts:
+        if entry[0] == impact:
+            entry[1].append(name)
+            break
+    else:
+        impacts.append([impact, [name]])
+    word_data["impacts"] = sorted([x for x in impacts if x[1]], key=lambda x: -x[0])
+    return True
+
+
+def drop_names(word_data: dict, names: set) -> bool:
+    # removes names from a word or location posting and its impact and field lists, returns False if none were in
+    # its names
+    found = bool(names.intersection(word_data.get("organizations", [])))
+    if found:
+        word_data["organizations"] = [x for x in word_data["organizations"] if x not in names]
+    if "impacts" in word_data:
+        impacts = [[x[0], [y for y in x[1] if y not in names]] for x in word_data["impacts"]]
+        word_data["impacts"] = [x for x in impacts if x[1]]
+    if "dba" in word_data:
+        word_data["dba"] = [x for x in word_data["dba"] if x not in names]
+    return found
+
+
+def sketch_change(name: str, add: bool, posting: dict = None):
+    # a change (see IndexBatch.modify) adding name to or removing it from a word's sketch. a missing sketch is
+    # built from the names posting has now, or left missing without a posting
+    names = list(posting["organizations"]) if posting else None
+
+    def change(sketch):
+        if sketch is None and names is not None:
+            sketch = dict(word=posting["word"], **build_sketch(names, config.SKETCH_SIZE))
+        if sketch and add:
+            sketch_add(sketch, name, config.SKETCH_SIZE)
+        elif sketch:
+            sketch_rm(sketch, name)
+        return sketch
+
+    return change
+
+
+def impact_head(impacts: list, limit: int = None) -> list:
+    # the highest impact buckets holding the first limit names, what a segmented posting keeps of its impacts
+    limit = limit or config.IMPACT_HEAD
+    head = []
+    count = 0
+    for impact, names in impacts:
+        if count >= limit:
+            break
+        head.append([impact, names])
+        count += len(names)
+    return head
+
+
+def set_field(word_data: dict, field: str, name: str, in_field: bool) -> bool:
+    # word postings list the orgs that only have the word in a secondary field, e.g. "dba": [names], so
+    # ranked search can weight those matches lower; returns True if the posting changed
+    names = word_data.get(field, [])
+    if in_field == (name in names):
+        return False
+    if in_field:
+        word_data[field] = names + [name]
+    else:
+        word_data[field] = [x for x in names if x != name]
+    return True
+
+
+def impact_order(word_data: dict):
+    # yields (impact, names) from the highest impact down; names missing from the impacts come last
+    seen = set()
+    for impact, names in word_data.get("impacts", []):
+        seen.update(names)
+        yield impact, names
+    rest = [x for x in word_data.get("organizations", []) if x not in seen]
+    if rest:
+        yield -1, rest
+
+
+def normalize_location(value: str) -> str:
+    return " ".join((value or "").lower().split())
+
+
+def location_keys(profile) -> set[str]:
+    # the location postings an organization belongs to: state, city, 3 and 5 digit zip prefixes and the
+    # words of the street names
+    keys = set()
+    for address in profile.physical_addresses:
+        for token in street_tokens(address.street1):
+            keys.add(f"street:{token}")
+        state = normalize_location(address.state)
+        city = normalize_location(address.city)
+        postal_code = "".join([x for x in (address.postal_code or "") if x.isdigit()])
+        if state:
+            keys.add(f"state:{state}")
+        if city:
+            keys.add(f"city:{city}")
+        if len(postal_code) >= 3:
+            keys.add(f"zip3:{postal_code[:3]}")
+        if len(postal_code) >= 5:
+            keys.add(f"zip5:{postal_code[:5]}")
+    return keys
+
+
+class Locations(Grouping):
+    # location postings, stored like the word postings: {"key": "state:tx", "organizations": [...]}
+    def __init__(self):
+        self.dao = DAO("locations")
+        self.log = PostingLog("locations")
+
+    def get(self, key: str) -> dict:
+        return self.log.get(key)
+
+    def is_cached(self, key: str) -> bool:
+        return self.log.is_cached(key)
+
+    def update(self, key: str, data: dict):
+        self.dao.update(key, data)
+
+    def add(self, key: str, name: str):
+        data = self.get(key) or dict(key=key, organizations=[])
+        if name not in data["organizations"]:
+            data["organizations"].append(name)
+            self.update(key, data)
+
+    def rm(self, key: str, name: str):
+        data = self.get(key)
+        if data and name in data["organizations"]:
+            data["organizations"].remove(name)
+            self.update(key, data)
+
+
+# log structured postings: a base object, {"key": "roofing", "organizations": [...], ...}, plus small immutable
+# deltas stored as {group}_deltas/{key}/{time_ns}-{random}, {"adds": [{"name": ..., "impact": ..., "dba": ...}],
+# "removes": [names]}. writers append a delta instead of rewriting the whole posting, so a write costs the size
+# of the change and two writers never overwrite each other. readers merge the base with the deltas in name
+# (time) order - deltas never change so they are cached like any object, only the listing expires after
+# INDEX_DELTA_LISTING_TTL seconds - and compact-postings folds the deltas into the base. replaying a delta the
+# base already holds is a no-op, so readers are correct while a compaction is between writing and deleting
+delta_listings = {}  # "group/key" -> (listed at, delta names)
+
+
+def is_segmented(posting: dict) -> bool:
+    return "segments" in posting
+
+
+def posting_count(posting: dict) -> int:
+    # without reading segments: the names re-added by a rating change are counted twice until compacted, see
+    # Words.total for the exact count
+    if is_segmented(posting):
+        return posting["count"] + len(posting.get("added", [])) - len(posting.get("removed", []))
+    return len(posting.get("organizations", []))
+
+
+def apply_delta(posting: dict, delta: dict) -> dict:
+    # a segmented posting (see Words) is only the header, its names changes are kept in "added" and "removed"
+    removes = set(delta.get("removes", []))
+    drop_names(posting, removes)
+    if is_segmented(posting):
+        posting["added"] = [x for x in posting.get("added", []) if x not in removes]
+        adds = set([x["name"] for x in delta.get("adds", [])])
+        posting["removed"] = [x for x in posting.get("removed", []) if x not in adds] + sorted(removes)
+    for add in delta.get("adds", []):
+        name = add["name"]
+        if is_segmented(posting):
+            if name not in posting["added"]:
+                posting["added"].append(name)
+        elif name not in posting["organizations"]:
+            posting["organizations"].append(name)
+        if add.get("impact") is not None:
+            set_impact(posting, name, add["impact"])
+        if add.get("dba") is not None:
+            set_field(posting, "dba", name, add["dba"])
+    return posting
+
+
+class PostingLog:
+    def __init__(self, group: str, key_field: str = "key", save=None):
+        # save(key, posting) writes a compacted posting, a plain put of the base by default
+        self.group = group
+        self.key_field = key_field
+        self.base = DAO(group)
+        self.deltas = DAO(f"{group}_deltas")
+        self.save = save or self.base.put
+
+    def delta_name(self, obj: dict) -> str:
+        # "{key}/{time_ns}-{random}" from a listed delta object
+        return self.deltas.name_of(obj["Key"])
+
+    def delta_names(self, key: str) -> list[str]:
+        listing = delta_listings.get(f"{self.group}/{key}")
+        if listing and time() - listing[0] < config.INDEX_DELTA_LISTING_TTL:
+            return listing[1]
+        names = sorted([self.delta_name(x) for x in self.deltas.ls(prefix=f"{key}/") or []])
+        delta_listings[f"{self.group}/{key}"] = (time(), names)
+        return names
+
+    def is_cached(self, key: str) -> bool:
+        listing = delta_listings.get(f"{self.group}/{key}")
+        if not listing or time() - listing[0] >= config.INDEX_DELTA_LISTING_TTL:
+            return False
+        return self.base.is_cached(key) and all([self.deltas.is_cached(x) for x in listing[1]])
+
+    def get(self, key: str, deltas: list[str] = None) -> dict:
+        # the merged posting, None if it does not exist or is empty
+        deltas = self.delta_names(key) if deltas is None else deltas
+        posting = self.base.get(key)
+        if posting is None and not deltas:
+            return None
+        posting = posting or {self.key_field: key, "organizations": []}
+        for name in deltas:
+            delta = self.deltas.get(name)
+            if delta:
+                apply_delta(posting, delta)
+        return posting if is_segmented(posting) or posting["organizations"] else None
+
+    def append(self, key: str, adds: list[dict] = [], removes: list[str] = []) -> bool:
+        name = f"{key}/{time_ns():020d}-{uuid4().hex[:8]}"
+        if not self.deltas.put(name, dict(adds=adds, removes=removes)):
+            return False
+        listing = delta_listings.get(f"{self.group}/{key}")
+        if listing:
+            delta_listings[f"{self.group}/{key}"] = (listing[0], listing[1] + [name])
+        return True
+
+    def pending(self) -> dict:
+        # {key: delta names} of every posting with deltas, for the compactor
+        keys = {}
+        for name in [self.delta_name(x) for x in self.deltas.ls() or []]:
+            keys.setdefault(name.rsplit("/", 1)[0], []).append(name)
+        return {x: sorted(y) for x, y in keys.items()}
+
+    def compact(self, key: str, deltas: list[str] = None) -> bool:
+        # folds the deltas into the base, an emptied posting is deleted. deltas appended meanwhile are left for
+        # the next run. only one compactor may run at a time (see compact-postings)
+        deltas = self.delta_names(key) if deltas is None else deltas
+        if not deltas:
+            return False
+        posting = self.get(key, deltas=deltas)
+        if posting:
+            if not self.save(key, posting):
+                return False
+        elif self.base.get(key) is not None and not self.base.delete(key):
+            return False
+        for name in deltas:
+            self.deltas.delete(name)
+        delta_listings.pop(f"{self.group}/{key}", None)
+        return True
+
+
+# sorted posting lists split into segments of about POSTING_SEGMENT_SIZE names. a small header object
+# lists the segments in order with their first name and size:
+#   {"key": "organization:ppp", "count": 123456, "next_id": 42, "segments": [{"id": 0, "first": "A", "count": 5000}]}
+# and each segment is its own object, {"names": [...]}. readers fetch the header and then only the segments
+# they need - a page at any offset costs the header plus one or two segments - and writers rewrite only
+# the segment that changed and the header.
+# the header is the posting's version: writers read it with its version and write it conditionally (see
+# DAO.read), a changed segment is copied on write to a new object that only becomes visible with the header, so
+# a writer that loses the race has changed nothing anybody can see, deletes its copies and tries again
+class SegmentedPostings:
+    def __init__(self, group: str, key: str, segment_size: int = None, header: dict = None):
+        # header is an already loaded header object, it can carry fields of its own that are written back with it.
+        # a header passed in is written as is, its caller makes sure nobody else writes it (see Words.save)
+        self.group = group
+        self.key = key
+        self.segment_size = segment_size or config.POSTING_SEGMENT_SIZE
+        self.headers = DAO(group)
+        self.segments = DAO(f"{group}_segments")
+        self._header = header
+        self.conditional = header is None
+        self.version = None  # of the header as read by load_header
+        self.stored_ids = set()  # segments the header had when it was read, copied on write
+        self.written = []  # segments written for the header
+        self.replaced = []  # segments to delete once the header is written
+        self.failed = False  # a segment or the header could not be written
+        if header is not None:
+            for field, value in dict(key=key, count=0, next_id=0, segments=[]).items():
+                header.setdefault(field, value)
+
+    def segment_name(self, segment_id: int) -> str:
+        return f"{self.key}/{segment_id}"
+
+    def header(self) -> dict:
+        if self._header is None:
+            self._header = self.headers.get(self.key) or dict(key=self.key, count=0, next_id=0, segments=[])
+        return self._header
+
+    def load_header(self) -> dict:
+        # the header to change, read with its version
+        if self.conditional and self.version is None:
+            data, self.version = self.headers.read(self.key)
+            self._header = data or dict(key=self.key, count=0, next_id=0, segments=[])
+            self.stored_ids = set([x["id"] for x in self._header["segments"]])
+        return self.header()
+
+    def commit(self, change):
+        # runs change(), again on a fresh header if another writer changed the posting meanwhile. False if it could
+        # not be written, a header passed in is then put back as it was
+        def attempt():
+            before = deepcopy(self._header) if not self.conditional else None
+            try:
+                result = change()
+            except WriteConflict:
+                self._header, self.version = None, None
+                raise
+            if self.failed:
+                self.failed = False
+                if before is not None:
+                    self._header.clear()
+                    self._header.update(before)
+                else:
+                    self._header, self.version = None, None
+                return False
+            return result
+
+        return retry_conflicts(attempt)
+
+    def exists(self) -> bool:
+        return self.headers.get(self.key) is not None
+
+    def count(self) -> int:
+        return self.header()["count"]
+
+    def load_segment(self, segment: dict) -> list[str]:
+        data = self.segments.get(self.segment_name(segment["id"]))
+        return data["names"] if data else []
+
+    def load_segments(self, segments: list[dict]) -> list[list[str]]:
+        ids = [x["id"] for x in segments]
+        loaded = fetch_parallel(lambda x: self.load_segment(dict(id=x)), ids, timeout=config.SEARCH_FETCH_TIMEOUT)
+        return [loaded.get(x, []) for x in ids]
+
+    def all(self) -> list[str]:
+        names = []
+        for segment_names in self.load_segments(self.header()["segments"]):
+            names.extend(segment_names)
+        return names
+
+    def range(self, start: int, length: int) -> list[str]:
+        # names [start, start + length) in sorted order
+        needed = []
+        offset = 0
+        for segment in self.header()["segments"]:
+            if offset + segment["count"] > start and offset < start + length:
+                needed.append((offset, segment))
+            offset += segment["count"]
+        names = []
+        for (offset, _), segment_names in zip(needed, self.load_segments([x[1] for x in needed])):
+            names.extend(segment_names[max(0, start - offset) : start + length - offset])
+        return names
+
+    def segment_for(self, name: str) -> int:
+        # index of the segment that holds or would hold name
+        firsts = [x["first"] for x in self.header()["segments"]]
+        return max(0, bisect_right(firsts, name) - 1)
+
+    def intersect(self, names: set) -> set:
+        # the names that are in this posting, fetching only the segments they would be in
+        segments = self.header()["segments"]
+        if not segments or not names:
+            return set()
+        needed = sorted(set([self.segment_for(x) for x in names]))
+        found = set()
+        for segment_names in self.load_segments([segments[x] for x in needed]):
+            found.update(names.intersection(segment_names))
+        return found
+
+    def write_segment(self, segment: dict, names: list[str]):
+        if segment["id"] in self.stored_ids:
+            # copy on write
+            self.replaced.append(segment["id"])
+            segment["id"] = self.new_id()
+        segment["first"] = names[0]
+        segment["count"] = len(names)
+        self.written.append(segment["id"])
+        if not self.segments.put(self.segment_name(segment["id"]), dict(names=names)):
+            self.failed = True
+
+    def drop_segment(self, idx: int):
+        self.replaced.append(self.header()["segments"].pop(idx)["id"])
+
+    def write_header(self):
+        # a header read by load_header is only written if it is still at the version read, otherwise the segments
+        # written for it are deleted again and WriteConflict raised. replaced segments are deleted once it is in
+        header = self.header()
+        header["count"] = sum([x["count"] for x in header["segments"]])
+        written, replaced = self.written, self.replaced
+        self.written, self.replaced = [], []
+        try:
+            if self.failed:
+                # a header pointing at a segment that is not there would lose its names
+                saved = False
+            elif self.conditional:
+                saved = self.headers.put(self.key, header, version=self.version)
+                if saved and self.version == ABSENT:
+                    self.headers.adjust_count(1)
+                self.version = saved if isinstance(saved, str) else None
+                self.stored_ids = set([x["id"] for x in header["segments"]])
+            else:
+                saved = self.headers.put(self.key, header)
+        except WriteConflict:
+            saved = None
+        if not saved:
+            fetch_parallel(lambda x: self.segments.delete(self.segment_name(x)), written)
+            if saved is None:
+                raise WriteConflict(f"{self.group} {self.key}")
+            self.failed = True
+            return False
+        fetch_parallel(lambda x: self.segments.delete(self.segment_name(x)), replaced)
+        return True
+
+    def add(self, name: str) -> bool:
+        def change():
+            header = self.load_header()
+            if not header["segments"]:
+                header["segments"].append(dict(id=self.new_id(), first=name, count=0))
+            idx = self.segment_for(name)
+            segment = header["segments"][idx]
+            names = self.load_segment(segment)
+            pos = bisect_right(names, name)
+            if pos > 0 and names[pos - 1] == name:
+                return False
+            names.insert(pos, name)
+            if len(names) > 2 * self.segment_size:
+                # split a full segment in two, the new half gets its own object
+                new_segment = dict(id=self.new_id(), first=None, count=0)
+                header["segments"].insert(idx + 1, new_segment)
+                self.write_segment(new_segment, names[self.segment_size :])
+                names = names[: self.segment_size]
+            self.write_segment(segment, names)
+            return self.write_header()
+
+        return self.commit(change)
+
+    def remove(self, name: str) -> bool:
+        def change():
+            header = self.load_header()
+            if not header["segments"]:
+                return False
+            idx = self.segment_for(name)
+            segment = header["segments"][idx]
+            names = self.load_segment(segment)
+            if name not in names:
+                return False
+            names.remove(name)
+            if names:
+                self.write_segment(segment, names)
+            else:
+                self.drop_segment(idx)
+            return self.write_header()
+
+        return self.commit(change)
+
+    def new_id(self) -> int:
+        if self.conditional:
+            # writers racing on one header must not pick the same id for their copies
+            return uuid4().int >> 64
+        header = self.header()
+        header["next_id"] = header.get("next_id", 0) + 1
+        return header["next_id"] - 1
+
+    def replace(self, names):
+        # bulk (re)write of the whole posting, segments are written in parallel
+        names = sorted(set(names))
+
+        def change():
+            header = self.load_header()
+            old_ids = [x["id"] for x in header["segments"]]
+            chunks = [names[x : x + self.segment_size] for x in range(0, len(names), self.segment_size)]
+            segments = [dict(id=self.new_id(), first=None, count=0) for _ in chunks]
+            fetch_parallel(lambda x: self.write_segment(segments[x], chunks[x]), list(range(len(chunks))))
+            header["segments"] = segments
+            self.replaced += old_ids
+            return self.write_header() and len(names)
+
+        return self.commit(change)
+
+    def delete(self):
+        fetch_parallel(lambda x: self.segments.rm(self.segment_name(x["id"])), self.header()["segments"])
+        self.headers.rm(self.key)
+        self._header = None
+
+
 class Tags(Grouping):
+    # tag names and descriptions live in "tags", the profiles carrying a tag in one segmented posting per
+    # profile type, e.g. tag_postings/user:beta and tag_postings/organization:ppp
     def __init__(self):
         self.dao = DAO("tags")
 
@@ -734,32 +2353,51 @@ class Tags(Grouping):
         self.dao.update(name, data)
 
     def add(self, name: str, description: str = None) -> bool:
-        tag_data = self.get(name)
-        if tag_data is None:
-            tag_data = dict(name=name, profiles=[])
-            if description:
-                tag_data["description"] = description
-
-    def add_profile(self, name: str, profile_name: str) -> bool:
-        tag_data = self.get(name)
-        if profile_name not in tag_data["profiles"]:
-            tag_data["profiles"].append(profile_name)
-            self.dao.update(name, tag_data)
+        # False if the tag exists, also when another request is creating it right now
+        if self.get(name) is not None:
+            return False
+        try:
+            if not self.dao.put(name, dict(name=name, description=description), version=ABSENT):
+                return False
+        except WriteConflict:
+            return False
+        return self.dao.adjust_count(1) is not False
+
+    def postings(self, name: str, profile_type: str = "user") -> SegmentedPostings:
+        # read only, tags from before the postings were segmented are moved over by build-tag-postings or by the
+        # first add_profile/rm_profile on them
+        return SegmentedPostings("tag_postings", f"{profile_type}:{name.lower()}")
+
+    def migrated_postings(self, name: str, profile_type: str = "user") -> SegmentedPostings:
+        postings = self.postings(name, profile_type)
+        if profile_type == "user" and not postings.exists():
+            # tags written before the postings were segmented keep their users in the tag object
+            legacy_profiles = (self.get(name) or {}).get("profiles")
+            if legacy_profiles:
+                postings.replace(legacy_profiles)
+        return postings
+
+    def add_profile(self, name: str, profile_name: str, profile_type: str = "user") -> bool:
+        self.add(name)
+        return self.migrated_postings(name, profile_type).add(profile_name)
 
     def rm(self, name: str) -> bool:
+        for profile_type in ["user", "organization"]:
+            self.postings(name, profile_type).delete()
         return self.dao.rm(name)
 
-    def rm_profile(self, name: str, profile_name: str) -> bool:
-        tag_data = self.get(name)
-        if tag_data is None:
-            return False
+    def rm_profile(self, name: str, profile_name: str, profile_type: str = "user") -> bool:
+        return self.migrated_postings(name, profile_type).remove(profile_name)
 
-        if profile_name in tag_data["profiles"]:
-            tag_data["profiles"].remove(profile_name)
-            self.dao.update(name, tag_data)
+    def profile_count(self, name: str) -> int:
+        return sum([self.postings(name, x).count() for x in ["user", "organization"]])
 
     def tags(self):
-        return [self.get(x) for x in self.ls()]
+        # a tag deleted since the listing is skipped
+        tags = [x for x in [self.get(x) for x in self.ls()] if x]
+        for tag in tags:
+            tag["count"] = self.profile_count(tag["name"])
+        return tags
 
 
 def initS3():
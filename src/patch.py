@@ -0,0 +1,51 @@
+from copy import deepcopy
+
+# field level diffs of json documents, what changed between two versions of a profile as a patch object
+#   {"set": {field: value}, "unset": [field], "splice": {field: [start, end, items]}, "patch": {field: patch}}
+# with only the parts it needs. a changed list is one splice, old[start:end] replaced by items, so appending a
+# change event or toggling an email's is_default costs the entry, not the list. a changed dict (raw_data) is
+# diffed field by field. apply_patch(old, diff(old, new)) == new for any two documents
+
+
+def diff(old: dict, new: dict) -> dict:
+    patch = {}
+    unset = [x for x in old if x not in new]
+    if unset:
+        patch["unset"] = unset
+    for field, value in new.items():
+        if field not in old:
+            patch.setdefault("set", {})[field] = value
+        elif old[field] == value:
+            continue
+        elif isinstance(old[field], dict) and isinstance(value, dict):
+            patch.setdefault("patch", {})[field] = diff(old[field], value)
+        elif isinstance(old[field], list) and isinstance(value, list):
+            patch.setdefault("splice", {})[field] = splice(old[field], value)
+        else:
+            patch.setdefault("set", {})[field] = value
+    return patch
+
+
+def splice(old: list, new: list) -> list:
+    # [start, end, items] with new == old[:start] + items + old[end:], the shortest one around the common ends
+    start = 0
+    while start < min(len(old), len(new)) and old[start] == new[start]:
+        start += 1
+    end = 0
+    while end < min(len(old), len(new)) - start and old[-end - 1] == new[-end - 1]:
+        end += 1
+    return [start, len(old) - end, new[start : len(new) - end]]
+
+
+def apply_patch(doc: dict, patch: dict) -> dict:
+    # a patched copy of doc, doc is left as is
+    doc = dict(doc)
+    for field in patch.get("unset", []):
+        doc.pop(field, None)
+    doc.update(deepcopy(patch.get("set", {})))
+    for field, (start, end, items) in patch.get("splice", {}).items():
+        values = doc.get(field) or []
+        doc[field] = values[:start] + deepcopy(items) + values[end:]
+    for field, nested in patch.get("patch", {}).items():
+        doc[field] = apply_patch(doc.get(field) or {}, nested)
+    return doc
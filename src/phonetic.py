@@ -0,0 +1,500 @@
+import re
+import unicodedata
+
+# double metaphone (lawrence philips, 2000) phonetic keys for names
+# every word gets a primary and an alternate key of up to MAX_LENGTH characters, so "smith" and "smyth"
+# both come out as SM0/XMT and "jon" and "john" as JN/AN. the phonetics postings map a key to the indexed
+# words (and usernames) that produce it, a phonetic search looks up the keys of each term and then reads
+# the ordinary word postings of whatever words are found
+
+MAX_LENGTH = 4
+VOWELS = "AEIOUY"
+
+token_re = re.compile(r"[a-z]+")
+
+
+def phonetic_tokens(name: str) -> list[str]:
+    # words of a name or username, accents stripped; digits and punctuation split words
+    text = unicodedata.normalize("NFKD", name or "").encode("ascii", "ignore").decode("ascii")
+    return token_re.findall(text.lower())
+
+
+def phonetic_keys(word: str) -> set[str]:
+    return set([x for x in double_metaphone(word) if x])
+
+
+class _Word:
+    def __init__(self, word: str):
+        self.value = word.upper()
+        self.length = len(self.value)
+        # padding so lookups past either end never fail, the end of the word reads as spaces like the original
+        self.buffer = "--" + self.value + "      "
+        self.primary = ""
+        self.secondary = ""
+
+    def at(self, pos: int, length: int = 1) -> str:
+        return self.buffer[pos + 2 : pos + 2 + length]
+
+    def is_at(self, pos: int, *options) -> bool:
+        # True if one of the options starts at pos
+        return any([self.at(pos, len(x)) == x for x in options])
+
+    def is_vowel(self, pos: int) -> bool:
+        return 0 <= pos < self.length and self.value[pos] in VOWELS
+
+    def add(self, primary: str, secondary: str = None):
+        self.primary += primary
+        self.secondary += primary if secondary is None else secondary
+
+    @property
+    def slavo_germanic(self) -> bool:
+        return any([x in self.value for x in ["W", "K", "CZ", "WITZ"]])
+
+
+def double_metaphone(word: str) -> tuple[str, str]:
+    # accents are stripped first, so "ç" and "ñ" are read as "c" and "n"
+    word = unicodedata.normalize("NFKD", word or "").encode("ascii", "ignore").decode("ascii")
+    w = _Word("".join([x for x in word if x.isalpha()]))
+    if not w.length:
+        return "", ""
+
+    pos = 0
+    last = w.length - 1
+    # skip these when at the start of a word
+    if w.is_at(0, "GN", "KN", "PN", "WR", "PS"):
+        pos += 1
+    # initial 'X' is pronounced 'Z' e.g. 'Xavier'
+    if w.at(0) == "X":
+        w.add("S")
+        pos += 1
+
+    while pos < w.length and (len(w.primary) < MAX_LENGTH or len(w.secondary) < MAX_LENGTH):
+        c = w.at(pos)
+
+        if c in VOWELS:
+            # all initial vowels map to 'A', the rest are skipped
+            if pos == 0:
+                w.add("A")
+            pos += 1
+
+        elif c == "B":
+            # "-mb", e.g "dumb", is handled under 'M'
+            w.add("P")
+            pos += 2 if w.at(pos + 1) == "B" else 1
+
+        elif c == "C":
+            pos = _c(w, pos, last)
+
+        elif c == "D":
+            if w.is_at(pos, "DG"):
+                if w.is_at(pos + 2, "I", "E", "Y"):
+                    # e.g. "edge"
+                    w.add("J")
+                    pos += 3
+                else:
+                    # e.g. "edgar"
+                    w.add("TK")
+                    pos += 2
+            elif w.is_at(pos, "DT", "DD"):
+                w.add("T")
+                pos += 2
+            else:
+                w.add("T")
+                pos += 1
+
+        elif c == "F":
+            w.add("F")
+            pos += 2 if w.at(pos + 1) == "F" else 1
+
+        elif c == "G":
+            pos = _g(w, pos, last)
+
+        elif c == "H":
+            # only keep if first & before vowel or between 2 vowels
+            if (pos == 0 or w.is_vowel(pos - 1)) and w.is_vowel(pos + 1):
+                w.add("H")
+                pos += 2
+            else:
+                pos += 1
+
+        elif c == "J":
+            pos = _j(w, pos, last)
+
+        elif c == "K":
+            w.add("K")
+            pos += 2 if w.at(pos + 1) == "K" else 1
+
+        elif c == "L":
+            if w.at(pos + 1) == "L":
+                # spanish e.g. "cabrillo", "gallegos"
+                if (pos == w.length - 3 and w.is_at(pos - 1, "ILLO", "ILLA", "ALLE")) or (
+                    (w.is_at(last - 1, "AS", "OS") or w.is_at(last, "A", "O")) and w.is_at(pos - 1, "ALLE")
+                ):
+                    w.add("L", "")
+                    pos += 2
+                    continue
+                pos += 2
+            else:
+                pos += 1
+            w.add("L")
+
+        elif c == "M":
+            w.add("M")
+            if (w.is_at(pos - 1, "UMB") and (pos + 1 == last or w.is_at(pos + 2, "ER"))) or w.at(pos + 1) == "M":
+                pos += 2
+            else:
+                pos += 1
+
+        elif c == "N":
+            w.add("N")
+            pos += 2 if w.at(pos + 1) == "N" else 1
+
+        elif c == "P":
+            if w.at(pos + 1) == "H":
+                w.add("F")
+                pos += 2
+            else:
+                # also account for "campbell", "raspberry"
+                w.add("P")
+                pos += 2 if w.is_at(pos + 1, "P", "B") else 1
+
+        elif c == "Q":
+            w.add("K")
+            pos += 2 if w.at(pos + 1) == "Q" else 1
+
+        elif c == "R":
+            # french e.g. "rogier", but exclude "hochmeier"
+            if (
+                pos == last
+                and not w.slavo_germanic
+                and w.is_at(pos - 2, "IE")
+                and not w.is_at(pos - 4, "ME", "MA")
+            ):
+                w.add("", "R")
+            else:
+                w.add("R")
+            pos += 2 if w.at(pos + 1) == "R" else 1
+
+        elif c == "S":
+            pos = _s(w, pos, last)
+
+        elif c == "T":
+            if w.is_at(pos, "TION", "TIA", "TCH"):
+                w.add("X")
+                pos += 3
+            elif w.is_at(pos, "TH", "TTH"):
+                # special case "thomas", "thames" or germanic
+                if w.is_at(pos + 2, "OM", "AM") or w.is_at(0, "VAN ", "VON ", "SCH"):
+                    w.add("T")
+                else:
+                    w.add("0", "T")
+                pos += 2
+            else:
+                w.add("T")
+                pos += 2 if w.is_at(pos + 1, "T", "D") else 1
+
+        elif c == "V":
+            w.add("F")
+            pos += 2 if w.at(pos + 1) == "V" else 1
+
+        elif c == "W":
+            pos = _w(w, pos, last)
+
+        elif c == "X":
+            # french e.g. "breaux"
+            if not (pos == last and (w.is_at(pos - 3, "IAU", "EAU") or w.is_at(pos - 2, "AU", "OU"))):
+                w.add("KS")
+            pos += 2 if w.is_at(pos + 1, "C", "X") else 1
+
+        elif c == "Z":
+            if w.at(pos + 1) == "H":
+                # chinese pinyin e.g. "zhao"
+                w.add("J")
+                pos += 2
+                continue
+            if w.is_at(pos + 1, "ZO", "ZI", "ZA") or (w.slavo_germanic and pos > 0 and w.at(pos - 1) != "T"):
+                w.add("S", "TS")
+            else:
+                w.add("S")
+            pos += 2 if w.at(pos + 1) == "Z" else 1
+
+        else:
+            pos += 1
+
+    return w.primary[:MAX_LENGTH], w.secondary[:MAX_LENGTH]
+
+
+def _c(w: _Word, pos: int, last: int) -> int:
+    # various germanic
+    if (
+        pos > 1
+        and not w.is_vowel(pos - 2)
+        and w.is_at(pos - 1, "ACH")
+        and w.at(pos + 2) != "I"
+        and (w.at(pos + 2) != "E" or w.is_at(pos - 2, "BACHER", "MACHER"))
+    ):
+        w.add("K")
+        return pos + 2
+    # special case "caesar"
+    if pos == 0 and w.is_at(pos, "CAESAR"):
+        w.add("S")
+        return pos + 2
+    # italian "chianti"
+    if w.is_at(pos, "CHIA"):
+        w.add("K")
+        return pos + 2
+    if w.is_at(pos, "CH"):
+        # find "michael"
+        if pos > 0 and w.is_at(pos, "CHAE"):
+            w.add("K", "X")
+            return pos + 2
+        # greek roots e.g. "chemistry", "chorus"
+        if (
+            pos == 0
+            and (w.is_at(pos + 1, "HARAC", "HARIS") or w.is_at(pos + 1, "HOR", "HYM", "HIA", "HEM"))
+            and not w.is_at(0, "CHORE")
+        ):
+            w.add("K")
+            return pos + 2
+        # germanic, greek, or otherwise "ch" for "kh" sound
+        if (
+            w.is_at(0, "VAN ", "VON ", "SCH")
+            or w.is_at(pos - 2, "ORCHES", "ARCHIT", "ORCHID")
+            or w.is_at(pos + 2, "T", "S")
+            or (
+                (w.is_at(pos - 1, "A", "O", "U", "E") or pos == 0)
+                and w.is_at(pos + 2, "L", "R", "N", "M", "B", "H", "F", "V", "W", " ")
+            )
+        ):
+            w.add("K")
+        elif pos > 0:
+            if w.is_at(0, "MC"):
+                # e.g. "mchugh"
+                w.add("K")
+            else:
+                w.add("X", "K")
+        else:
+            w.add("X")
+        return pos + 2
+    # e.g. "czerny"
+    if w.is_at(pos, "CZ") and not w.is_at(pos - 2, "WICZ"):
+        w.add("S", "X")
+        return pos + 2
+    # e.g. "focaccia"
+    if w.is_at(pos + 1, "CIA"):
+        w.add("X")
+        return pos + 3
+    # double 'C', but not if e.g. "mcclellan"
+    if w.is_at(pos, "CC") and not (pos == 1 and w.at(0) == "M"):
+        # "bellocchio" but not "bacchus"
+        if w.is_at(pos + 2, "I", "E", "H") and not w.is_at(pos + 2, "HU"):
+            # "accident", "accede", "succeed"
+            if (pos == 1 and w.at(pos - 1) == "A") or w.is_at(pos - 1, "UCCEE", "UCCES"):
+                w.add("KS")
+            # "bacci", "bertucci", other italian
+            else:
+                w.add("X")
+            return pos + 3
+        # Pierce's rule
+        w.add("K")
+        return pos + 2
+    if w.is_at(pos, "CK", "CG", "CQ"):
+        w.add("K")
+        return pos + 2
+    if w.is_at(pos, "CI", "CE", "CY"):
+        # italian vs. english
+        if w.is_at(pos, "CIO", "CIE", "CIA"):
+            w.add("S", "X")
+        else:
+            w.add("S")
+        return pos + 2
+    w.add("K")
+    # name sent in "mac caffrey", "mac gregor"
+    if w.is_at(pos + 1, " C", " Q", " G"):
+        return pos + 3
+    if w.is_at(pos + 1, "C", "K", "Q") and not w.is_at(pos + 1, "CE", "CI"):
+        return pos + 2
+    return pos + 1
+
+
+def _g(w: _Word, pos: int, last: int) -> int:
+    if w.at(pos + 1) == "H":
+        if pos > 0 and not w.is_vowel(pos - 1):
+            w.add("K")
+            return pos + 2
+        # "ghislane", "ghiradelli"
+        if pos == 0:
+            if w.at(pos + 2) == "I":
+                w.add("J")
+            else:
+                w.add("K")
+            return pos + 2
+        # Parker's rule (with some further refinements) - e.g. "hugh", "bough", "broughton"
+        if (
+            (pos > 1 and w.is_at(pos - 2, "B", "H", "D"))
+            or (pos > 2 and w.is_at(pos - 3, "B", "H", "D"))
+            or (pos > 3 and w.is_at(pos - 4, "B", "H"))
+        ):
+            return pos + 2
+        # e.g. "laugh", "mclaughlin", "cough", "gough", "rough", "tough"
+        if pos > 2 and w.at(pos - 1) == "U" and w.is_at(pos - 3, "C", "G", "L", "R", "T"):
+            w.add("F")
+        elif pos > 0 and w.at(pos - 1) != "I":
+            w.add("K")
+        return pos + 2
+    if w.at(pos + 1) == "N":
+        if pos == 1 and w.is_vowel(0) and not w.slavo_germanic:
+            w.add("KN", "N")
+        # not e.g. "cagney"
+        elif not w.is_at(pos + 2, "EY") and w.at(pos + 1) != "Y" and not w.slavo_germanic:
+            w.add("N", "KN")
+        else:
+            w.add("KN")
+        return pos + 2
+    # "tagliaro"
+    if w.is_at(pos + 1, "LI") and not w.slavo_germanic:
+        w.add("KL", "L")
+        return pos + 2
+    # -ges-, -gep-, -gel-, -gie- at beginning
+    if pos == 0 and (
+        w.at(pos + 1) == "Y" or w.is_at(pos + 1, "ES", "EP", "EB", "EL", "EY", "IB", "IL", "IN", "IE", "EI", "ER")
+    ):
+        w.add("K", "J")
+        return pos + 2
+    # -ger-, -gy-
+    if (
+        (w.is_at(pos + 1, "ER") or w.at(pos + 1) == "Y")
+        and not w.is_at(0, "DANGER", "RANGER", "MANGER")
+        and not w.is_at(pos - 1, "E", "I")
+        and not w.is_at(pos - 1, "RGY", "OGY")
+    ):
+        w.add("K", "J")
+        return pos + 2
+    # italian e.g. "biaggi"
+    if w.is_at(pos + 1, "E", "I", "Y") or w.is_at(pos - 1, "AGGI", "OGGI"):
+        # obvious germanic
+        if w.is_at(0, "VAN ", "VON ", "SCH") or w.is_at(pos + 1, "ET"):
+            w.add("K")
+        elif w.is_at(pos + 1, "IER "):
+            # always soft if french ending
+            w.add("J")
+        else:
+            w.add("J", "K")
+        return pos + 2
+    w.add("K")
+    return pos + 2 if w.at(pos + 1) == "G" else pos + 1
+
+
+def _j(w: _Word, pos: int, last: int) -> int:
+    # obvious spanish, "jose", "san jacinto"
+    if w.is_at(pos, "JOSE") or w.is_at(0, "SAN "):
+        if (pos == 0 and w.at(pos + 4) == " ") or w.is_at(0, "SAN "):
+            w.add("H")
+        else:
+            w.add("J", "H")
+        return pos + 1
+    if pos == 0 and not w.is_at(pos, "JOSE"):
+        # Yankelovich/Jankelowicz
+        w.add("J", "A")
+    elif w.is_vowel(pos - 1) and not w.slavo_germanic and w.is_at(pos + 1, "A", "O"):
+        # spanish pron. of e.g. "bajador"
+        w.add("J", "H")
+    elif pos == last:
+        w.add("J", "")
+    elif not w.is_at(pos + 1, "L", "T", "K", "S", "N", "M", "B", "Z") and not w.is_at(pos - 1, "S", "K", "L"):
+        w.add("J")
+    return pos + 2 if w.at(pos + 1) == "J" else pos + 1
+
+
+def _s(w: _Word, pos: int, last: int) -> int:
+    # special cases "island", "isle", "carlisle", "carlysle"
+    if w.is_at(pos - 1, "ISL", "YSL"):
+        return pos + 1
+    # special case "sugar-"
+    if pos == 0 and w.is_at(pos, "SUGAR"):
+        w.add("X", "S")
+        return pos + 1
+    if w.is_at(pos, "SH"):
+        # germanic
+        if w.is_at(pos + 1, "HEIM", "HOEK", "HOLM", "HOLZ"):
+            w.add("S")
+        else:
+            w.add("X")
+        return pos + 2
+    # italian & armenian
+    if w.is_at(pos, "SIO", "SIA", "SIAN"):
+        if not w.slavo_germanic:
+            w.add("S", "X")
+        else:
+            w.add("S")
+        return pos + 3
+    # german & anglicisations, e.g. "smith" match "schmidt", "snider" match "schneider"
+    # also, -sz- in slavic language although in hungarian it is pronounced 's'
+    if (pos == 0 and w.is_at(pos + 1, "M", "N", "L", "W")) or w.at(pos + 1) == "Z":
+        w.add("S", "X")
+        return pos + 2 if w.at(pos + 1) == "Z" else pos + 1
+    if w.is_at(pos, "SC"):
+        # Schlesinger's rule
+        if w.at(pos + 2) == "H":
+            # dutch origin, e.g. "school", "schooner"
+            if w.is_at(pos + 3, "OO", "ER", "EN", "UY", "ED", "EM"):
+                # "schermerhorn", "schenker"
+                if w.is_at(pos + 3, "ER", "EN"):
+                    w.add("X", "SK")
+                else:
+                    w.add("SK")
+                return pos + 3
+            if pos == 0 and not w.is_vowel(3) and w.at(3) != "W":
+                w.add("X", "S")
+            else:
+                w.add("X")
+            return pos + 3
+        if w.is_at(pos + 2, "I", "E", "Y"):
+            w.add("S")
+            return pos + 3
+        w.add("SK")
+        return pos + 3
+    # french e.g. "resnais", "artois"
+    if pos == last and w.is_at(pos - 2, "AI", "OI"):
+        w.add("", "S")
+    else:
+        w.add("S")
+    return pos + 2 if w.is_at(pos + 1, "S", "Z") else pos + 1
+
+
+def _w(w: _Word, pos: int, last: int) -> int:
+    # can also be in middle of word
+    if w.is_at(pos, "WR"):
+        w.add("R")
+        return pos + 2
+    if pos == 0 and (w.is_vowel(pos + 1) or w.is_at(pos, "WH")):
+        # Wasserman should match Vasserman
+        if w.is_vowel(pos + 1):
+            w.add("A", "F")
+        else:
+            # need Uomo to match Womo
+            w.add("A")
+    # Arnow should match Arnoff
+    if (
+        (pos == last and w.is_vowel(pos - 1))
+        or w.is_at(pos - 1, "EWSKI", "EWSKY", "OWSKI", "OWSKY")
+        or w.is_at(0, "SCH")
+    ):
+        w.add("", "F")
+        return pos + 1
+    # polish e.g. "filipowicz"
+    if w.is_at(pos, "WICZ", "WITZ"):
+        w.add("TS", "FX")
+        return pos + 4
+    return pos + 1
+
+
+def phonetic_entries(names: list[str], by_name: bool = False, exclude: list[str] = []) -> dict:
+    # {key: words} for the words of names, or {key: names} with by_name; module level so it can run in a
+    # multiprocessing pool for the bulk build
+    entries = {}
+    for name in names:
+        for word in [x for x in phonetic_tokens(name) if x not in exclude]:
+            for key in phonetic_keys(word):
+                entries.setdefault(key, set()).add(name if by_name else word)
+    return entries
@@ -0,0 +1,392 @@
+import re
+import shlex
+from math import ceil
+
+from config import config
+from models import (
+    Locations,
+    Organizations,
+    Tags,
+    Words,
+    impact_order,
+    is_segmented,
+    normalize_location,
+    posting_count,
+    rating_impact,
+)
+from suggest import suggest_index
+from tokenizer import index_tokens, name_words, street_tokens
+
+# field scoped organization queries, e.g. `state:TX city:austin street:main tag:ppp rating>100000 roofing`
+#
+# every predicate can be answered by a document filter (load the org and test it) and some can also be
+# answered from an index (a posting of matching names). the planner estimates how many orgs each indexed
+# predicate matches, starts from the most selective one and then, for each remaining predicate, either
+# intersects its posting or tests it on the candidate orgs, whichever is estimated to be cheaper
+
+FETCH_LATENCY = 0.05  # seconds for one s3 round trip
+POSTING_ENTRY_TIME = 0.000002  # seconds to download and parse one posting entry
+
+predicate_re = re.compile(r"^(?P<field>[a-z_]+)(?P<op>:|>=|<=|>|<|=)(?P<value>.+)$")
+
+
+class QueryError(Exception):
+    pass
+
+
+class Predicate:
+    field = None
+    group = None  # the Grouping holding this predicate's postings
+
+    def __init__(self, value: str):
+        self.value = value
+        self.posting = None
+        self._postings = None
+
+    def __repr__(self):
+        return f"{self.field}:{self.value}"
+
+    def key(self) -> str:
+        # name of this predicate's posting in group, None when there is no index for the predicate
+        return None
+
+    def estimate(self):
+        # estimated number of matching orgs, None when there is no index for the predicate
+        if self.key() is None:
+            return None
+        return posting_count(self.load())
+
+    def load(self) -> dict:
+        if self.posting is None:
+            self.posting = self.group().get(self.key()) or dict(organizations=[])
+        return self.posting
+
+    def postings(self) -> set:
+        if self.key() is None:
+            raise QueryError(f"{self} has no index")
+        if self._postings is None:
+            self._postings = set(self.load().get("organizations", []))
+        return self._postings
+
+    def intersect(self, candidates: set) -> set:
+        return candidates & self.postings()
+
+    def intersect_cost(self, estimate: int, candidate_count: int) -> float:
+        return index_cost(self, estimate)
+
+    def matches(self, profile) -> bool:
+        raise Exception("Not implemented")
+
+
+class WordPredicate(Predicate):
+    field = "word"
+    group = Words
+
+    def __init__(self, value: str):
+        super().__init__(value.lower())
+
+    def key(self) -> str:
+        return self.value
+
+    def estimate(self):
+        # document frequencies are in the suggest index, so the posting is only fetched if it is used
+        index = suggest_index()
+        if self.posting is None and index is not None:
+            start, end = index.prefix_range(self.value)
+            if start < end and index.term(start) == self.value:
+                return index.df(start)
+            return 0
+        return super().estimate()
+
+    def load(self) -> dict:
+        # segmented postings (see models.Words) are loaded as their header
+        if self.posting is None:
+            self.posting = Words().head(self.key()) or dict(organizations=[])
+        return self.posting
+
+    def postings(self) -> set:
+        if self._postings is None:
+            self._postings = set(Words().expand(self.load())["organizations"])
+        return self._postings
+
+    def intersect(self, candidates: set) -> set:
+        if self._postings is None and is_segmented(self.load()):
+            return Words().intersect(self.posting, candidates)
+        return super().intersect(candidates)
+
+    def intersect_cost(self, estimate: int, candidate_count: int) -> float:
+        if self.posting is not None and is_segmented(self.posting):
+            # only the segments the candidates fall in are fetched, in parallel
+            segments = min(candidate_count, len(self.posting["segments"]))
+            return FETCH_LATENCY + segments * config.POSTING_SEGMENT_SIZE * POSTING_ENTRY_TIME
+        return super().intersect_cost(estimate, candidate_count)
+
+    def matches(self, profile) -> bool:
+        return self.value in name_words(profile.name)
+
+
+class AddressPredicate(Predicate):
+    attribute = None
+    group = Locations
+
+    def key(self) -> str:
+        return f"{self.field}:{normalize_location(self.value)}"
+
+    def normalized(self, value: str) -> str:
+        return normalize_location(value)
+
+    def matches(self, profile) -> bool:
+        value = self.normalized(self.value)
+        return any([self.normalized(getattr(x, self.attribute)) == value for x in profile.physical_addresses])
+
+
+class StatePredicate(AddressPredicate):
+    field = "state"
+    attribute = "state"
+
+
+class CityPredicate(AddressPredicate):
+    field = "city"
+    attribute = "city"
+
+
+class ZipPredicate(AddressPredicate):
+    field = "zip"
+    attribute = "postal_code"
+
+    def key(self) -> str:
+        # zip:787 uses the 3 digit zip prefix postings, zip:78701 the 5 digit ones
+        if self.value.isdigit() and len(self.value) in [3, 5]:
+            return f"zip{len(self.value)}:{self.value}"
+        return None
+
+    def matches(self, profile) -> bool:
+        # zip:787 matches any zip starting with 787
+        return any([(x.postal_code or "").strip().startswith(self.value) for x in profile.physical_addresses])
+
+
+class StreetPredicate(AddressPredicate):
+    # street:main and street:"main st" use the posting of the street name word, streets of more than one
+    # word ("old mill rd") are only filtered
+    field = "street"
+    attribute = "street1"
+
+    def key(self) -> str:
+        words = street_tokens(self.value)
+        return f"street:{words[0]}" if len(words) == 1 else None
+
+    def matches(self, profile) -> bool:
+        words = set(street_tokens(self.value))
+        return any([words <= set(street_tokens(x.street1)) for x in profile.physical_addresses])
+
+
+class TagPredicate(Predicate):
+    # tag postings are segmented (see models.SegmentedPostings): the estimate only needs the header and
+    # candidates are checked against just the segments they would be in
+    field = "tag"
+
+    def __init__(self, value: str):
+        super().__init__(value)
+        self.index = Tags().postings(value, profile_type="organization")
+
+    def key(self) -> str:
+        return self.index.key
+
+    def estimate(self):
+        return self.index.count()
+
+    def postings(self) -> set:
+        if self._postings is None:
+            self._postings = set(self.index.all())
+        return self._postings
+
+    def intersect(self, candidates: set) -> set:
+        if self._postings is not None:
+            return candidates & self._postings
+        return self.index.intersect(candidates)
+
+    def intersect_cost(self, estimate: int, candidate_count: int) -> float:
+        segments = min(len(self.index.header()["segments"]), candidate_count)
+        entries = min(estimate, segments * self.index.segment_size)
+        return ceil(segments / config.IO_THREAD_COUNT) * FETCH_LATENCY + entries * POSTING_ENTRY_TIME
+
+    def page(self, page: int, per_page: int) -> list[str]:
+        return self.index.range((page - 1) * per_page, per_page)
+
+    def matches(self, profile) -> bool:
+        return self.value.lower() in [x.lower() for x in profile.tags]
+
+
+class RatingPredicate(Predicate):
+    field = "rating"
+    attribute = "antisocial_rating"
+    operators = {
+        ">": lambda a, b: a > b,
+        ">=": lambda a, b: a >= b,
+        "<": lambda a, b: a < b,
+        "<=": lambda a, b: a <= b,
+        "=": lambda a, b: a == b,
+        ":": lambda a, b: a == b,
+    }
+
+    def __init__(self, value: str, op: str):
+        try:
+            super().__init__(int(value))
+        except ValueError:
+            raise QueryError(f"{self.field} needs a whole number, not {value}")
+        self.op = op
+
+    def __repr__(self):
+        return f"{self.field}{self.op}{self.value}"
+
+    def matches(self, profile) -> bool:
+        return self.operators[self.op](getattr(profile, self.attribute), self.value)
+
+    def prefilter(self, word_data: dict) -> set:
+        # the names of a word posting whose rating impact could satisfy the predicate, impacts are
+        # monotonic in the rating so this never drops a real match
+        impact = rating_impact(self.value)
+        keep = set()
+        for bucket, names in impact_order(word_data):
+            if bucket < 0 or self.operators[self.op](bucket, impact) or bucket == impact:
+                keep.update(names)
+        return keep
+
+
+class SocialRatingPredicate(RatingPredicate):
+    field = "social"
+    attribute = "social_rating"
+
+    def prefilter(self, word_data: dict) -> set:
+        # impacts only track the antisocial rating
+        return set(word_data.get("organizations", []))
+
+
+FIELDS = {
+    "state": StatePredicate,
+    "city": CityPredicate,
+    "zip": ZipPredicate,
+    "street": StreetPredicate,
+    "tag": TagPredicate,
+    "name": WordPredicate,
+    "word": WordPredicate,
+}
+RANGE_FIELDS = {
+    "rating": RatingPredicate,
+    "antisocial": RatingPredicate,
+    "social": SocialRatingPredicate,
+}
+
+
+def is_field_query(q: str) -> bool:
+    return any([predicate_re.match(x.lower()) for x in q.split(" ") if x])
+
+
+def parse(q: str) -> list[Predicate]:
+    try:
+        tokens = shlex.split(q)
+    except ValueError as e:
+        raise QueryError(f"Could not parse query: {e}")
+    predicates = []
+    for token in tokens:
+        match = predicate_re.match(token)
+        field = match.group("field").lower() if match else None
+        if match and field in RANGE_FIELDS:
+            predicates.append(RANGE_FIELDS[field](match.group("value"), match.group("op")))
+        elif match and field in FIELDS and match.group("op") == ":":
+            predicates.append(FIELDS[field](match.group("value")))
+        else:
+            for word in index_tokens(token):
+                predicates.append(WordPredicate(word))
+    return predicates
+
+
+def index_cost(p: Predicate, estimate: int) -> float:
+    # postings fetched while planning only cost the intersection
+    return (0 if p.posting is not None else FETCH_LATENCY) + estimate * POSTING_ENTRY_TIME
+
+
+def filter_cost(candidate_count: int) -> float:
+    return ceil(candidate_count / config.IO_THREAD_COUNT) * FETCH_LATENCY
+
+
+class Plan:
+    def __init__(self, predicates: list[Predicate]):
+        self.predicates = predicates
+        self.steps = []  # (predicate, method, estimate) in execution order
+
+    def describe(self) -> list[str]:
+        return [f"{method} {p} (~{estimate})" for p, method, estimate in self.steps]
+
+    def is_paged(self) -> bool:
+        # a lone tag is answered a page at a time straight from its sorted posting
+        return len(self.predicates) == 1 and isinstance(self.predicates[0], TagPredicate)
+
+    def page(self, page: int, per_page: int) -> tuple[list[str], int]:
+        p = self.predicates[0]
+        total = p.estimate()
+        self.steps.append((p, "index page", total))
+        return p.page(page, per_page), total
+
+    def execute(self, filter_limit: int = None) -> set:
+        filter_limit = filter_limit or config.SEARCH_FILTER_LIMIT
+        if not self.predicates:
+            return set()
+        estimates = {p: p.estimate() for p in self.predicates}
+        indexed = sorted([p for p in self.predicates if estimates[p] is not None], key=lambda x: estimates[x])
+        if not indexed:
+            raise QueryError("Add a name word or another indexed field to the query.")
+
+        driver = indexed[0]
+        self.steps.append((driver, "index", estimates[driver]))
+        candidates = set(driver.postings())
+
+        # rating ranges are cut down with the impacts of the word postings before any org is loaded
+        for p in [x for x in self.predicates if isinstance(x, RatingPredicate)]:
+            # segmented postings only keep the head of their impacts, so they cannot narrow the range
+            words = [x for x in indexed if isinstance(x, WordPredicate) and x.posting is not None]
+            for word in [x for x in words if not is_segmented(x.posting)]:
+                candidates &= p.prefilter(word.posting)
+                self.steps.append((p, f"impacts of {word.value}", len(candidates)))
+                break
+
+        filters = []
+        for p in [x for x in indexed[1:]]:
+            if not candidates:
+                break
+            if p.intersect_cost(estimates[p], len(candidates)) <= filter_cost(len(candidates)):
+                candidates = p.intersect(candidates)
+                self.steps.append((p, "index", estimates[p]))
+            else:
+                filters.append(p)
+        filters += [x for x in self.predicates if estimates[x] is None]
+        if not filters or not candidates:
+            return candidates
+
+        if len(candidates) > filter_limit:
+            raise QueryError(
+                f"{len(candidates)} organizations would have to be loaded to check {', '.join(map(str, filters))}, "
+                "refine your query."
+            )
+        for p in filters:
+            self.steps.append((p, "filter", len(candidates)))
+        profiles = Organizations().get_many(list(candidates), timeout=config.SEARCH_FETCH_TIMEOUT)
+        return set([name for name, profile in profiles.items() if all([p.matches(profile) for p in filters])])
+
+
+def plan(q: str) -> Plan:
+    predicates = parse(q)
+    # postings whose sizes are the estimates are fetched together up front, one batch per index
+    pending = [x for x in predicates if x.group is not None and x.key() is not None]
+    if suggest_index() is not None:
+        pending = [x for x in pending if not isinstance(x, WordPredicate)]
+    for group in list(dict.fromkeys([x.group for x in pending])):
+        members = [x for x in pending if x.group is group]
+        keys = list(set([x.key() for x in members]))
+        if group is Words:
+            fetched = Words().heads(keys, timeout=config.SEARCH_FETCH_TIMEOUT)
+        else:
+            fetched = group().get_many(keys, timeout=config.SEARCH_FETCH_TIMEOUT)
+        for p in members:
+            p.posting = fetched.get(p.key()) or dict(organizations=[])
+    return Plan(predicates)
@@ -0,0 +1,77 @@
+from collections import defaultdict
+from math import log
+
+from tokenizer import tokens
+
+# okapi bm25 over organization name tokens
+# document frequencies come from the size of each word posting, document lengths from the number
+# of tokens in the organization name, so nothing beyond the word index has to be loaded to rank
+K1 = 1.2
+B = 0.75
+DEFAULT_AVG_LENGTH = 3.0
+
+
+def name_tokens(name: str) -> list[str]:
+    # the shared tokenizer, stop words included since they count towards the name length
+    return tokens(name)
+
+
+def idf(df: int, doc_count: int) -> float:
+    return log(1 + (doc_count - df + 0.5) / (df + 0.5))
+
+
+def bm25_scores(
+    postings: dict, doc_count: int, avg_length: float = None, min_should_match: int = 1, weights: dict = None
+) -> dict:
+    # postings maps each query term to the names containing it; returns {name: score} for every
+    # name that contains at least min_should_match of the terms. weights ({term: {name: weight}}) scale
+    # matches in lower weighted fields, anything not listed counts in full
+    matched = defaultdict(list)
+    for term, names in postings.items():
+        for name in names:
+            matched[name].append(term)
+
+    avg_length = avg_length or DEFAULT_AVG_LENGTH
+    doc_count = max(doc_count, max([len(x) for x in postings.values()] + [0]))
+    idfs = {term: idf(len(names), doc_count) for term, names in postings.items()}
+    scores = {}
+    for name, terms in matched.items():
+        if len(terms) < min_should_match:
+            continue
+        tokens = name_tokens(name)
+        norm = K1 * (1 - B + B * len(tokens) / avg_length)
+        score = 0.0
+        for term in terms:
+            tf = max(1, tokens.count(term))
+            weight = (weights or {}).get(term, {}).get(name, 1.0)
+            score += weight * idfs[term] * tf * (K1 + 1) / (tf + norm)
+        scores[name] = score
+    return scores
+
+
+def min_should_match(term_count: int, value: str = None) -> int:
+    # value is either a number of terms ("2") or a percentage of the query terms ("75%")
+    if not value:
+        return term_count
+    try:
+        if value.endswith("%"):
+            count = int(term_count * float(value[:-1]) / 100)
+        else:
+            count = int(value)
+    except ValueError:
+        return term_count
+    return min(max(1, count), max(1, term_count))
+
+
+def top_by_impact(impacts, filters: list, k: int) -> list[str]:
+    # threshold walk over an impact ordered posting (see models.impact_order): names are checked
+    # against the other terms' postings bucket by bucket, highest impact first, and the walk stops at
+    # the end of the bucket in which the k-th match is found since no later name can rank above it
+    results = []
+    for _, names in impacts:
+        for name in sorted(names, key=lambda x: x.lower()):
+            if all([name in x for x in filters]):
+                results.append(name)
+        if len(results) >= k:
+            break
+    return results[:k]
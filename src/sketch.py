@@ -0,0 +1,73 @@
+from hashlib import blake2b
+
+# k minimum values (bottom-k minhash) sketches of word postings, used to estimate how many organizations
+# match every word of a query without fetching the postings themselves
+# a sketch is {"count": posting size, "hashes": the k smallest 64 bit hashes of the posting's names, sorted}.
+# a sketch with count <= len(hashes) holds every hash of its posting and is exact
+
+HASH_RANGE = 1 << 64
+MIN_SAMPLE = 16  # fewer testable hashes than this and an estimate is mostly noise
+
+
+def name_hash(name: str) -> int:
+    return int.from_bytes(blake2b(name.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def build_sketch(names, k: int) -> dict:
+    names = set(names)
+    return dict(count=len(names), hashes=sorted([name_hash(x) for x in names])[:k])
+
+
+def sketch_add(sketch: dict, name: str, k: int):
+    # the caller only adds names that are new to the posting
+    h = name_hash(name)
+    hashes = sketch["hashes"]
+    sketch["count"] += 1
+    if h in hashes or (len(hashes) >= k and h > hashes[-1]):
+        return
+    sketch["hashes"] = sorted(hashes + [h])[:k]
+
+
+def sketch_rm(sketch: dict, name: str):
+    # a removed hash leaves a bottom-(k-1) sketch, still a valid sample of the smaller posting
+    h = name_hash(name)
+    sketch["count"] = max(0, sketch["count"] - 1)
+    if h in sketch["hashes"]:
+        sketch["hashes"].remove(h)
+
+
+def is_exact(sketch: dict) -> bool:
+    return sketch["count"] <= len(sketch["hashes"])
+
+
+def estimate_intersection(sketches: list[dict]):
+    # returns (estimated number of names in every posting, whether the number is exact), or None when the
+    # sketches share too few hashes to say anything and the postings have to be intersected
+    if not sketches:
+        return 0, True
+    if len(sketches) == 1:
+        return sketches[0]["count"], True
+    sets = [set(x["hashes"]) for x in sketches]
+    smallest = min([x["count"] for x in sketches])
+    exact = [x for x in sketches if is_exact(x)]
+    if len(exact) == len(sketches):
+        return len(set.intersection(*sets)), True
+
+    # hashes at or below a sampled sketch's largest hash can be tested against it
+    cutoff = min([x["hashes"][-1] for x in sketches if not is_exact(x) and x["hashes"]] + [HASH_RANGE])
+    if exact:
+        # a fully known posting drives: the share of its testable names found in every other sketch
+        driver = min(exact, key=lambda x: x["count"])
+        testable = [h for h in driver["hashes"] if h <= cutoff]
+        if len(testable) >= MIN_SAMPLE:
+            shared = len([h for h in testable if all([h in x for x in sets])])
+            return min(smallest, round(shared * driver["count"] / len(testable))), False
+
+    # jaccard similarity of the k smallest hashes of the union, scaled by the estimated union size
+    k = min([len(x["hashes"]) for x in sketches if not is_exact(x)])
+    union = sorted(set().union(*sets))[:k]
+    shared = len([h for h in union if all([h in x for x in sets])])
+    if k < MIN_SAMPLE or not shared:
+        return None
+    union_size = (k - 1) * HASH_RANGE / (union[-1] + 1)
+    return min(smallest, round(shared / k * union_size)), False
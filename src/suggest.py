@@ -0,0 +1,157 @@
+import heapq
+import json
+import mmap
+import os
+import struct
+from bisect import bisect_left
+
+# suggest index file layout (little endian):
+#   header          magic, entry count, blob size, prefix table size
+#   offsets         uint32 * (count + 1) - start of each term in the blob
+#   dfs             uint32 * count - document frequency of each term
+#   kinds           uint8 * count - see KINDS
+#   blob            utf-8 terms, sorted
+#   prefix table    json {prefix: [entry index, ...]} with the precomputed top completions of every prefix that
+#                   has more than SCAN_THRESHOLD of them
+# terms are sorted so all completions of a prefix are a contiguous range found with two binary searches. a prefix
+# that is not in the table has at most SCAN_THRESHOLD completions, which are scanned at query time
+
+MAGIC = b"SGT1"
+HEADER = struct.Struct("<4sIII")
+KINDS = ["word", "user"]
+SCAN_THRESHOLD = 256  # prefixes with more completions than this have their top completions precomputed
+
+
+def large_prefixes(ordered: list, threshold: int):
+    # (prefix, start, end) of every prefix with more than threshold terms, the terms of a prefix are the run of
+    # sorted terms sharing it, split by the next character to find the longer prefixes inside it
+    ranges = [(0, len(ordered), 1)]
+    while ranges:
+        start, end, length = ranges.pop()
+        run = start
+        for idx in range(start, end + 1):
+            if idx < end and ordered[idx][:length] == ordered[run][:length]:
+                continue
+            if idx - run > threshold and len(ordered[run]) >= length:
+                yield ordered[run][:length], run, idx
+                ranges.append((run, idx, length + 1))
+            run = idx
+
+
+def build_suggest_index(entries, fn: str, k: int = 10, threshold: int = SCAN_THRESHOLD):
+    # entries is an iterable of (term, df, kind) - written atomically so running workers never see a partial file
+    terms = {}
+    for term, df, kind in entries:
+        term = term.lower().strip()
+        if not term:
+            continue
+        if term in terms:
+            # keep the highest frequency when a term is both a word and a username
+            if df <= terms[term][0]:
+                continue
+        terms[term] = (df, KINDS.index(kind))
+    ordered = sorted(terms.keys())
+
+    blob = bytearray()
+    offsets = []
+    for term in ordered:
+        offsets.append(len(blob))
+        blob.extend(term.encode("utf-8"))
+    offsets.append(len(blob))
+
+    dfs = [terms[x][0] for x in ordered]
+    prefix_table = {
+        prefix: heapq.nlargest(k, range(start, end), key=lambda x: (dfs[x], -x))
+        for prefix, start, end in large_prefixes(ordered, threshold)
+    }
+    prefix_bytes = json.dumps(prefix_table).encode("utf-8")
+
+    tmp_fn = f"{fn}.tmp"
+    with open(tmp_fn, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(ordered), len(blob), len(prefix_bytes)))
+        f.write(struct.pack(f"<{len(offsets)}I", *offsets))
+        f.write(struct.pack(f"<{len(ordered)}I", *dfs))
+        f.write(bytes([terms[x][1] for x in ordered]))
+        f.write(blob)
+        f.write(prefix_bytes)
+    os.replace(tmp_fn, fn)
+    return len(ordered)
+
+
+class SuggestIndex:
+    def __init__(self, fn: str):
+        self.fn = fn
+        with open(fn, "rb") as f:
+            # the mapping is read only so every worker process shares the same pages
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, blob_size, prefix_size = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise Exception(f"{fn} is not a suggest index")
+        self.offsets_at = HEADER.size
+        self.dfs_at = self.offsets_at + 4 * (self.count + 1)
+        self.kinds_at = self.dfs_at + 4 * self.count
+        self.blob_at = self.kinds_at + self.count
+        prefix_at = self.blob_at + blob_size
+        self.prefix_table = json.loads(self.mm[prefix_at : prefix_at + prefix_size].decode("utf-8"))
+
+    def __len__(self):
+        return self.count
+
+    def term(self, idx: int) -> str:
+        start, end = struct.unpack_from("<II", self.mm, self.offsets_at + 4 * idx)
+        return self.mm[self.blob_at + start : self.blob_at + end].decode("utf-8")
+
+    def df(self, idx: int) -> int:
+        return struct.unpack_from("<I", self.mm, self.dfs_at + 4 * idx)[0]
+
+    def kind(self, idx: int) -> str:
+        return KINDS[self.mm[self.kinds_at + idx]]
+
+    def entry(self, idx: int) -> dict:
+        return dict(term=self.term(idx), df=self.df(idx), kind=self.kind(idx))
+
+    def prefix_range(self, prefix: str) -> tuple[int, int]:
+        # returns the [start, end) range of entries starting with prefix
+        terms = _TermView(self)
+        start = bisect_left(terms, prefix)
+        end = bisect_left(terms, prefix + "\U0010ffff", lo=start)
+        return start, end
+
+    def suggest(self, prefix: str, k: int = 10) -> list[dict]:
+        prefix = prefix.lower().strip()
+        if not prefix:
+            return []
+        if prefix in self.prefix_table:
+            return [self.entry(x) for x in self.prefix_table[prefix][:k]]
+        # at most SCAN_THRESHOLD completions
+        start, end = self.prefix_range(prefix)
+        best = heapq.nlargest(k, range(start, end), key=lambda x: (self.df(x), -x))
+        return [self.entry(x) for x in best]
+
+
+class _TermView:
+    # sequence view over the sorted terms for bisect
+    def __init__(self, index: SuggestIndex):
+        self.index = index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, idx: int) -> str:
+        return self.index.term(idx)
+
+
+_suggest_index = None
+
+
+def suggest_index(fn: str = None):
+    # loaded once per worker process; returns None until the index has been built
+    global _suggest_index
+    if _suggest_index is None:
+        from config import config
+
+        fn = fn or config.SUGGEST_INDEX_FILE
+        if not os.path.exists(fn):
+            return None
+        _suggest_index = SuggestIndex(fn)
+    return _suggest_index
@@ -0,0 +1,85 @@
+from contextlib import contextmanager
+import threading
+from time import monotonic
+
+from botocore.exceptions import ClientError, ConnectionClosedError, ConnectTimeoutError, ReadTimeoutError
+
+# adaptive (aimd) concurrency limit for s3 requests, like tcp congestion control: every request takes a slot,
+# the limit grows by one slot per limit's worth of healthy responses while it is in use, holds while responses
+# are slower than latency_target and halves on throttling (SlowDown, 503), server errors and timeouts. one
+# limiter per process is shared by the DAO and the bulk loaders, so they run at about the request rate s3
+# sustains instead of pushing on into throttling or idling on fixed sleeps
+
+OVERLOAD_CODES = ["SlowDown", "ServiceUnavailable", "RequestTimeout", "Throttling", "ThrottlingException"]
+
+
+def is_overload(e: Exception) -> bool:
+    if isinstance(e, (ConnectTimeoutError, ReadTimeoutError, ConnectionClosedError)):
+        return True
+    if isinstance(e, ClientError):
+        status = e.response.get("ResponseMetadata", {}).get("HTTPStatusCode") or 0
+        return e.response.get("Error", {}).get("Code") in OVERLOAD_CODES or status >= 500 or status == 429
+    return False
+
+
+class AdaptiveLimiter:
+    def __init__(self, initial: int = 8, minimum: int = 1, maximum: int = 256, latency_target: float = 2.0):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self.in_flight = 0
+        self.decreased_at = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self) -> float:
+        # waits for a slot, returns when the request started
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+            return monotonic()
+
+    def release(self, started: float, overloaded: bool = False):
+        with self.condition:
+            full = self.in_flight >= int(self.limit)
+            self.in_flight -= 1
+            if overloaded:
+                # requests sent before the last decrease saw the old limit, one episode of overload halves once
+                if started > self.decreased_at:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self.decreased_at = monotonic()
+            elif full and monotonic() - started <= self.latency_target:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+    @contextmanager
+    def slot(self):
+        started = self.acquire()
+        overloaded = False
+        try:
+            yield
+        except Exception as e:
+            overloaded = is_overload(e)
+            raise
+        finally:
+            self.release(started, overloaded)
+
+
+class LimitedClient:
+    # a boto3 client whose api calls each take a slot of limiter, anything else (exceptions, meta, the transfer
+    # helpers) is the client's own
+    def __init__(self, client, limiter: AdaptiveLimiter):
+        self.client = client
+        self.limiter = limiter
+
+    def __getattr__(self, name: str):
+        attr = getattr(self.client, name)
+        if name not in self.client.meta.method_to_api_mapping:
+            return attr
+
+        def call(*args, **kwargs):
+            with self.limiter.slot():
+                return attr(*args, **kwargs)
+
+        return call
@@ -0,0 +1,84 @@
+import re
+import unicodedata
+
+# the one tokenizer for organization names and addresses, used by the web write path, search and the bulk
+# loaders so that words indexed in bulk and words indexed by Organizations.update always agree
+#
+# names are lower cased, accents folded to ascii, apostrophes and dots dropped ("joe's" -> "joes",
+# "a.b.c." -> "abc") and split on anything that is not a letter or digit. "X DBA Y" names are split into
+# the legal name and the doing-business-as name, each a separately weighted field of the index
+
+STOP_WORDS = frozenset(
+    ["the", "and", "of", "to", "in", "for", "a", "is", "that", "on", "with", "as", "at", "by", "from", "be"]
+    + ["llc", "inc"]
+)
+STREET_STOP_WORDS = frozenset(
+    ["st", "street", "ave", "avenue", "rd", "road", "dr", "drive", "blvd", "ln", "lane", "ct", "hwy", "way"]
+    + ["suite", "ste", "apt", "unit", "fl", "floor", "po", "box", "n", "s", "e", "w", "ne", "nw", "se", "sw"]
+)
+# relative weight of a match in each field for ranked search
+FIELD_WEIGHTS = {"name": 1.0, "dba": 0.7, "street": 0.3}
+
+drop_table = str.maketrans("", "", "'`.’")
+split_re = re.compile(r"[^a-z0-9]+")
+dba_re = re.compile(r"\s+(?:d\s*/\s*b\s*/\s*a|d\.?\s*b\.?\s*a\.?)\s+", re.IGNORECASE)
+
+
+def normalize(text: str) -> str:
+    text = unicodedata.normalize("NFKD", text or "")
+    if not text.isascii():
+        text = text.encode("ascii", "ignore").decode("ascii")
+    return text.lower().translate(drop_table)
+
+
+def tokens(text: str) -> list[str]:
+    # every token in order, stop words included (bm25 document lengths count them)
+    return [x for x in split_re.split(normalize(text)) if x]
+
+
+def index_tokens(text: str, stop_words=STOP_WORDS) -> list[str]:
+    # distinct indexable tokens in order of first appearance
+    return list(dict.fromkeys([x for x in tokens(text) if x not in stop_words]))
+
+
+def tokenize_batch(texts: list[str], stop_words=STOP_WORDS) -> list[list[str]]:
+    # index_tokens over a batch with one normalize pass over the joined text, for the bulk loaders
+    joined = normalize("\n".join([(x or "").replace("\n", " ") for x in texts]))
+    return [
+        list(dict.fromkeys([x for x in split_re.split(line) if x and x not in stop_words]))
+        for line in joined.split("\n")
+    ]
+
+
+def split_dba(name: str) -> tuple[str, str]:
+    # "ACME LLC DBA ACME ROOFING" -> ("ACME LLC", "ACME ROOFING"), names without a dba part get ""
+    parts = dba_re.split(name or "", maxsplit=1)
+    if len(parts) == 2:
+        return parts[0], parts[1]
+    return name or "", ""
+
+
+def street_tokens(street: str) -> list[str]:
+    # street name words, house numbers and street types are too common to be worth indexing
+    return [x for x in index_tokens(street, STOP_WORDS | STREET_STOP_WORDS) if not x.isdigit()]
+
+
+def organization_fields(name: str, streets: list[str] = []) -> dict:
+    # {"name": [...], "dba": [...], "street": [...]} tokens of an organization, a token in both the legal and
+    # the dba name only counts for the name field
+    legal_name, dba = split_dba(name)
+    name_tokens = index_tokens(legal_name)
+    fields = dict(
+        name=name_tokens,
+        dba=[x for x in index_tokens(dba) if x not in name_tokens],
+        street=[],
+    )
+    for street in streets:
+        fields["street"] += [x for x in street_tokens(street) if x not in fields["street"]]
+    return fields
+
+
+def name_words(name: str) -> list[str]:
+    # the word postings a name belongs to: its legal name and dba tokens
+    fields = organization_fields(name)
+    return fields["name"] + fields["dba"]
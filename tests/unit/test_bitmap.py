@@ -0,0 +1,34 @@
+# tests for src/bitmap.py using pytest
+import json
+from bitmap import ARRAY_LIMIT, Bitmap
+
+
+def test_add_discard_contains():
+    bitmap = Bitmap([1, 5, 70000])
+    assert 5 in bitmap and 70000 in bitmap and 6 not in bitmap
+    assert bitmap.add(5) is False
+    assert bitmap.discard(5) is True
+    assert bitmap.discard(5) is False
+    assert list(bitmap) == [1, 70000]
+    assert len(bitmap) == 2
+
+
+def test_dense_containers_round_trip():
+    bitmap = Bitmap(range(0, 3 * ARRAY_LIMIT, 2))
+    assert isinstance(bitmap.containers[0], int)
+    assert len(bitmap) == 3 * ARRAY_LIMIT // 2
+    assert Bitmap.load(json.loads(json.dumps(bitmap.dump()))) == bitmap
+
+    # dropping below the array limit switches back to a sorted list
+    for doc_id in range(0, 3 * ARRAY_LIMIT, 4):
+        bitmap.discard(doc_id)
+    assert isinstance(bitmap.containers[0], list)
+
+
+def test_set_operations():
+    a = Bitmap([1, 2, 3, 65536 + 1])
+    b = Bitmap([2, 3, 4, 131072])
+    assert list(a & b) == [2, 3]
+    assert list(a | b) == [1, 2, 3, 4, 65537, 131072]
+    assert list(a - b) == [1, 65537]
+    assert len(a & Bitmap()) == 0
@@ -0,0 +1,41 @@
+# tests for src/fuzzy.py using pytest
+import pytest
+from suggest import SuggestIndex, build_suggest_index
+from fuzzy import FuzzyIndex, build_fuzzy_index, edit_distance
+
+
+@pytest.fixture
+def index(tmp_path):
+    suggest_fn = str(tmp_path / "suggest.idx")
+    fuzzy_fn = str(tmp_path / "fuzzy.idx")
+    entries = [
+        ("john", 500, "word"),
+        ("jon", 50, "word"),
+        ("smith", 900, "word"),
+        ("smyth", 10, "word"),
+        ("roofing", 300, "word"),
+        ("construction", 700, "word"),
+        ("jonny", 1, "user"),
+    ]
+    build_suggest_index(entries, suggest_fn)
+    suggest = SuggestIndex(suggest_fn)
+    build_fuzzy_index(suggest, fuzzy_fn, max_distance=2)
+    return FuzzyIndex(fuzzy_fn, suggest)
+
+
+def test_edit_distance():
+    assert edit_distance("smith", "smyth", 2) == 1
+    assert edit_distance("roofing", "rofoing", 2) == 1
+    assert edit_distance("abc", "abcdef", 2) == 3
+
+
+def test_lookup(index):
+    assert [x["term"] for x in index.lookup("smith")] == ["smith", "smyth"]
+    assert [x["term"] for x in index.lookup("jhon")] == ["john", "jon"]
+    assert index.lookup("constructoin", max_distance=1)[0]["term"] == "construction"
+    assert index.lookup("constructoin", max_distance=1)[0]["distance"] == 1
+    assert index.lookup("zzzzzz") == []
+
+
+def test_lookup_skips_usernames(index):
+    assert "jonny" not in [x["term"] for x in index.lookup("jonny")]
@@ -0,0 +1,100 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+import pytest
+
+from hedge import HedgeBudget, Hedger, LatencyTracker
+
+
+def test_latency_tracker():
+    tracker = LatencyTracker(size=100, min_samples=10, refresh=10)
+    for x in range(9):
+        tracker.add(x)
+    assert tracker.percentile() is None
+    for x in range(9, 100):
+        tracker.add(x)
+    assert tracker.percentile() == 95
+
+    # a rolling window, recomputed every refresh samples
+    for _ in range(100):
+        tracker.add(0.5)
+    assert tracker.percentile() == 0.5
+
+
+def test_hedge_budget():
+    budget = HedgeBudget(ratio=0.25, burst=2)
+    assert not budget.spend()
+    for _ in range(4):
+        budget.earn()
+    assert budget.spend()
+    assert not budget.spend()
+    for _ in range(100):
+        budget.earn()
+    assert budget.spend() and budget.spend()
+    assert not budget.spend()
+
+
+@pytest.fixture
+def hedger():
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        hedger = Hedger(executor, HedgeBudget(ratio=1))
+        tracker = hedger.tracker("orgs")
+        for _ in range(tracker.min_samples):
+            tracker.add(0.01)
+        yield hedger
+
+
+def test_slow_request_is_hedged(hedger):
+    release = threading.Event()
+    calls = []
+
+    def get():
+        calls.append(1)
+        if len(calls) == 1:
+            # the first request hangs until the test is done
+            release.wait(5)
+            return "slow"
+        return "fast"
+
+    assert hedger.call("orgs", get) == "fast"
+    assert hedger.hedges == 1
+    release.set()
+
+    # fast requests are not hedged
+    assert hedger.call("orgs", lambda: "ok") == "ok"
+    assert hedger.hedges == 1
+
+
+def test_hedges_are_budgeted(hedger):
+    hedger.budget.ratio = 0
+    hedger.budget.tokens = 0
+    calls = []
+
+    def get():
+        calls.append(1)
+        threading.Event().wait(0.05)
+        return len(calls)
+
+    assert hedger.call("orgs", get) == 1
+    assert len(calls) == 1 and hedger.hedges == 0
+
+
+def test_failed_request_falls_back_to_hedge(hedger):
+    calls = []
+
+    def get():
+        calls.append(1)
+        if len(calls) == 1:
+            threading.Event().wait(0.05)
+            raise TimeoutError()
+        threading.Event().wait(0.1)
+        return "hedge"
+
+    assert hedger.call("orgs", get) == "hedge"
+
+    def fail():
+        threading.Event().wait(0.05)
+        raise KeyError()
+
+    with pytest.raises(KeyError):
+        hedger.call("orgs", fail)
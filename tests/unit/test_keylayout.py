@@ -0,0 +1,23 @@
+# tests for src/keylayout.py using pytest
+from keylayout import *
+
+
+def test_group_layout():
+    assert group_layout("words") == FLAT
+    assert group_layout("words", sharded_groups="organizations, words") == SHARDED
+    assert group_layout("words", sharded_groups="*", migrating_groups="words") == MIGRATING
+    assert group_layout("users", sharded_groups="*") == SHARDED
+
+
+def test_object_keys_round_trip():
+    root = "data/words_deltas"
+    assert object_key(root, "roofing/123-ab") == "data/words_deltas/roofing/123-ab.json.gz"
+    key = object_key(root, "roofing/123-ab", SHARDED)
+    assert key == f"data/words_deltas.shards/{shard('roofing')}/roofing/123-ab.json.gz"
+    assert len(shard("roofing")) == SHARD_CHARS
+    for layout in [FLAT, SHARDED]:
+        assert object_name(root, object_key(root, "roofing/123-ab", layout)) == "roofing/123-ab"
+        assert object_name(root, object_key(root, "ACME 3.0, INC.", layout)) == "ACME 3.0, INC."
+    # the deltas of one posting are in one shard, a plain prefix could be in any
+    assert key.startswith(list_prefix(root, "roofing/", SHARDED))
+    assert list_prefix(root, "roof", SHARDED) == "data/words_deltas.shards/"
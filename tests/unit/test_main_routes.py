@@ -57,3 +57,96 @@ def test_index(loggedin_client):
     print(response.data)
     assert response.status_code == 302
     assert b"Redirecting" in response.data
+
+
+def test_lazy_pagination_materializes_only_page():
+    from main.routes import LazyPagination
+
+    built = []
+
+    def factory(name):
+        built.append(name)
+        return OrganizationProfile(name=name)
+
+    names = set(f"Org {i:04d}" for i in range(1000))
+    pagination = LazyPagination(names, 2, 25, factory)
+    assert pagination.total == 1000
+    assert pagination.pages == 40
+    assert built == []
+    assert [x.name for x in pagination.items] == [f"Org {i:04d}" for i in range(25, 50)]
+    assert len(built) == 25
+
+    last = LazyPagination(names, 40, 25, factory)
+    assert [x.name for x in last.items][-1] == "Org 0999"
+    assert LazyPagination(names, 41, 25, factory).items == []
+
+
+def test_search_organizations_fetches_terms_concurrently(client, monkeypatch):
+    from time import sleep, time
+    from main.routes import search_organizations
+
+    postings = {
+        "acme": ["ACME ROOFING OF TEXAS", "ACME DENTAL"],
+        "roofing": ["ACME ROOFING OF TEXAS", "ROOFING PROS"],
+        "texas": ["ACME ROOFING OF TEXAS"],
+    }
+
+    def get(self, word):
+        sleep(0.3)
+        return dict(word=word, organizations=postings.get(word, []))
+
+    monkeypatch.setattr(DAO, "is_cached", lambda self, name: False)
+    monkeypatch.setattr(Words, "head", get)
+    start = time()
+    pagination = search_organizations(["Acme", "Roofing", "Texas"])
+    assert time() - start < 0.8
+    assert [x.name for x in pagination.items] == ["ACME ROOFING OF TEXAS"]
+
+
+def test_search_organizations_phonetic(client, monkeypatch):
+    from main.routes import search_organizations
+
+    postings = {
+        "jon": dict(word="jon", organizations=["JON SMITH PLUMBING"]),
+        "john": dict(word="john", organizations=["JOHN SMYTH ROOFING"]),
+        "smyth": dict(word="smyth", organizations=["JOHN SMYTH ROOFING"]),
+        "smith": dict(word="smith", organizations=["JON SMITH PLUMBING"]),
+    }
+    phonetics = dict()
+    for word in postings:
+        for key in Phonetics().keys(word):
+            phonetics.setdefault(key, dict(key=key, words=[], users=[]))["words"].append(word)
+    monkeypatch.setattr(
+        Words, "get_many", lambda self, names, **kwargs: {x: postings[x] for x in names if x in postings}
+    )
+    monkeypatch.setattr(
+        Phonetics, "get_many", lambda self, keys, **kwargs: {x: phonetics[x] for x in keys if x in phonetics}
+    )
+    pagination = search_organizations(["Jon", "Smith"], phonetic=True)
+    assert [x.name for x in pagination.items] == ["JOHN SMYTH ROOFING", "JON SMITH PLUMBING"]
+    assert search_organizations(["Jon", "Smith"]).total == 1
+
+
+def test_search_organizations_returns_partial_results(client, monkeypatch):
+    from time import sleep, time
+    from main.routes import search_organizations
+
+    postings = {
+        "acme": ["ACME ROOFING OF TEXAS", "ACME DENTAL"],
+        "roofing": ["ACME ROOFING OF TEXAS", "ROOFING PROS"],
+    }
+
+    def get(self, word):
+        if word == "texas":
+            sleep(1)
+        return dict(word=word, organizations=postings.get(word, []))
+
+    monkeypatch.setattr(DAO, "is_cached", lambda self, name: False)
+    monkeypatch.setattr(Words, "head", get)
+    start = time()
+    pagination = search_organizations(["Acme", "Roofing", "Texas"], budget=0.3)
+    assert time() - start < 0.6
+    assert pagination.partial and "refine your query" in pagination.message
+    # the late term is left out of the intersection
+    assert [x.name for x in pagination.items] == ["ACME ROOFING OF TEXAS"]
+    assert not search_organizations(["Acme", "Roofing"], budget=0.3).partial
@@ -1,6 +1,11 @@
 # tests for src/models.py using pytest
+import io
 import json
 import pytest
+from botocore.exceptions import ClientError
+import models
+from keylayout import shard
+from ranking import top_by_impact
 from models import *
 from auth.utils import requires_login_and_group
 from flask import Blueprint, render_template, redirect, url_for, request, session
@@ -16,3 +21,625 @@ def client():
     app.config["TESTING"] = True
     with app.app_context():
         yield app.test_client()
+
+
+class FakeS3:
+    # in memory s3 with etags and conditional writes
+    class exceptions:
+        class NoSuchKey(Exception):
+            pass
+
+    def __init__(self):
+        self.objects = {}  # key -> (body, etag)
+        self.before_put = None  # called with the key before a put, to race a writer
+
+    def check(self, key, IfMatch=None, IfNoneMatch=None):
+        etag = self.objects.get(key, (None, None))[1]
+        if (IfNoneMatch and etag) or (IfMatch and IfMatch != etag):
+            raise ClientError(dict(Error=dict(Code="PreconditionFailed")), "PutObject")
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise self.exceptions.NoSuchKey(Key)
+        return dict(Body=io.BytesIO(self.objects[Key][0]), ETag=self.objects[Key][1])
+
+    def put_object(self, Bucket, Key, Body, **conditions):
+        if self.before_put:
+            before_put, self.before_put = self.before_put, None
+            before_put(Key)
+        self.check(Key, **conditions)
+        etag = f'"{uuid4().hex}"'
+        self.objects[Key] = (Body, etag)
+        return dict(ETag=etag)
+
+    def copy_object(self, Bucket, Key, CopySource, **conditions):
+        if CopySource["Key"] not in self.objects:
+            raise ClientError(dict(Error=dict(Code="NoSuchKey")), "CopyObject")
+        self.check(Key, **conditions)
+        self.objects[Key] = (self.objects[CopySource["Key"]][0], f'"{uuid4().hex}"')
+
+    def delete_object(self, Bucket, Key, **conditions):
+        if Key in self.objects:
+            self.check(Key, **conditions)
+        self.objects.pop(Key, None)
+
+    def list_objects_v2(self, Bucket, Prefix, **kwargs):
+        return dict(Contents=[dict(Key=x) for x in sorted(self.objects) if x.startswith(Prefix)])
+
+
+class DictCache(dict):
+    def set(self, key, value):
+        self[key] = value
+
+    def delete(self, key):
+        self.pop(key, None)
+
+
+@pytest.fixture
+def fake_s3(monkeypatch):
+    s3 = FakeS3()
+    monkeypatch.setattr(models, "s3", s3)
+    monkeypatch.setattr(models, "r", DictCache())
+    monkeypatch.setattr(config, "WRITE_CONFLICT_BACKOFF", 0.0)
+    return s3
+
+
+def test_fetch_parallel_drops_late_results(client):
+    from time import sleep
+
+    def fetch(key):
+        if key == "slow":
+            sleep(0.5)
+        return key.upper()
+
+    late = set()
+    results = fetch_parallel(fetch, ["a", "b", "slow"], timeout=0.2, late=late)
+    assert results == {"a": "A", "b": "B"}
+    assert late == {"slow"}
+
+    # on the pool the calls run one by one, a failed one is dropped and the ones past the timeout are late
+    def inline_fetch(key):
+        if key == "bad":
+            raise Exception("boom")
+        return fetch(key)
+
+    late = set()
+    results = models.submit(fetch_parallel, inline_fetch, ["a", "bad", "slow", "b"], timeout=0.2, late=late).result()
+    assert results == {"a": "A", "slow": "SLOW"}
+    assert late == {"b"}
+
+
+def test_deadline():
+    from time import sleep
+
+    assert Deadline().remaining() is None and not Deadline().expired
+    deadline = Deadline(0.1)
+    assert 0 < deadline.remaining() <= 0.1
+    sleep(0.15)
+    assert deadline.remaining() == 0 and deadline.expired
+
+
+def test_set_impact_keeps_buckets_ordered():
+    word_data = dict(word="roofing", organizations=["A", "B", "C"])
+    assert set_impact(word_data, "A", rating_impact(1000)) is True
+    assert set_impact(word_data, "B", rating_impact(1000000)) is True
+    assert set_impact(word_data, "B", rating_impact(1000000)) is False
+    assert [x[1] for x in word_data["impacts"]] == [["B"], ["A"]]
+
+    # moving an org between buckets drops the empty bucket
+    set_impact(word_data, "A", rating_impact(5000000))
+    assert [x[1] for x in word_data["impacts"]] == [["A"], ["B"]]
+    assert list(impact_order(word_data))[-1] == (-1, ["C"])
+
+
+def test_location_keys():
+    profile = PPPOrganizationProfile(
+        dict(
+            BorrowerName="ACME ROOFING",
+            BorrowerAddress="1 Main St",
+            BorrowerCity="San  Antonio",
+            BorrowerState="TX",
+            BorrowerZip="78205-1234",
+            ForgivenessDate="2021-06-01",
+        )
+    )
+    assert location_keys(profile) == {"state:tx", "city:san antonio", "zip3:782", "zip5:78205", "street:main"}
+
+
+def test_user_bitmap_keys():
+    profile = UserProfile(name="test", uid="x", groups=["Users", "Admins"], tags=["club"], create_method="manual")
+    assert user_bitmap_keys(profile) == {"all", "create_method:manual", "is_blocked", "is_admin", "tag:club"}
+
+
+def test_user_bitmaps_merge_concurrent_writes(client, fake_s3):
+    # not built yet: nothing is written and readers fall back to the profiles
+    bitmaps = UserBitmaps()
+    assert bitmaps.update_profile(UserProfile(name="ann", uid="1")) and not bitmaps.available()
+    assert not fake_s3.objects
+
+    bitmaps.dao.put("users", dict(names=[], bitmaps={}))
+    first, second = UserBitmaps(), UserBitmaps()
+    assert first.available() and second.available()
+    assert first.update_profile(UserProfile(name="ann", uid="1", is_blocked=False))
+    # second still has the bitmaps it loaded before ann was added
+    assert second.update_profile(UserProfile(name="bob", uid="2", groups=["Admins"]))
+    assert second.remove_profile("ann")
+
+    bitmaps = UserBitmaps()
+    assert bitmaps.available() and bitmaps.names == [None, "bob"]
+    assert bitmaps.profile_names(bitmaps.get("all")) == ["bob"]
+    assert bitmaps.profile_names(bitmaps.get("is_admin")) == ["bob"] and bitmaps.count("is_blocked") == 1
+
+
+def test_segmented_postings(client, fake_s3):
+    names = [f"ORG {x:03d}" for x in range(10)]
+    postings = SegmentedPostings("tag_postings", "organization:ppp", segment_size=3)
+    assert postings.replace(reversed(names)) == 10
+    assert len(postings.header()["segments"]) == 4
+    assert postings.all() == names
+    assert postings.range(2, 4) == names[2:6]
+    assert postings.range(9, 5) == names[9:]
+    assert postings.intersect({"ORG 004", "ORG 011"}) == {"ORG 004"}
+
+    # adds go to the segment the name sorts into and split it once it holds more than two segments' worth
+    for name in ["ORG 004A", "ORG 004B", "ORG 004C", "ORG 004D"]:
+        assert postings.add(name)
+    assert not postings.add("ORG 004A")
+    assert len(postings.header()["segments"]) == 5
+    reloaded = SegmentedPostings("tag_postings", "organization:ppp", segment_size=3)
+    assert reloaded.count() == 14 and reloaded.all() == sorted(names + ["ORG 004A", "ORG 004B", "ORG 004C", "ORG 004D"])
+
+    for name in names[:3]:
+        assert postings.remove(name)
+    assert not postings.remove("ORG 000")
+    assert postings.range(0, 1) == ["ORG 003"]
+    assert len(postings.header()["segments"]) == 4
+    # replaced segments are deleted
+    segments = [x for x in fake_s3.objects if "/tag_postings_segments/" in x]
+    assert len(segments) == 4
+
+    # a segment that cannot be written leaves the header as it was and no segment behind
+    put_object = fake_s3.put_object
+
+    def failing_put(Bucket, Key, Body, **conditions):
+        if "/tag_postings_segments/" in Key:
+            raise ClientError({"Error": {"Code": "InternalError"}}, "PutObject")
+        return put_object(Bucket, Key, Body, **conditions)
+
+    fake_s3.put_object = failing_put
+    header = SegmentedPostings("tag_postings", "organization:ppp").header()
+    assert postings.replace(names) is False
+    assert SegmentedPostings("tag_postings", "organization:ppp").header() == header
+    assert len([x for x in fake_s3.objects if "/tag_postings_segments/" in x]) == 4
+    passed_in = json.loads(json.dumps(header))
+    assert SegmentedPostings("tag_postings", "organization:ppp", header=passed_in).add("ORG 100") is False
+    assert passed_in == header
+
+
+def test_legacy_tag_postings(client, fake_s3):
+    # a tag from before the postings were segmented is not written to on reads, the first profile change moves it
+    DAO("tags").put("beta", dict(name="beta", description=None, profiles=["jon", "ann"]))
+    DAO("tags").put("gone", None)
+    tags = Tags()
+    assert [x["name"] for x in tags.tags()] == ["beta"] and tags.tags()[0]["count"] == 0
+    assert not [x for x in fake_s3.objects if "/tag_postings" in x]
+    assert tags.add_profile("beta", "bob")
+    assert tags.postings("beta").all() == ["ann", "bob", "jon"] and tags.profile_count("beta") == 3
+
+
+def test_rating_order_past_impact_head(client, fake_s3, monkeypatch):
+    monkeypatch.setattr(config, "IMPACT_HEAD", 2)
+    monkeypatch.setattr(config, "WORD_SEGMENT_THRESHOLD", 3)
+    monkeypatch.setattr(config, "POSTING_SEGMENT_SIZE", 2)
+    delta_listings.clear()
+    words = Words()
+    ratings = {f"ORG {x}": 10**x for x in range(8)}
+    posting = dict(word="roofing", organizations=sorted(ratings))
+    for name, rating in ratings.items():
+        set_impact(posting, name, rating_impact(rating))
+    assert words.save("roofing", posting)
+    assert sum([len(x[1]) for x in words.head("roofing")["impacts"]]) == 2
+
+    # every match past the head still comes in rating order
+    by_rating = sorted(ratings, key=lambda x: -ratings[x])
+    assert top_by_impact(impact_order(words.get("roofing")), [], 8) == by_rating
+    assert top_by_impact(impact_order(words.get("roofing")), [set(by_rating[3:])], 3) == by_rating[3:6]
+
+    # compacted changes move names between the head and the tail
+    words.log.append("roofing", adds=[dict(name="ORG 0", impact=rating_impact(10**9), dba=False)], removes=["ORG 7"])
+    assert words.log.compact("roofing")
+    by_rating = ["ORG 0"] + by_rating[1:-1]
+    assert top_by_impact(impact_order(words.get("roofing")), [], 8) == by_rating
+
+
+def test_conditional_writes_retry_conflicts(client, fake_s3):
+    dao = DAO("users")
+    assert dao.update("jon", dict(name="jon", email="jon@example.com"))
+    assert dao.count() == 1
+
+    # another writer saves the object between the read and the write, the update is merged into its version
+    fake_s3.before_put = lambda key: DAO("users").put("jon", dict(name="jon", email="j@example.com", bio="hi"))
+    assert dao.update("jon", dict(is_admin=True))
+    assert dao.get("jon") == dict(name="jon", email="j@example.com", bio="hi", is_admin=True)
+    assert dao.count() == 1
+
+    # a stale version does not overwrite
+    _, version = dao.read("jon")
+    assert dao.put("jon", dict(name="jon"), version=version)
+    with pytest.raises(WriteConflict):
+        dao.put("jon", dict(name="jon", bio="lost"), version=version)
+    with pytest.raises(WriteConflict):
+        dao.put("jon", dict(name="jon"), version=ABSENT)
+    assert Tags().add("beta") and not Tags().add("beta")
+    fake_s3.before_put = lambda key: DAO("tags").put("alpha", dict(name="alpha", description="first"))
+    assert not Tags().add("alpha", description="second")
+    assert Tags().get("alpha")["description"] == "first"
+
+    # a racing writer adds a name to the same tag posting, both names end up in it
+    postings = SegmentedPostings("tag_postings", "user:beta", segment_size=3)
+    assert postings.add("jon")
+    fake_s3.before_put = lambda key: SegmentedPostings("tag_postings", "user:beta", segment_size=3).add("ann")
+    assert postings.add("bob")
+    reloaded = SegmentedPostings("tag_postings", "user:beta", segment_size=3)
+    assert reloaded.all() == ["ann", "bob", "jon"] and reloaded.count() == 3
+    assert len([x for x in fake_s3.objects if "/tag_postings_segments/" in x]) == 1
+
+    # index objects changed with IndexBatch.modify are changed again on what the other writer stored
+    sketches = DAO("sketches")
+    sketches.put("roofing", dict(word="roofing", **build_sketch(["A"], 8)))
+    batch = IndexBatch()
+    batch.read([(sketches, "roofing")])
+    batch.modify(sketches, "roofing", sketch_change("B", add=True))
+    other = sketches.get("roofing")
+    sketch_add(other, "C", 8)
+    sketches.put("roofing", other)
+    assert batch.write()
+    assert sketches.get("roofing")["count"] == 3 and not batch.conflicts
+
+
+def test_sharded_key_layout_migrates_online(client, fake_s3, monkeypatch):
+    orgs, deltas = DAO("organizations"), DAO("words_deltas")
+    for name in ["ACME", "BOLT", "CORE"]:
+        assert orgs.update(name, dict(name=name))
+    assert deltas.put("roofing/1", dict(adds=[], removes=["ACME"]))
+    flat_keys = set([x for x in fake_s3.objects if "/metadata/" not in x])
+
+    # while migrating, writes go to the sharded keys and reads fall back to the flat ones
+    monkeypatch.setattr(config, "S3_MIGRATING_GROUPS", "organizations,words_deltas")
+    assert orgs.key("ACME") == f"{orgs.root}.shards/{shard('ACME')}/ACME.json.gz"
+    assert orgs.get("BOLT") == dict(name="BOLT")
+    assert orgs.update("ACME", dict(rating=5)) and orgs.get("ACME") == dict(name="ACME", rating=5)
+    assert orgs.update("DART", dict(name="DART"))
+    assert orgs.delete("CORE") and orgs.get("CORE") is None
+    assert deltas.put("roofing/2", dict(adds=[], removes=["BOLT"]))
+    assert sorted([orgs.name_of(x["Key"]) for x in orgs.ls()]) == ["ACME", "BOLT", "DART"] and orgs.count() == 4
+    assert sorted([deltas.name_of(x["Key"]) for x in deltas.ls(prefix="roofing/")]) == ["roofing/1", "roofing/2"]
+
+    # copying never overwrites what the app wrote since
+    for group in [orgs, deltas]:
+        for obj in group.list_keys(f"{group.root}/"):
+            assert group.migrate(group.name_of(obj["Key"]))
+    assert orgs.read("ACME")[0] == dict(name="ACME", rating=5)
+    monkeypatch.setattr(config, "S3_MIGRATING_GROUPS", "")
+    monkeypatch.setattr(config, "S3_SHARDED_GROUPS", "organizations,words_deltas")
+    assert orgs.read("BOLT")[0] == dict(name="BOLT") and orgs.read("CORE")[0] is None
+    for group in [orgs, deltas]:
+        for obj in group.list_keys(f"{group.root}/"):
+            assert group.migrate(group.name_of(obj["Key"]), cleanup=True)
+    assert not flat_keys.intersection(fake_s3.objects)
+    assert sorted([x["Key"].split("/")[-1] for x in orgs.ls()]) == ["ACME.json.gz", "BOLT.json.gz", "DART.json.gz"]
+    assert len(deltas.ls(prefix="roofing/")) == 2
+
+
+def test_organization_update_batches_index_writes(client, fake_s3, monkeypatch):
+    delta_listings.clear()
+    puts = []
+    put_object = fake_s3.put_object
+
+    def recording_put(Bucket, Key, Body, **conditions):
+        puts.append(Key)
+        return put_object(Bucket, Key, Body, **conditions)
+
+    fake_s3.put_object = recording_put
+    monkeypatch.setattr(Tags, "add_profile", lambda *args, **kwargs: None)
+    address = PhysicalAddressProfile(street1="1 Main St", city="Tulsa", state="OK", postal_code="74103", country="US")
+    org = OrganizationProfile(name="ACME DBA ROOFING PROS", antisocial_rating=1000, physical_addresses=[address])
+
+    assert Organizations().update(org)
+    assert Words().get("acme")["organizations"] == [org.name]
+    assert Words().get("roofing")["dba"] == [org.name]
+    assert Sketches().get("pros")["count"] == 1
+    assert Locations().get("street:main")["organizations"] == [org.name]
+    assert all(["acme" in Phonetics().get(x)["words"] for x in Phonetics().keys("acme")])
+    assert DAO("organizations").count() == 1
+
+    # an unchanged org writes nothing, a changed one only a patch of itself
+    puts.clear()
+    assert Organizations().update(org)
+    assert puts == []
+    org.is_premium_user = True
+    assert Organizations().update(org)
+    assert puts == [DAO("organizations_patches").key(f"{org.name}/0000000001")]
+    assert DAO("organizations_patches").get(f"{org.name}/0000000001") == {"set": {"is_premium_user": True}}
+    assert Organizations().get(org.name).is_premium_user
+
+
+def test_organization_rename_and_delete_clean_postings(client, fake_s3):
+    delta_listings.clear()
+    orgs = Organizations()
+    orgs.update(OrganizationProfile(name="ACME ROOFING", antisocial_rating=1000))
+    orgs.update(OrganizationProfile(name="BOLT ROOFING"))
+
+    organization = orgs.get("ACME ROOFING")
+    organization.name = "ACME SIDING"
+    assert orgs.update(organization, previous_name="ACME ROOFING")
+    assert orgs.get("ACME ROOFING") is None
+    assert Words().get("roofing")["organizations"] == ["BOLT ROOFING"]
+    assert Words().get("acme")["organizations"] == ["ACME SIDING"]
+    assert [x for x in Words().get("acme")["impacts"] if "ACME ROOFING" in x[1]] == []
+    assert Sketches().get("roofing")["count"] == 1
+    assert DAO("organizations").count() == 2
+
+    assert orgs.delete("BOLT ROOFING")
+    assert Words().get("roofing") is None and Words().get("bolt") is None and Sketches().get("roofing") is None
+    assert all(["bolt" not in Phonetics().get(x)["words"] for x in Phonetics().keys("bolt")])
+    assert DAO("organizations").count() == 1
+
+    # the compactor folds the deltas into the base postings and deletes the emptied ones
+    for key, deltas in Words().log.pending().items():
+        assert Words().log.compact(key, deltas)
+    assert Words().log.pending() == {}
+    assert Words().dao.get("acme")["organizations"] == ["ACME SIDING"] and Words().dao.get("roofing") is None
+
+
+def test_apply_delta_replays_idempotently():
+    deltas = [
+        dict(adds=[dict(name="ACME", impact=10, dba=False), dict(name="BOLT", impact=5, dba=True)], removes=[]),
+        dict(adds=[], removes=["BOLT"]),
+        dict(adds=[dict(name="ACME", impact=20, dba=False)], removes=[]),
+    ]
+    posting = dict(word="roofing", organizations=["CORE"])
+    for delta in deltas:
+        apply_delta(posting, delta)
+    assert posting["organizations"] == ["CORE", "ACME"]
+    assert posting["impacts"] == [[20, ["ACME"]]] and posting["dba"] == []
+    # a compaction folded the deltas but has not deleted them yet
+    replayed = json.loads(json.dumps(posting))
+    for delta in deltas:
+        apply_delta(replayed, delta)
+    assert replayed == posting
+
+
+def test_segmented_word_postings(client, fake_s3, monkeypatch):
+    delta_listings.clear()
+    monkeypatch.setattr(config, "WORD_SEGMENT_THRESHOLD", 4)
+    monkeypatch.setattr(config, "POSTING_SEGMENT_SIZE", 2)
+    words = Words()
+    names = [f"ORG {x}" for x in range(6)]
+    words.log.append("services", adds=[dict(name=x, impact=9 if x == "ORG 5" else 1) for x in names])
+    assert words.log.compact("services")
+
+    # the base became the header of sorted segments, the full posting is still there for get()
+    head = words.head("services")
+    assert is_segmented(head) and "organizations" not in head and head["count"] == 6
+    assert head["impacts"][0] == [9, ["ORG 5"]]
+    assert words.get("services")["organizations"] == names
+    assert words.page(head, 2, 2) == ["ORG 2", "ORG 3"]
+    assert words.intersect(head, {"ORG 1", "ORG 4", "ACME"}) == {"ORG 1", "ORG 4"}
+
+    # changes to a segmented posting are deltas until compacted into the segments they fall in
+    words.log.append("services", adds=[dict(name="ORG 25", impact=1)], removes=["ORG 1"])
+    head = words.head("services")
+    assert posting_count(head) == 6 and words.intersect(head, {"ORG 1", "ORG 25"}) == {"ORG 25"}
+    assert words.page(head, 0, 2) == ["ORG 0", "ORG 2"]
+
+    # pages and their total take in the deltas: names added before, among and after the segments, a name re-added
+    # by a rating change and one added and removed again
+    words.log.append("services", adds=[dict(name=x, impact=1) for x in ["AAA", "ORG 45", "ZED", "ZZZ"]])
+    words.log.append("services", adds=[dict(name="ORG 3", impact=7)], removes=["ORG 4", "ZED"])
+    head = words.head("services")
+    expected = ["AAA", "ORG 0", "ORG 2", "ORG 25", "ORG 3", "ORG 45", "ORG 5", "ZZZ"]
+    assert sorted(words.get("services")["organizations"]) == expected and words.total(head) == len(expected)
+    for length in range(1, 5):
+        for start in range(0, 10):
+            assert words.page(head, start, length) == expected[start : start + length]
+    words.log.append("services", removes=["AAA", "ORG 45", "ZZZ"], adds=[dict(name="ORG 4", impact=1)])
+    assert words.log.compact("services")
+    assert words.get("services")["organizations"] == ["ORG 0", "ORG 2", "ORG 25", "ORG 3", "ORG 4", "ORG 5"]
+
+    # the write path only reads the segment a name would be in
+    assert Organizations().update(OrganizationProfile(name="ACME SERVICES"))
+    assert Organizations().update(OrganizationProfile(name="ACME SERVICES"))
+    assert words.head("services")["added"] == ["ACME SERVICES"]
+    assert Organizations().delete("ACME SERVICES")
+    assert "ACME SERVICES" not in words.get("services")["organizations"]
+
+
+def test_hedged_get(client, fake_s3, monkeypatch):
+    monkeypatch.setattr(config, "S3_HEDGE_GROUPS", "organizations, users")
+    orgs = DAO("organizations")
+    assert orgs.hedged() and not DAO("words").hedged()
+    assert orgs.put("ACME", dict(name="ACME"))
+    models.r.delete(orgs.key("ACME"))
+    assert orgs.get("ACME") == dict(name="ACME")
+    assert orgs.read("DART") == (None, ABSENT)
+
+
+def test_patched_profiles(client, fake_s3):
+    patch_listings.clear()
+    users = PatchedDAO("users")
+    profile = dict(name="jon", emails=["a@example.com"], raw_data=dict(bio="hi"))
+    assert users.update("jon", profile)
+    assert not users.patches.ls()
+
+    # edits are stored as patches of the fields they change
+    assert users.update("jon", dict(emails=["a@example.com", "b@example.com"]))
+    assert users.update("jon", dict(raw_data=dict(bio="hello")))
+    assert users.update("jon", dict(raw_data=dict(bio="hello")))
+    assert users.patch_seqs("jon") == [1, 2]
+    assert users.patches.get("jon/0000000001") == {"splice": {"emails": [1, 1, ["b@example.com"]]}}
+    expected = dict(name="jon", emails=["a@example.com", "b@example.com"], raw_data=dict(bio="hello"))
+    assert users.get("jon") == expected and users.read("jon")[1][0] == 2
+
+    # an edit that loses the race to a patch is applied again on top of it
+    fake_s3.before_put = lambda key: fake_s3.__setattr__("before_put", None) or users.update("jon", dict(nick="j"))
+    assert users.update("jon", dict(emails=[]))
+    assert users.get("jon") == dict(expected, emails=[], nick="j") and users.patch_seqs("jon") == [1, 2, 3, 4]
+
+    # a reader that listed the patches before the compactor folded them reads them off the new base
+    seqs = users.patch_seqs("jon")
+    assert users.compact("jon")
+    assert not users.patches.ls() and users.read("jon")[1][0] == 4
+    assert users.merge("jon", users.read("jon")[0] | {PATCHED_THROUGH: 4}, seqs) == (users.get("jon"), 4)
+    assert users.update("jon", dict(nick="jj")) and users.patch_seqs("jon") == [5]
+    assert users.get("jon") == dict(expected, emails=[], nick="jj")
+
+    # reads and edits probe for the next patches instead of listing them
+    lists = []
+    list_objects = fake_s3.list_objects_v2
+    fake_s3.list_objects_v2 = lambda **kwargs: lists.append(kwargs["Prefix"]) or list_objects(**kwargs)
+    patch_listings.clear()
+    models.r.clear()
+    assert users.get("jon") == dict(expected, emails=[], nick="jj") and users.read("jon")[1][0] == 5
+    assert users.update("jon", dict(nick="j2")) and users.get("jon")["nick"] == "j2" and lists == []
+    fake_s3.list_objects_v2 = list_objects
+
+    # a compactor that folds the patches between the read of the base and the probe for them is noticed
+    get_object = fake_s3.get_object
+
+    def compacting_get(Bucket, Key):
+        if Key.endswith("/0000000005.json.gz"):
+            fake_s3.get_object = get_object
+            assert users.compact("jon")
+        return get_object(Bucket, Key)
+
+    models.r.clear()
+    fake_s3.get_object = compacting_get
+    data, version = users.read("jon")
+    assert data["nick"] == "j2" and version[0] == 6 and not users.patches.ls()
+    assert users.update("jon", dict(nick="jj")) and users.get("jon")["nick"] == "jj"
+
+    # patches left behind by a deleted profile do not apply to the next one of that name
+    fake_s3.delete_object = lambda Bucket, Key: Key.endswith("0000000007.json.gz") or fake_s3.objects.pop(Key)
+    assert users.delete("jon") and users.patch_seqs("jon") == [7]
+    assert users.get("jon") is None and users.read("jon") == (None, ABSENT)
+    assert users.update("jon", dict(name="jon"))
+    assert users.get("jon") == dict(name="jon")
+
+
+def test_patched_profiles_cold_reads(client, fake_s3, monkeypatch):
+    # a profile with patches reads the same from a cold cache as from a warm one, and saves what it read
+    delta_listings.clear()
+    monkeypatch.setattr(UserBitmaps, "update_profile", lambda *args: None)
+    monkeypatch.setattr(Phonetics, "add", lambda *args: None)
+    users, orgs = Users(), Organizations()
+
+    def cold():
+        models.r.clear()
+        patch_listings.clear()
+
+    user = UserProfile(name="jon", uid="1", email_addresses=[EmailAddressProfile(email="a@x.com")])
+    assert users.update(user)
+    user.tags = ["club"]
+    assert users.update(user)
+    user.email_addresses = [EmailAddressProfile(email="b@x.com")]
+    assert users.update(user)
+    assert users.dao.patch_seqs("jon") == [1, 2]
+    warm = users.get("jon")
+    cold()
+    assert users.get("jon") == warm and warm.tags == ["club"] and len(warm.email_addresses) == 1
+    cold()
+    user = users.get("jon")
+    user.nickname = "j"
+    assert users.update(user)
+    cold()
+    assert users.get("jon") == warm.copy(update=dict(nickname="j"))
+
+    org = OrganizationProfile(name="ACME ROOFING", tags=["ppp"])
+    monkeypatch.setattr(Tags, "add_profile", lambda *args, **kwargs: None)
+    assert orgs.update(org)
+    org.telephone_numbers = [TelephoneNumberProfile(phone="555 0100")]
+    assert orgs.update(org)
+    org.tags = ["ppp", "roofers"]
+    assert orgs.update(org)
+    warm = orgs.get(org.name)
+    cold()
+    assert orgs.get(org.name) == warm and warm.tags == ["ppp", "roofers"] and len(warm.telephone_numbers) == 1
+    cold()
+    org = orgs.get(org.name)
+    org.is_premium_user = True
+    assert orgs.update(org)
+    cold()
+    assert orgs.get(org.name) == warm.copy(update=dict(is_premium_user=True))
+
+
+def test_change_event_log(client, fake_s3, monkeypatch):
+    patch_listings.clear()
+    event_listings.clear()
+    monkeypatch.setattr(config, "CHANGE_EVENT_PAGE", 3)
+    monkeypatch.setattr(config, "CHANGE_EVENT_SEGMENT_SIZE", 4)
+    monkeypatch.setattr(UserBitmaps, "update_profile", lambda *args: None)
+    monkeypatch.setattr(Phonetics, "add", lambda *args: None)
+    users = Users()
+
+    def event(idx: int, rating: int = 0):
+        return ChangeEventProfile(
+            change=f"change {idx}",
+            change_date=f"2024-01-{idx:02d}",
+            changed_by_user="admin",
+            social_rating_change=rating,
+        )
+
+    # saves move the events on the profile to its log, the document keeps the rating snapshot
+    user = UserProfile(name="jon", uid="1", change_events=[event(1, 10)], social_rating=10)
+    assert users.update(user)
+    for idx in range(2, 7):
+        user = users.get("jon")
+        assert user.change_events == []
+        user.change_events.append(event(idx, 1))
+        user.social_rating += 1
+        assert users.update(user)
+    assert users.dao.get("jon")["change_events"] == [] and users.get("jon").social_rating == 15
+    assert len(users.events.names("jon")) == 6
+
+    # a view fetches only the objects of the latest events, embedded legacy events are listed with them
+    gets = []
+    get = users.events.dao.get
+    monkeypatch.setattr(users.events.dao, "get", lambda name: gets.append(name) or get(name))
+    latest = users.events.latest("jon", embedded=[event(7)])
+    assert [x.change for x in latest] == ["change 7", "change 6", "change 5"] and len(gets) == 3
+
+    # the compactor folds the log into segments in time order
+    assert users.events.pending() == ["jon"]
+    assert users.events.compact("jon")
+    assert [x.rsplit("-", 1)[1] for x in users.events.names("jon")] == ["4", "2"]
+    assert [x.change for x in users.events.latest("jon", count=10)] == [f"change {x}" for x in range(6, 0, -1)]
+    assert users.events.pending() == ["jon"] and not users.events.compact("jon")
+
+    # a ppp org's forgiveness event is rebuilt from its raw data, it is not logged
+    org = PPPOrganizationProfile(dict(BorrowerName="ACME", ForgivenessAmount="100", ForgivenessDate="2021-01-01"))
+    apply = Organizations.apply
+    monkeypatch.setattr(Organizations, "apply", lambda self, changes: True)
+    assert Organizations().update(org) and Organizations().events.names("ACME") == []
+    org.change_events.append(event(8, 5))
+    assert Organizations().update(org) and len(Organizations().events.names("ACME")) == 1
+
+    # a save that keeps conflicting logs none of its events
+    monkeypatch.setattr(config, "WRITE_CONFLICT_RETRIES", 1)
+    put_object = fake_s3.put_object
+
+    def conflicting_put(Bucket, Key, Body, **conditions):
+        if "/users_patches/" in Key or "/organizations/" in Key:
+            raise ClientError(dict(Error=dict(Code="PreconditionFailed")), "PutObject")
+        return put_object(Bucket, Key, Body, **conditions)
+
+    fake_s3.put_object = conflicting_put
+    user = users.get("jon")
+    user.change_events.append(event(9, 1))
+    user.social_rating += 1
+    assert not users.update(user)
+    assert users.get("jon").social_rating == 15 and len(users.events.latest("jon", count=10)) == 6
+    org = OrganizationProfile(name="BOLT", change_events=[event(9, 1)], social_rating=1)
+    monkeypatch.setattr(Organizations, "apply", apply)
+    assert not Organizations().update(org)
+    assert Organizations().get("BOLT") is None and Organizations().events.names("BOLT") == []
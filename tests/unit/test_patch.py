@@ -0,0 +1,44 @@
+from patch import apply_patch, diff, splice
+
+
+def test_diff_is_field_level():
+    old = dict(
+        name="ACME",
+        rating=5,
+        emails=[dict(email="a@example.com", is_default=True), dict(email="b@example.com", is_default=False)],
+        events=[dict(change="one"), dict(change="two")],
+        raw_data=dict(BorrowerName="ACME", LoanAmount="100"),
+        nickname="acme",
+    )
+    new = dict(
+        name="ACME",
+        rating=6,
+        emails=[dict(email="a@example.com", is_default=False), dict(email="b@example.com", is_default=True)],
+        events=[dict(change="one"), dict(change="two"), dict(change="three")],
+        raw_data=dict(BorrowerName="ACME", LoanAmount="200"),
+        tags=["ppp"],
+    )
+    patch = diff(old, new)
+    assert patch == {
+        "unset": ["nickname"],
+        "set": {"rating": 6, "tags": ["ppp"]},
+        "splice": {"emails": [0, 2, new["emails"]], "events": [2, 2, [dict(change="three")]]},
+        "patch": {"raw_data": {"set": {"LoanAmount": "200"}}},
+    }
+    assert apply_patch(old, patch) == new
+    assert old["events"] == [dict(change="one"), dict(change="two")]
+    assert diff(new, new) == {}
+
+
+def test_splice():
+    for old, new in [
+        ([1, 2, 3], [1, 3]),
+        ([1, 2, 3], [0, 1, 2, 3]),
+        ([1, 1, 1], [1, 1]),
+        ([], [1]),
+        ([1, 2], []),
+        ([1, 2, 3, 4], [1, 5, 4]),
+    ]:
+        start, end, items = splice(old, new)
+        assert old[:start] + items + old[end:] == new
+    assert splice([1, 2, 3], [1, 3]) == [1, 2, []]
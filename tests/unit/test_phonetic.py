@@ -0,0 +1,39 @@
+# tests for src/phonetic.py using pytest
+import pytest
+from phonetic import double_metaphone, phonetic_entries, phonetic_keys, phonetic_tokens
+
+
+@pytest.mark.parametrize(
+    "word, expected",
+    [
+        ("smith", ("SM0", "XMT")),
+        ("schmidt", ("XMT", "SMT")),
+        ("john", ("JN", "AN")),
+        ("catherine", ("K0RN", "KTRN")),
+        ("philip", ("FLP", "FLP")),
+        ("knight", ("NT", "NT")),
+        ("xavier", ("SF", "SFR")),
+        ("michael", ("MKL", "MXL")),
+        ("wasserman", ("ASRM", "FSRM")),
+        ("edge", ("AJ", "AJ")),
+        ("laugh", ("LF", "LF")),
+        ("", ("", "")),
+    ],
+)
+def test_double_metaphone(word, expected):
+    assert double_metaphone(word) == expected
+
+
+def test_misspellings_share_a_key():
+    for a, b in [("jon", "john"), ("smyth", "smith"), ("kathryn", "catherine"), ("müller", "miller")]:
+        assert phonetic_keys(a) & phonetic_keys(b)
+    assert not phonetic_keys("smith") & phonetic_keys("jones")
+
+
+def test_phonetic_entries():
+    assert phonetic_tokens("Jon_Smith-2, Inc.") == ["jon", "smith", "inc"]
+    entries = phonetic_entries(["JON SMITH INC", "JOHN SMYTH"], exclude=["inc"])
+    assert entries["JN"] == {"jon", "john"}
+    assert entries["SM0"] == {"smith", "smyth"}
+    assert "ANK" not in entries
+    assert phonetic_entries(["jon_smith"], by_name=True)["JN"] == {"jon_smith"}
@@ -0,0 +1,128 @@
+# tests for src/query.py using pytest
+import pytest
+from models import *
+from app import app
+import query
+from query import QueryError, RatingPredicate, StatePredicate, TagPredicate, WordPredicate, parse, plan
+
+
+@pytest.fixture
+def client():
+    app.config["TESTING"] = True
+    with app.app_context():
+        yield app.test_client()
+
+
+def org(name, state="TX", city="Austin", postal_code="78701", rating=0, tags=[]):
+    profile = OrganizationProfile(name=name, antisocial_rating=rating, tags=tags)
+    profile.physical_addresses.append(
+        PhysicalAddressProfile(street1="1 Main", city=city, state=state, postal_code=postal_code, country="USA")
+    )
+    return profile
+
+
+@pytest.fixture
+def data(client, monkeypatch):
+    orgs = {
+        "ACME ROOFING": org("ACME ROOFING", rating=250000, tags=["ppp"]),
+        "BEST ROOFING": org("BEST ROOFING", state="OK", city="Tulsa", postal_code="74101", rating=500000),
+        "ROOFING PROS": org("ROOFING PROS", rating=1000, tags=["ppp"]),
+    }
+    postings = {"roofing": dict(word="roofing", organizations=list(orgs.keys())), "acme": None}
+    locations = {}
+    for profile in orgs.values():
+        for key in location_keys(profile):
+            locations.setdefault(key, dict(key=key, organizations=[]))["organizations"].append(profile.name)
+    loaded = []
+
+    def get_many(self, names, timeout=None):
+        loaded.extend(names)
+        return {x: orgs[x] for x in names if x in orgs}
+
+    store = {}
+    monkeypatch.setattr(DAO, "get", lambda self, name: store.get(self.key(name)))
+    monkeypatch.setattr(DAO, "update", lambda self, name, data: store.__setitem__(self.key(name), data))
+    monkeypatch.setattr(DAO, "rm", lambda self, name: store.pop(self.key(name), None))
+    monkeypatch.setattr(DAO, "read", lambda self, name: (store.get(self.key(name)), None))
+    monkeypatch.setattr(
+        DAO, "put", lambda self, name, data, version=None: store.__setitem__(self.key(name), data) or True
+    )
+    monkeypatch.setattr(DAO, "delete", lambda self, name, version=None: store.pop(self.key(name), None) or True)
+    Tags().postings("ppp", profile_type="organization").replace([x.name for x in orgs.values() if "ppp" in x.tags])
+    monkeypatch.setattr(query, "suggest_index", lambda: None)
+    monkeypatch.setattr(Words, "get_many", lambda self, names, **kwargs: {x: postings[x] for x in names if postings.get(x)})
+    monkeypatch.setattr(Locations, "get_many", lambda self, keys, timeout=None: {x: locations[x] for x in keys if x in locations})
+    monkeypatch.setattr(Organizations, "get_many", get_many)
+    return loaded
+
+
+def test_parse():
+    predicates = parse('state:TX city:"san antonio" tag:ppp rating>100000 roofing LLC')
+    assert [type(x) for x in predicates] == [
+        StatePredicate,
+        query.CityPredicate,
+        TagPredicate,
+        RatingPredicate,
+        WordPredicate,
+    ]
+    assert predicates[1].value == "san antonio"
+    assert predicates[3].op == ">" and predicates[3].value == 100000
+    with pytest.raises(QueryError):
+        parse("rating>lots")
+
+
+def test_plan_filters_candidates(data):
+    query_plan = plan("state:tx rating>100000 roofing")
+    assert query_plan.execute() == {"ACME ROOFING"}
+    assert query_plan.describe()[0] == "index state:tx (~2)"
+    # the rating range is narrowed with the posting impacts only when they exist, so both are loaded
+    assert sorted(data) == ["ACME ROOFING", "ROOFING PROS"]
+
+
+def test_plan_starts_from_most_selective_index(data):
+    query_plan = plan("city:tulsa roofing")
+    assert query_plan.execute() == {"BEST ROOFING"}
+    assert query_plan.describe() == ["index city:tulsa (~1)", "index word:roofing (~3)"]
+    assert plan("zip:787 roofing").execute() == {"ACME ROOFING", "ROOFING PROS"}
+    assert data == []
+
+
+def test_plan_missing_word_matches_nothing(data):
+    assert plan("state:tx acme roofing").execute() == set()
+    assert data == []
+
+
+def test_plan_needs_an_index(data):
+    with pytest.raises(QueryError):
+        plan("rating>100000").execute()
+
+
+def test_plan_filter_limit(data):
+    with pytest.raises(QueryError):
+        plan("rating>100000 roofing").execute(filter_limit=2)
+
+
+def test_plan_tags_are_indexed(data):
+    query_plan = plan("tag:ppp roofing")
+    assert query_plan.execute() == {"ACME ROOFING", "ROOFING PROS"}
+    assert query_plan.describe() == ["index tag:ppp (~2)", "index word:roofing (~3)"]
+    assert data == []
+    assert plan("city:tulsa tag:ppp").execute() == set()
+
+
+def test_plan_pages_a_lone_tag(data):
+    query_plan = plan("tag:PPP")
+    assert query_plan.is_paged()
+    assert query_plan.page(1, 1) == (["ACME ROOFING"], 2)
+    assert query_plan.page(2, 1) == (["ROOFING PROS"], 2)
+    assert query_plan.page(3, 1) == ([], 2)
+
+
+def test_plan_rating_uses_impacts(data, monkeypatch):
+    word_data = dict(word="roofing", organizations=["ACME ROOFING", "BEST ROOFING", "ROOFING PROS"])
+    set_impact(word_data, "ACME ROOFING", rating_impact(250000))
+    set_impact(word_data, "BEST ROOFING", rating_impact(500000))
+    set_impact(word_data, "ROOFING PROS", rating_impact(1000))
+    monkeypatch.setattr(Words, "get_many", lambda self, names, **kwargs: {"roofing": word_data})
+    assert plan("rating>100000 roofing").execute() == {"ACME ROOFING", "BEST ROOFING"}
+    assert sorted(data) == ["ACME ROOFING", "BEST ROOFING"]
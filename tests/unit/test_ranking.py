@@ -0,0 +1,49 @@
+# tests for src/ranking.py using pytest
+import pytest
+
+from ranking import bm25_scores, min_should_match, name_tokens, top_by_impact
+
+
+def test_name_tokens():
+    assert name_tokens("Acme Roofing, L.L.C.") == ["acme", "roofing", "llc"]
+
+
+def test_bm25_prefers_rare_terms_and_short_names():
+    postings = {
+        "roofing": {"ACME ROOFING", "BEST ROOFING AND SIDING OF TEXAS", "ROOFING PROS"},
+        "acme": {"ACME ROOFING", "ACME DENTAL"},
+    }
+    scores = bm25_scores(postings, doc_count=1000, avg_length=3.0, min_should_match=1)
+    ranked = sorted(scores, key=lambda x: -scores[x])
+    assert ranked[0] == "ACME ROOFING"
+    assert scores["ACME DENTAL"] > scores["ROOFING PROS"]
+    assert scores["ROOFING PROS"] > scores["BEST ROOFING AND SIDING OF TEXAS"]
+
+
+def test_bm25_min_should_match():
+    postings = {"acme": {"ACME ROOFING", "ACME DENTAL"}, "roofing": {"ACME ROOFING", "ROOFING PROS"}}
+    assert set(bm25_scores(postings, 1000, 3.0, min_should_match=2)) == {"ACME ROOFING"}
+
+
+def test_bm25_field_weights():
+    postings = {"roofing": {"acme roofing", "acme dba roofing"}}
+    scores = bm25_scores(postings, doc_count=100, avg_length=2.0)
+    weighted = bm25_scores(postings, doc_count=100, avg_length=2.0, weights={"roofing": {"acme dba roofing": 0.7}})
+    assert weighted["acme roofing"] == scores["acme roofing"]
+    assert weighted["acme dba roofing"] == pytest.approx(0.7 * scores["acme dba roofing"])
+
+
+def test_min_should_match():
+    assert min_should_match(4) == 4
+    assert min_should_match(4, "75%") == 3
+    assert min_should_match(2, "75%") == 1
+    assert min_should_match(3, "5") == 3
+    assert min_should_match(3, "junk") == 3
+
+
+def test_top_by_impact_stops_at_threshold():
+    impacts = [[100, ["Z ROOFING", "A ROOFING"]], [90, ["B ROOFING", "C ROOFING"]], [10, ["D ROOFING"]]]
+    filters = [{"A ROOFING", "C ROOFING", "D ROOFING", "Z ROOFING"}]
+    assert top_by_impact(impacts, filters, 2) == ["A ROOFING", "Z ROOFING"]
+    assert top_by_impact(impacts, filters, 3) == ["A ROOFING", "Z ROOFING", "C ROOFING"]
+    assert top_by_impact(impacts, filters, 10) == ["A ROOFING", "Z ROOFING", "C ROOFING", "D ROOFING"]
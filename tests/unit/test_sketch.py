@@ -0,0 +1,34 @@
+# tests for src/sketch.py using pytest
+from sketch import build_sketch, estimate_intersection, is_exact, sketch_add, sketch_rm
+
+
+def names(start, end):
+    return [f"ORG {x}" for x in range(start, end)]
+
+
+def test_small_postings_are_exact():
+    a = build_sketch(names(0, 100), 256)
+    b = build_sketch(names(50, 300), 256)
+    assert is_exact(a) and is_exact(b)
+    assert estimate_intersection([a, b]) == (50, True)
+    assert estimate_intersection([b]) == (250, True)
+
+
+def test_large_postings_are_estimated():
+    a = build_sketch(names(0, 200000), 512)
+    b = build_sketch(names(150000, 400000), 512)
+    c = build_sketch(names(0, 20000), 512)
+    estimate, exact = estimate_intersection([a, b])
+    assert not exact and 35000 < estimate < 65000
+    assert estimate_intersection([a, c]) == (20000, False)
+    # disjoint postings share no hashes, so there is nothing to estimate from
+    assert estimate_intersection([b, c]) is None
+
+
+def test_sketch_maintenance():
+    sketch = build_sketch(names(0, 10), 4)
+    for name in names(10, 20):
+        sketch_add(sketch, name, 4)
+    assert sketch == build_sketch(names(0, 20), 4)
+    sketch_rm(sketch, "ORG 0")
+    assert sketch["count"] == 19 and len(sketch["hashes"]) <= 4
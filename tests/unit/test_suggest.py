@@ -0,0 +1,53 @@
+# tests for src/suggest.py using pytest
+import random
+import pytest
+from suggest import SuggestIndex, build_suggest_index
+
+
+@pytest.fixture
+def index(tmp_path):
+    fn = str(tmp_path / "suggest.idx")
+    entries = [
+        ("roofing", 900, "word"),
+        ("roofers", 40, "word"),
+        ("rock", 300, "word"),
+        ("robert", 5000, "word"),
+        ("rob", 1, "user"),
+        ("zebra", 2, "word"),
+        ("Ñandu", 3, "word"),
+    ]
+    build_suggest_index(entries, fn, k=3, threshold=1)
+    return SuggestIndex(fn)
+
+
+def test_suggest_long_prefix(index):
+    assert [x["term"] for x in index.suggest("roo")] == ["roofing", "roofers"]
+    assert index.suggest("roofi")[0] == dict(term="roofing", df=900, kind="word")
+    assert index.suggest("rooz") == []
+
+
+def test_suggest_short_prefix_is_precomputed(index):
+    assert [x["term"] for x in index.suggest("r")] == ["robert", "roofing", "rock"]
+    assert [x["term"] for x in index.suggest("ro", k=2)] == ["robert", "roofing"]
+    assert index.suggest("ña")[0]["term"] == "ñandu"
+    assert "roo" in index.prefix_table and "z" not in index.prefix_table
+
+
+def test_suggest_usernames(index):
+    assert dict(term="rob", df=1, kind="user") in index.suggest("rob")
+
+
+def test_suggest_matches_a_full_scan(tmp_path):
+    # prefixes of any length with more than threshold completions are precomputed, the others scanned, and both
+    # give the top completions by df
+    rnd = random.Random(7)
+    words = ["".join(rnd.choice("abc") for _ in range(rnd.randint(1, 6))) for _ in range(300)]
+    entries = [(x, rnd.randint(1, 50), "word") for x in words]
+    fn = str(tmp_path / "suggest.idx")
+    build_suggest_index(entries, fn, k=5, threshold=4)
+    index = SuggestIndex(fn)
+    assert any(len(x) >= 3 for x in index.prefix_table)
+    terms = [index.entry(x) for x in range(len(index))]
+    for prefix in {x["term"][:length] for x in terms for length in range(1, 5)}:
+        expected = sorted([x for x in terms if x["term"].startswith(prefix)], key=lambda x: (-x["df"], x["term"]))
+        assert index.suggest(prefix, k=5) == expected[:5]
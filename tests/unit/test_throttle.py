@@ -0,0 +1,90 @@
+import threading
+
+from botocore.exceptions import ClientError, ReadTimeoutError
+import pytest
+
+from throttle import AdaptiveLimiter, LimitedClient, is_overload
+
+
+def client_error(code, status):
+    return ClientError({"Error": {"Code": code}, "ResponseMetadata": {"HTTPStatusCode": status}}, "PutObject")
+
+
+def slow_down():
+    return client_error("SlowDown", 503)
+
+
+def test_is_overload():
+    assert is_overload(slow_down())
+    assert is_overload(ReadTimeoutError(endpoint_url="https://s3"))
+    assert is_overload(client_error("InternalError", 500))
+    assert not is_overload(client_error("NoSuchKey", 404))
+    assert not is_overload(ValueError())
+
+
+def test_limit_grows_while_saturated_and_healthy():
+    limiter = AdaptiveLimiter(initial=2, maximum=3)
+    for _ in range(20):
+        started = [limiter.acquire() for _ in range(int(limiter.limit))]
+        for x in started:
+            limiter.release(x)
+    assert limiter.limit == 3
+
+    # a limit that is not in use does not grow
+    limiter = AdaptiveLimiter(initial=4)
+    for _ in range(20):
+        limiter.release(limiter.acquire())
+    assert limiter.limit == 4
+
+
+def test_limit_halves_once_per_overload_episode():
+    limiter = AdaptiveLimiter(initial=16, minimum=2)
+    started = [limiter.acquire() for _ in range(8)]
+    for x in started:
+        limiter.release(x, overloaded=True)
+    assert limiter.limit == 8
+
+    for _ in range(5):
+        limiter.release(limiter.acquire(), overloaded=True)
+    assert limiter.limit == 2
+
+    # slow responses hold the limit
+    limiter = AdaptiveLimiter(initial=1, latency_target=-1)
+    limiter.release(limiter.acquire())
+    assert limiter.limit == 1
+
+
+def test_acquire_blocks_at_the_limit():
+    limiter = AdaptiveLimiter(initial=1)
+    started = limiter.acquire()
+    acquired = threading.Event()
+    thread = threading.Thread(target=lambda: acquired.set() if limiter.acquire() else None)
+    thread.start()
+    assert not acquired.wait(0.1)
+    limiter.release(started)
+    assert acquired.wait(1)
+    thread.join()
+
+
+def test_limited_client():
+    class Meta:
+        method_to_api_mapping = {"put_object": "PutObject"}
+
+    class Client:
+        meta = Meta()
+        exceptions = "exceptions"
+
+        def put_object(self, **kwargs):
+            assert limiter.in_flight == 1
+            if kwargs.get("fail"):
+                raise slow_down()
+            return kwargs
+
+    limiter = AdaptiveLimiter(initial=4)
+    client = LimitedClient(Client(), limiter)
+    assert client.put_object(Key="a") == {"Key": "a"}
+    assert client.exceptions == "exceptions"
+    with pytest.raises(ClientError):
+        client.put_object(fail=True)
+    assert limiter.in_flight == 0
+    assert limiter.limit == 2
@@ -0,0 +1,25 @@
+from tokenizer import index_tokens, name_words, organization_fields, split_dba, street_tokens, tokenize_batch
+
+
+def test_index_tokens():
+    assert index_tokens("Joe's Roofing, L.L.C. & Roofing Inc") == ["joes", "roofing"]
+    assert index_tokens("Café Olé") == ["cafe", "ole"]
+
+
+def test_tokenize_batch_matches_index_tokens():
+    names = ["ACME ROOFING LLC", "Joe's\nPlumbing", "", None, "Café Olé D/B/A Sunrise"]
+    assert tokenize_batch(names) == [index_tokens(x) for x in names]
+
+
+def test_split_dba():
+    assert split_dba("ACME LLC DBA ACME ROOFING") == ("ACME LLC", "ACME ROOFING")
+    assert split_dba("Smith Holdings d/b/a Smith Plumbing") == ("Smith Holdings", "Smith Plumbing")
+    assert split_dba("J. Doe D.B.A. Doe Lawn Care") == ("J. Doe", "Doe Lawn Care")
+    assert split_dba("ADBA Services") == ("ADBA Services", "")
+
+
+def test_organization_fields():
+    fields = organization_fields("ACME LLC DBA ACME ROOFING", ["1200 N Oak Park Ave Suite 4"])
+    assert fields == dict(name=["acme"], dba=["roofing"], street=["oak", "park"])
+    assert name_words("ACME LLC DBA ACME ROOFING") == ["acme", "roofing"]
+    assert street_tokens("1 Main St") == ["main"]